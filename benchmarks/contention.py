@@ -0,0 +1,221 @@
+"""
+contention on the offer and claim path: worker processes race for the same tasks, directly on the database
+and through QueueProxy against a local gunicorn; checks that every task is executed exactly once
+
+    python benchmarks/contention.py --tasks 500 --processes 8
+    python benchmarks/contention.py --mode proxy --gunicorn-workers 4
+    python benchmarks/contention.py --mode proxy --url http://localhost:8000
+
+reports claims per second, duplicate claims (a task executed more than once), lost tasks (never executed, or not done),
+and wasted round trips: offers which found nothing while there was still work, and retries after a locked database or server error
+"""
+
+import os
+import sys
+import time
+import socket
+import logging
+import tempfile
+import subprocess
+import multiprocessing
+from collections import Counter
+
+import click
+import requests
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return float('nan')
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100. * len(values)))]
+
+
+def open_queue(mode, queue_uri, worker_id):
+    import dqueue.core as core
+
+    core.logger.setLevel(logging.ERROR)
+    core.sleep_multiplier = 0
+
+    if mode == "direct":
+        return core.Queue(queue_uri, worker_id=worker_id)
+
+    from dqueue.proxy import QueueProxy
+    return QueueProxy(queue_uri, worker_id=worker_id)
+
+
+def is_contention(e: Exception) -> bool:
+    "SQLite refuses a second writer outright; through the server, the same comes back as a server error"
+
+    import peewee
+    from bravado.exception import HTTPServerError # type: ignore
+
+    return (isinstance(e, peewee.OperationalError) and 'locked' in str(e)) or isinstance(e, HTTPServerError)
+
+
+def work(mode, queue_uri, worker_id, patience):
+    """
+    claims and completes tasks, until offers find nothing patience times in a row;
+    returns indices of executed tasks, claim latencies, offers which found nothing before a claim, and retries
+    """
+
+    try:
+        return _work(mode, queue_uri, worker_id, patience)
+    except Exception as e:
+        # some client exceptions can not be sent back from the pool, and would hang it
+        raise RuntimeError(f"worker {worker_id} failed: {e!r}")
+
+
+def _work(mode, queue_uri, worker_id, patience):
+    import dqueue.core as core
+
+    queue = open_queue(mode, queue_uri, worker_id)
+
+    executed = []
+    latencies = []
+    wasted = 0
+    retries = 0
+
+    n_empty = 0
+    while n_empty < patience:
+        t0 = time.time()
+        try:
+            task = queue.get()
+        except core.Empty:
+            n_empty += 1
+            time.sleep(0.01)
+            continue
+        except Exception as e:
+            if not is_contention(e):
+                raise
+            retries += 1
+            continue
+
+        latencies.append(time.time() - t0)
+
+        # offers which found nothing while this worker could still claim were round trips for nothing
+        wasted += n_empty
+        n_empty = 0
+
+        executed.append(task.task_data['i'])
+
+        while True:
+            try:
+                queue.task_done()
+                break
+            except Exception as e:
+                if not is_contention(e):
+                    raise
+                retries += 1
+
+    return executed, latencies, wasted, retries
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(n_workers):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+
+    p = subprocess.Popen([sys.executable, "-m", "gunicorn", "--workers", str(n_workers), "dqueue.api:app",
+                          "-b", f"127.0.0.1:{port}", "--log-level", "WARNING"],
+                         env={**os.environ, 'DQUEUE_DISABLE_AUTH': 'yes'})
+
+    for i in range(300):
+        try:
+            requests.get(url + "/apispec_1.json", timeout=1).raise_for_status()
+            return p, url
+        except requests.RequestException:
+            if p.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with {p.returncode}")
+            time.sleep(0.1)
+
+    p.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+def run(mode, queue_uri, queue_name, n_tasks, n_processes, patience):
+    import dqueue.core as core
+    from dqueue.database import TaskEntry
+
+    queue = core.Queue(queue_name)
+    queue.wipe(["waiting", "done", "running", "failed", "locked", "reserved"])
+
+    for i in range(n_tasks):
+        queue.put(dict(bench="contention", mode=mode, i=i))
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(n_processes) as pool:
+        t0 = time.time()
+        results = pool.starmap(work, [(mode, queue_uri, f"contention-{mode}-{i}", patience) for i in range(n_processes)])
+        elapsed_s = time.time() - t0
+
+    executed = Counter(sum([r[0] for r in results], []))
+    latencies = sum([r[1] for r in results], [])
+
+    states = Counter(e.state for e in TaskEntry.select(TaskEntry.state).where(TaskEntry.queue == queue_name).execute(database=None))
+
+    duplicates = sum(n - 1 for n in executed.values() if n > 1)
+    lost = n_tasks - len(executed)
+
+    print(f"{mode:>8s} {n_processes:3d} processes: {len(latencies)} claims in {elapsed_s:.2f} s, {len(latencies)/elapsed_s:.1f} claims/s, "
+          f"p50 {percentile(latencies, 50)*1000:.1f} ms p99 {percentile(latencies, 99)*1000:.1f} ms")
+    print(f"{'':>8s} duplicate claims {duplicates}, lost {lost}, final states {dict(states)}; "
+          f"wasted offers {sum(r[2] for r in results)}, retries {sum(r[3] for r in results)}; "
+          f"claims per process {[len(r[0]) for r in results]}")
+
+    return duplicates == 0 and lost == 0 and states == Counter(done=n_tasks)
+
+
+@click.command()
+@click.option("--tasks", "n_tasks", default=300, help="tasks raced for")
+@click.option("--processes", "n_processes", default=8, help="worker processes")
+@click.option("--mode", type=click.Choice(["direct", "proxy", "both"]), default="both")
+@click.option("--url", default=None, help="server for proxy workers; by default a local gunicorn is started on the same database")
+@click.option("--gunicorn-workers", default=4, help="workers of the local gunicorn")
+@click.option("--patience", default=5, help="offers finding nothing in a row, before a worker stops")
+@click.option("--database-url", default=None, help="instead of a temporary SQLite file")
+def main(n_tasks, n_processes, mode, url, gunicorn_workers, patience, database_url):
+    if database_url is not None:
+        os.environ['DQUEUE_DATABASE_URL'] = database_url
+    elif 'DQUEUE_DATABASE_URL' not in os.environ:
+        os.environ['DQUEUE_DATABASE_URL'] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "contention.db") + "?timeout=60"
+
+    os.environ.setdefault('DQUEUE_LOG_LEVEL', 'ERROR')
+
+    print(f"database: {os.environ['DQUEUE_DATABASE_URL']}")
+
+    queue_name = "benchmark-contention"
+
+    # creates tables, before the server and the workers race to do it
+    open_queue("direct", queue_name, "contention-setup")
+
+    ok = True
+
+    if mode in ("direct", "both"):
+        ok &= run("direct", queue_name, queue_name, n_tasks, n_processes, patience)
+
+    if mode in ("proxy", "both"):
+        server = None
+        if url is None:
+            server, url = start_gunicorn(gunicorn_workers)
+
+        try:
+            ok &= run("proxy", url + "@" + queue_name, queue_name, n_tasks, n_processes, patience)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    if not ok:
+        print("FAILED: some tasks were not executed exactly once")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
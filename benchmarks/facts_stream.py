@@ -0,0 +1,118 @@
+"""
+large data facts: raw chunked streaming compared to the JSON path, throughput and peak memory
+
+    python benchmarks/facts_stream.py --size-mb 128
+    python benchmarks/facts_stream.py --size-mb 512 --url http://localhost:8000
+
+without --url, only the server side handling of the request body is measured, no storage is needed;
+with --url, facts are uploaded to and restored from a running server, with its minio
+"""
+
+import os
+import json
+import time
+import base64
+import tracemalloc
+
+import click
+
+block = os.urandom(1024*1024)
+
+
+class SyntheticStream:
+    "file-like, reads size bytes without holding them"
+
+    def __init__(self, size: int):
+        self.size = size
+        self.position = 0
+
+    def read(self, n: int=-1) -> bytes:
+        if n < 0:
+            n = self.size - self.position
+
+        n = min(n, self.size - self.position, len(block))
+        self.position += n
+        return block[:n]
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(len(block))
+            if not chunk:
+                break
+            yield chunk
+
+
+def measure(f):
+    tracemalloc.start()
+    t0 = time.time()
+    try:
+        r = f()
+    finally:
+        elapsed_s = time.time() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return r, elapsed_s, peak
+
+
+def report(name, size, elapsed_s, peak):
+    print(f"{name:>24s} {size/1024**2:8.0f} Mb {elapsed_s:8.2f} s {size/1024**2/elapsed_s:8.1f} Mb/s peak memory {peak/1024**2:8.1f} Mb")
+
+
+def json_path(size):
+    # as /data/assert: client encodes, server decodes the request and the data, and encodes again to store
+    data = base64.b64encode(b"".join(SyntheticStream(size))).decode()
+    body = json.dumps(dict(dag_json=json.dumps(["F"]), data_json=json.dumps(data)))
+    payload = json.loads(body)
+    stored = json.dumps(dict(dag=["F"], data=json.loads(payload['data_json'])))
+    return len(stored)
+
+
+@click.command()
+@click.option("--size-mb", default=128, help="size of the fact")
+@click.option("--url", default=None, help="server to store facts to, e.g. http://localhost:8000")
+@click.option("--compare-json/--no-compare-json", default=True, help="also run the JSON path, needs several times the size in memory")
+def main(size_mb, url, compare_json):
+    import dqueue.facts as facts
+
+    size = size_mb * 1024 * 1024
+
+    print(f"fact of {size_mb} Mb, spooled in memory up to {facts.spool_max_memory/1024**2:.0f} Mb, chunks of {facts.chunk_size/1024**2:.0f} Mb")
+
+    def spool():
+        f, n, sha256 = facts.spool(SyntheticStream(size))
+        f.close()
+        return n
+
+    n, elapsed_s, peak = measure(spool)
+    assert n == size
+    report("raw spool", size, elapsed_s, peak)
+
+    if compare_json:
+        n, elapsed_s, peak = measure(lambda: json_path(size))
+        report("json decode and encode", size, elapsed_s, peak)
+
+    if url is not None:
+        from dqueue.data import DataFacts
+
+        client = DataFacts(url + "@default")
+        dag = ["benchmark-facts-stream", size_mb, time.time()]
+
+        r, elapsed_s, peak = measure(lambda: client.assert_fact_stream(dag, iter(SyntheticStream(size))))
+        assert r['size'] == size
+        report("upload stream", size, elapsed_s, peak)
+        print(f"{'':>24s} server spool {r['spool_s']:.2f} s upload {r['upload_s']:.2f} s")
+
+        class Sink:
+            n = 0
+            def write(self, chunk):
+                self.n += len(chunk)
+
+        sink = Sink()
+        _, elapsed_s, peak = measure(lambda: client.consult_fact_stream(dag, output=sink))
+        assert sink.n == size
+        report("download stream", size, elapsed_s, peak)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+simulates skewed load: one user floods the queue, a few others submit occasionally,
+a fixed pool of workers serves tasks; reports per-user waiting latency
+
+    python benchmarks/fair_share.py --flood 500 --others 3 --per-other 20
+"""
+
+import os
+import time
+import random
+import logging
+import tempfile
+from collections import defaultdict
+
+import click
+
+def percentile(values, q):
+    if len(values) == 0:
+        return float('nan')
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100. * len(values)))]
+
+
+def simulate(fair_share, n_flood, n_others, n_per_other, n_workers, seed):
+    import dqueue.core as core
+
+    core.logger.setLevel(logging.ERROR)
+    core.fair_share = fair_share
+
+    queue = core.Queue("benchmark-fair-share")
+    queue.wipe(["waiting", "done", "running", "failed", "locked"])
+
+    random.seed(seed)
+
+    # submission schedule: (step, user, task_data); the flood comes first, in one go
+    schedule = [(0, "flood", dict(bench="fair-share", user="flood", i=i)) for i in range(n_flood)]
+    for u in range(n_others):
+        for i in range(n_per_other):
+            schedule.append((random.randint(0, n_flood // n_workers), f"other-{u}", dict(bench="fair-share", user=f"other-{u}", i=i)))
+
+    schedule.sort(key=lambda x: x[0])
+
+    submitted_at = {}
+    latency_steps = defaultdict(list)
+    latency_s = defaultdict(list)
+
+    step = 0
+    while len(schedule) > 0 or len(submitted_at) > 0:
+        while len(schedule) > 0 and schedule[0][0] <= step:
+            _, user, task_data = schedule.pop(0)
+            queue.put(task_data, submission_data=dict(user_email=user))
+            submitted_at[core.Task(task_data).key] = (step, time.time())
+
+        for i_worker in range(n_workers):
+            try:
+                task = queue.get()
+            except core.Empty:
+                break
+
+            s0, t0 = submitted_at.pop(task.key)
+            latency_steps[task.user_email].append(step - s0)
+            latency_s[task.user_email].append(time.time() - t0)
+
+            queue.task_done()
+
+        step += 1
+
+    return latency_steps, latency_s
+
+
+@click.command()
+@click.option("--flood", "n_flood", default=500, help="tasks submitted at once by the flooding user")
+@click.option("--others", "n_others", default=3, help="number of other users")
+@click.option("--per-other", "n_per_other", default=20, help="tasks submitted by each other user, spread in time")
+@click.option("--workers", "n_workers", default=4, help="tasks served per simulation step")
+@click.option("--seed", default=1)
+def main(n_flood, n_others, n_per_other, n_workers, seed):
+    if 'DQUEUE_DATABASE_URL' not in os.environ:
+        os.environ['DQUEUE_DATABASE_URL'] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "fair-share.db")
+
+    os.environ.setdefault('DQUEUE_LOG_LEVEL', 'ERROR')
+
+    for fair_share in False, True:
+        latency_steps, latency_s = simulate(fair_share, n_flood, n_others, n_per_other, n_workers, seed)
+
+        print(f"\n\033[33mfair share: {fair_share}\033[0m, latency in steps (each step serves {n_workers} tasks) and seconds")
+        print(f"{'user':>10s} {'N':>5s} {'p50':>6s} {'p90':>6s} {'max':>6s} {'p50 s':>8s} {'p90 s':>8s}")
+        for user in sorted(latency_steps):
+            l, ls = latency_steps[user], latency_s[user]
+            print(f"{user:>10s} {len(l):5d} {percentile(l, 50):6d} {percentile(l, 90):6d} {max(l):6d} {percentile(ls, 50):8.3f} {percentile(ls, 90):8.3f}")
+
+
+if __name__ == "__main__":
+    main()
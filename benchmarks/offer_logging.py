@@ -0,0 +1,80 @@
+"""
+cost of logging on the offer path: latency of get and task_done with the queue loggers at each level,
+and with only per-offer detail (DQUEUE_HOT_PATH_LOG_LEVEL) raised to WARNING
+
+    python benchmarks/offer_logging.py --tasks 500 --worker-knowledge
+
+records are formatted and written to /dev/null, as a deployment writing logs to a file would pay for them
+"""
+
+import os
+import time
+import logging
+import tempfile
+
+import click
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return float('nan')
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100. * len(values)))]
+
+
+def measure(core, level, hot_level, n_tasks, worker_knowledge):
+    core.logger.setLevel(level)
+    getattr(core, 'hot_logger', core.logger).setLevel(hot_level)
+
+    queue = core.Queue("benchmark-offer-logging")
+    queue.wipe(["waiting", "done", "running", "failed", "locked", "reserved"])
+
+    for i in range(n_tasks):
+        queue.put(dict(bench="offer-logging", i=i, tags=["a", "b"]))
+
+    latencies = []
+    while True:
+        t0 = time.time()
+        try:
+            queue.get(worker_knowledge=worker_knowledge)
+        except core.Empty:
+            break
+        queue.task_done()
+        latencies.append(time.time() - t0)
+
+    return latencies
+
+
+@click.command()
+@click.option("--tasks", "n_tasks", default=300, help="tasks offered and completed at each level")
+@click.option("--worker-knowledge/--no-worker-knowledge", default=False, help="offers scored against worker knowledge")
+def main(n_tasks, worker_knowledge):
+    os.environ.setdefault('DQUEUE_DATABASE_URL', "sqlite:///" + os.path.join(tempfile.mkdtemp(), "offer-logging.db"))
+
+    import dqueue.core as core
+
+    devnull = open(os.devnull, "w")
+    for logger in [logging.getLogger(), core.logger]:
+        for handler in logger.handlers:
+            if isinstance(handler, logging.StreamHandler):
+                handler.setStream(devnull)
+
+    knowledge = [{"any-of": [{"key": ["tags"], "value": "a"}]}] if worker_knowledge else None
+
+    # first pass warms up connections and caches
+    measure(core, logging.WARNING, logging.WARNING, min(n_tasks, 20), knowledge)
+
+    for name, level, hot_level in [
+                ("DEBUG", logging.DEBUG, logging.DEBUG),
+                ("INFO", logging.INFO, logging.INFO),
+                ("INFO, hot path WARNING", logging.INFO, logging.WARNING),
+                ("WARNING", logging.WARNING, logging.WARNING),
+            ]:
+        latencies = measure(core, level, hot_level, n_tasks, knowledge)
+        print(f"{name:>24s} {len(latencies):6d} offers {len(latencies)/sum(latencies):8.1f}/s "
+              f"p50 {percentile(latencies, 50)*1000:7.2f} ms p99 {percentile(latencies, 99)*1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+queue engine throughput and latency: put, claim and complete, single process and concurrent workers,
+and maintenance and view calls on a populated queue
+
+    python benchmarks/queue_engine.py --tasks 2000 --events 20000 --processes 4
+    python benchmarks/queue_engine.py --database-url mysql://root@localhost/dqueue_benchmark
+
+SQLite in a temporary file by default; any DQUEUE_DATABASE_URL can be given, e.g. a local MySQL
+"""
+
+import os
+import time
+import logging
+import tempfile
+import multiprocessing
+
+import click
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return float('nan')
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100. * len(values)))]
+
+
+def report(name, latencies, elapsed_s=None):
+    if elapsed_s is None:
+        elapsed_s = sum(latencies)
+
+    n = len(latencies)
+    rate = n / elapsed_s if elapsed_s > 0 else float('nan')
+
+    print(f"{name:>28s} {n:7d} {rate:10.1f}/s p50 {percentile(latencies, 50)*1000:8.2f} ms p99 {percentile(latencies, 99)*1000:8.2f} ms max {max(latencies, default=float('nan'))*1000:8.2f} ms")
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.time()
+    r = f(*args, **kwargs)
+    return r, time.time() - t0
+
+
+def setup_process():
+    import dqueue.core as core
+
+    core.logger.setLevel(logging.ERROR)
+    core.sleep_multiplier = 0
+
+    return core
+
+
+def retrying(f, retries):
+    "SQLite refuses concurrent write transactions outright: these are retried, and counted"
+
+    import peewee
+
+    t0 = time.time()
+    while True:
+        try:
+            f()
+            return time.time() - t0
+        except peewee.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            retries.append(e)
+            time.sleep(0.001)
+
+
+def claim_and_complete(queue_name, n_max=None):
+    "claims and completes tasks until there are none; returns latencies of get and task_done, and the number of retries"
+
+    core = setup_process()
+
+    queue = core.Queue(queue_name)
+
+    get_latencies = []
+    done_latencies = []
+    retries = [] # type: list
+
+    while n_max is None or len(get_latencies) < n_max:
+        try:
+            get_latencies.append(retrying(queue.get, retries))
+        except core.Empty:
+            break
+
+        done_latencies.append(retrying(queue.task_done, retries))
+
+    return get_latencies, done_latencies, len(retries)
+
+
+def populate(queue, n_tasks, tag):
+    latencies = []
+    for i in range(n_tasks):
+        _, dt = timed(queue.put, dict(bench="queue-engine", tag=tag, i=i))
+        latencies.append(dt)
+    return latencies
+
+
+@click.command()
+@click.option("--tasks", "n_tasks", default=1000, help="tasks put and processed in each workload")
+@click.option("--events", "n_events", default=10000, help="event log entries added before measuring views")
+@click.option("--processes", "n_processes", default=4, help="concurrent worker processes")
+@click.option("--database-url", default=None, help="instead of a temporary SQLite file")
+def main(n_tasks, n_events, n_processes, database_url):
+    if database_url is not None:
+        os.environ['DQUEUE_DATABASE_URL'] = database_url
+    elif 'DQUEUE_DATABASE_URL' not in os.environ:
+        # concurrent workers wait for the write lock instead of failing
+        os.environ['DQUEUE_DATABASE_URL'] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "queue-engine.db") + "?timeout=60"
+
+    os.environ.setdefault('DQUEUE_LOG_LEVEL', 'ERROR')
+    os.environ.setdefault('DQUEUE_RETRY_BACKOFF_S', '0')
+
+    print(f"database: {os.environ['DQUEUE_DATABASE_URL']}")
+    print(f"{'':>28s} {'N':>7s} {'rate':>12s}")
+
+    core = setup_process()
+
+    queue_name = "benchmark-queue-engine"
+    queue = core.Queue(queue_name)
+    queue.wipe(["waiting", "done", "running", "failed", "locked", "reserved"])
+    queue.clear_task_history()
+
+    # single process
+    report("put", populate(queue, n_tasks, "single"))
+
+    (get_latencies, done_latencies, _), elapsed_s = timed(claim_and_complete, queue_name)
+    report("get", get_latencies)
+    report("task_done", done_latencies)
+    report("claim and complete", [a + b for a, b in zip(get_latencies, done_latencies)], elapsed_s)
+
+    # concurrent workers, own processes and connections
+    populate(queue, n_tasks, "concurrent")
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(n_processes) as pool:
+        t0 = time.time()
+        results = pool.starmap(claim_and_complete, [(queue_name,)] * n_processes)
+        elapsed_s = time.time() - t0
+
+    get_latencies = sum([r[0] for r in results], [])
+    done_latencies = sum([r[1] for r in results], [])
+    report(f"get, {n_processes} processes", get_latencies, elapsed_s)
+    report(f"task_done, {n_processes} processes", done_latencies, elapsed_s)
+    print(f"{'':>28s} {len(get_latencies)} claimed of {n_tasks}, per process: {[len(r[0]) for r in results]}, "
+          f"retried on lock: {sum(r[2] for r in results)}")
+
+    # maintenance and views, on a populated queue and event log
+    populate(queue, n_tasks, "maintenance")
+    claim_and_complete(queue_name, n_max=n_tasks // 2)
+
+    for i in range(n_events):
+        queue.log_task(f"benchmark event {i}", task_key=f"benchmark-{i % max(n_tasks, 1)}", state="running")
+
+    for name, f in [
+                ("expire_tasks", queue.expire_tasks),
+                ("try_all_locked", queue.try_all_locked),
+                ("get_summary", queue.get_summary),
+                ("view_log", queue.view_log),
+                ("view_log of one task", lambda: queue.view_log(task_key="benchmark-1")),
+            ]:
+        latencies = [timed(f)[1] for i in range(5)]
+        report(name, latencies)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,10 @@ from urllib.parse import urlparse, parse_qs
 import dqueue.core 
 import dqueue.app
 import dqueue.tools as tools
+import dqueue.facts as facts
+import dqueue.metrics as metrics
+import dqueue.profiling as profiling
+import dqueue.tracing as tracing
 
 import peewee # type: ignore
 import json
@@ -54,6 +58,15 @@ logger=logging.getLogger(__name__)
 
 ## === schemas
 
+class ProfileSummary(Schema):
+    id = fields.Str()
+    name = fields.Str()
+    pid = fields.Int()
+    started = fields.Float()
+    duration_s = fields.Float()
+    n_queries = fields.Int()
+    queries_s = fields.Float()
+
 class HubVersion(Schema):
     version = fields.Str()
 
@@ -66,6 +79,7 @@ class SubmissionData(Schema):
 class TaskPayload(Schema):
     task_data = TaskData
     submission_data = SubmissionData
+    priority = fields.Int()
 
 class Task(Schema):
     state = fields.Str()
@@ -85,6 +99,73 @@ class LogEntry(Schema):
 class LogSummaryReport(Schema):
     N = fields.Int()
 
+class RetentionPolicyReport(Schema):
+    kind = fields.Str()
+    max_age_days = fields.Float()
+    keep_last = fields.Int()
+    deleted = fields.Int()
+    elapsed_s = fields.Float()
+    rows_per_s = fields.Float()
+
+class RetentionReport(Schema):
+    deleted = fields.Int()
+    chunks = fields.Int()
+    max_id = fields.Int(allow_none=True)
+    elapsed_s = fields.Float()
+    rows_per_s = fields.Float()
+    policies = fields.Nested(RetentionPolicyReport, many=True)
+
+class MovedTasks(Schema):
+    tasks = fields.Int()
+
+class RollupBucket(Schema):
+    bucket = fields.Str()
+    queue = fields.Str()
+    worker_id = fields.Str()
+    factory_name = fields.Str()
+    n_events = fields.Int()
+    n_started = fields.Int()
+    n_done = fields.Int()
+    n_failed = fields.Int()
+    spent_s_sum = fields.Float()
+    spent_s_count = fields.Int()
+    spent_s_mean = fields.Float(allow_none=True)
+    spent_s_p50 = fields.Float(allow_none=True)
+    spent_s_p90 = fields.Float(allow_none=True)
+    spent_s_p99 = fields.Float(allow_none=True)
+    last_active = fields.Str(allow_none=True)
+
+class Rollup(Schema):
+    buckets = fields.Nested(RollupBucket, many=True)
+
+class RollupUpdateReport(Schema):
+    events = fields.Int()
+    batches = fields.Int()
+    elapsed_s = fields.Float()
+
+class QueryTraceStatement(Schema):
+    sql = fields.Str()
+    params = fields.Str()
+    count = fields.Int()
+    total_s = fields.Float()
+    mean_s = fields.Float()
+    max_s = fields.Float()
+    rows = fields.Int()
+
+class QueryTraceExecution(Schema):
+    sql = fields.Str()
+    params = fields.Str()
+    duration_s = fields.Float()
+    timestamp = fields.Float()
+    rows = fields.Int()
+
+class QueryTraceReport(Schema):
+    pid = fields.Int()
+    n_traced = fields.Int()
+    n_statements = fields.Int()
+    statements = fields.Nested(QueryTraceStatement, many=True)
+    slowest = fields.Nested(QueryTraceExecution, many=True)
+
 class Summary(Schema):
     pass
 
@@ -105,6 +186,20 @@ class DataFact(Schema):
     dag_json = fields.Str()
     data_json = fields.Str()
 
+class DataFactsQuery(Schema):
+    dags_json = fields.List(fields.Str())
+
+class DataFactsExistence(Schema):
+    exists = fields.List(fields.Bool())
+
+class DataFactStreamReport(Schema):
+    bucket = fields.Str()
+    format = fields.Str()
+    size = fields.Int()
+    sha256 = fields.Str()
+    spool_s = fields.Float()
+    upload_s = fields.Float()
+
 ## === views
 
 class SummaryView(SwaggerView):
@@ -451,7 +546,6 @@ class WorkerDataAssertFact(SwaggerView):
         payload_dict = request.json
 
         try:
-            dag_json = json.loads(payload_dict['dag_json'])
             dag = json.loads(payload_dict['dag_json'])
             data_json = payload_dict['data_json']
             data = json.loads(data_json)
@@ -469,6 +563,17 @@ class WorkerDataAssertFact(SwaggerView):
         
         logger.info("storing object %s size %s Mb in dag-motivated bucket: %s", dag[-1], len(data_json)/1024./1024, dag_bucket)
 
+        if facts.upload_spool.enabled:
+            # durable here, uploaded in background; served from the spool until then
+            facts.upload_spool.put(dag_bucket, '{"dag": ' + payload_dict['dag_json'] + ', "data": ' + data_json + '}')
+
+            facts.restored.drop(dag_bucket)
+            facts.known.note(dag_bucket, format="json", size=len(data_json))
+
+            return jsonify(
+                        { 'bucket': dag_bucket }
+                   )
+
         attempts_left = 1
         bucket = None
 
@@ -497,6 +602,9 @@ class WorkerDataAssertFact(SwaggerView):
                     logger.error("stored debug bucket to %s", fn)
                     raise
 
+        facts.restored.drop(dag_bucket)
+        facts.known.note(dag_bucket, format="json", size=len(data_json))
+
         logger.info("succesfully returning!")
 
         return jsonify(
@@ -561,6 +669,27 @@ class WorkerDataConsultFact(SwaggerView):
 
         #logger.error("return_data %s %s", return_data,type( return_data))
 
+        fact = facts.spooled(dag_bucket)
+        if fact is None:
+            fact = facts.restored.get(dag_bucket)
+            metrics.inc("dqueue_facts_restored_total", cache="miss" if fact is None else "hit")
+
+        if fact is not None:
+            logger.info("fact found in spool or memory")
+            if return_data:
+                return jsonify(**fact)
+            else:
+                return Response(
+                          f"bucket found: {dag_bucket}",
+                          status=200,
+                       )
+
+        if not return_data and facts.known.known([dag_bucket])[dag_bucket]:
+            return Response(
+                      f"bucket found: {dag_bucket}",
+                      status=200,
+                   )
+
         if odakb.datalake.exists(dag_bucket):
             if return_data:
                 logger.info("data requested!")
@@ -573,7 +702,21 @@ class WorkerDataConsultFact(SwaggerView):
                               status=400,
                            )
                 except minio.error.NoSuchKey:
+                    raw_meta = facts.raw_meta(dag)
+
+                    if raw_meta is not None and raw_meta.get('format') == "container":
+                        fact = facts.restore_container_as_json(dag)
+                        facts.restored.put(dag_bucket, fact)
+                        return jsonify(**fact)
+
+                    if raw_meta is not None:
+                        return Response(
+                                  f"fact is stored raw, consult it with /data/consult/stream: {dag_bucket}",
+                                  status=400,
+                               )
+
                     odakb.datalake.delete(dag_bucket)
+                    facts.known.forget(dag_bucket)
                     logger.error("bucket was corrupt, deleting")
                     return Response(
                               f"corrupt bucket: {dag_bucket}",
@@ -581,12 +724,19 @@ class WorkerDataConsultFact(SwaggerView):
                            )
 
                 assert payload['dag'] == dag
-                
-                return jsonify(
+
+                fact = dict(
                            dag_json=json.dumps(payload['dag'], sort_keys=True),
                            data_json=json.dumps(payload['data'], sort_keys=True),
                        )
+
+                facts.restored.put(dag_bucket, fact)
+                
+                return jsonify(**fact)
             else:
+                # asserted before it was indexed
+                facts.known.note(dag_bucket, format="unknown")
+
                 return Response(
                           f"bucket found: {dag_bucket}",
                           status=200,
@@ -606,6 +756,244 @@ app.add_url_rule(
           methods=['POST']
 )
 
+class WorkerDataFactsExist(SwaggerView):
+    operationId = "facts_exist"
+
+    parameters = [
+                {
+                    'name': 'worker_id',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+                {
+                    'name': 'payload',
+                    'in': 'body',
+                    'required': True,
+                    'schema': DataFactsQuery,
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'for each dag, in order, whether its fact is known',
+                    'schema': DataFactsExistence,
+                 },
+            400: {
+                    'description': 'provided data insufficient',
+                 }
+            }
+
+    def post(self):
+        worker_id = request.args.get('worker_id')
+
+        try:
+            dags = [json.loads(dag_json) for dag_json in request.json['dags_json']]
+        except (KeyError, TypeError, ValueError) as e:
+            return Response(
+                        f"insufficient data: {e}",
+                        status=400,
+                    )
+
+        buckets = [facts.fact_bucket(dag) for dag in dags]
+
+        # only the index: facts asserted before it existed are found by /data/consult, or after indexing the datalake
+        known = facts.known.known(buckets)
+
+        logger.info("worker %s probing %s facts, %s known", worker_id, len(buckets), sum(known.values()))
+
+        return jsonify(
+                    exists=[known[b] for b in buckets],
+               )
+
+
+app.add_url_rule(
+         '/data/exists',
+          view_func=WorkerDataFactsExist.as_view('data_facts_exist'),
+          methods=['POST']
+)
+
+class WorkerDataConsultFacts(SwaggerView):
+    operationId = "consult_facts"
+
+    produces = ['application/x-ndjson']
+
+    parameters = [
+                {
+                    'name': 'worker_id',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+                {
+                    'name': 'payload',
+                    'in': 'body',
+                    'required': True,
+                    'schema': DataFactsQuery,
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'one JSON line per dag, as facts are restored: index of the dag, found, dag_json and data_json if found',
+                 },
+            400: {
+                    'description': 'provided data insufficient',
+                 }
+            }
+
+    def post(self):
+        worker_id = request.args.get('worker_id')
+
+        try:
+            dags = [json.loads(dag_json) for dag_json in request.json['dags_json']]
+        except (KeyError, TypeError, ValueError) as e:
+            return Response(
+                        f"insufficient data: {e}",
+                        status=400,
+                    )
+
+        logger.info("worker %s consulting %s facts", worker_id, len(dags))
+
+        # index is checked here, in the request: facts are restored while the response is streamed
+        answers = facts.consult_many(dags)
+
+        def lines():
+            for answer in answers:
+                yield json.dumps(answer) + "\n"
+
+        return Response(lines(), mimetype='application/x-ndjson')
+
+
+app.add_url_rule(
+         '/data/consult_many',
+          view_func=WorkerDataConsultFacts.as_view('data_consult_facts'),
+          methods=['POST']
+)
+
+class WorkerDataAssertFactStream(SwaggerView):
+    operationId = "assert_fact_stream"
+
+    consumes = ['application/octet-stream']
+
+    parameters = [
+                {
+                    'name': 'worker_id',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+                {
+                    'name': 'dag_json',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+                {
+                    'name': 'payload',
+                    'in': 'body',
+                    'required': True,
+                    'schema': {'type': 'string', 'format': 'binary'},
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'stored',
+                    'schema': DataFactStreamReport,
+                 },
+            400: {
+                    'description': 'provided data insufficient',
+                 }
+            }
+
+    def post(self):
+        worker_id = request.args.get('worker_id')
+
+        try:
+            dag = json.loads(request.args['dag_json'])
+        except (KeyError, ValueError) as e:
+            return Response(
+                        f"insufficient data: {e}",
+                        status=400,
+                    )
+
+        logger.info("worker %s streaming raw fact of dag %s", worker_id, len(dag))
+
+        # body is read as it arrives, possibly chunked: never whole in memory
+        report = facts.store_stream(dag, request.stream)
+
+        return jsonify(report)
+
+
+app.add_url_rule(
+         '/data/assert/stream',
+          view_func=auth.login_required(WorkerDataAssertFactStream.as_view('data_assert_fact_stream')),
+          methods=['POST']
+)
+
+class WorkerDataConsultFactStream(SwaggerView):
+    operationId = "consult_fact_stream"
+
+    produces = ['application/octet-stream']
+
+    parameters = [
+                {
+                    'name': 'worker_id',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+                {
+                    'name': 'dag_json',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'raw fact data',
+                 },
+            400: {
+                    'description': 'no such raw fact found',
+                 }
+            }
+
+    def get(self):
+        try:
+            dag = json.loads(request.args['dag_json'])
+        except (KeyError, ValueError) as e:
+            return Response(
+                        f"insufficient data: {e}",
+                        status=400,
+                    )
+
+        try:
+            meta, chunks = facts.open_stream(dag)
+        except facts.FactNotFound as e:
+            return Response(
+                      f"no such raw fact! bucket: {e}",
+                      status=400,
+                   )
+
+        return Response(
+                    chunks,
+                    mimetype='application/octet-stream',
+                    headers={
+                        'Content-Length': str(meta['size']),
+                        'X-Fact-Sha256': meta['sha256'],
+                    },
+               )
+
+
+app.add_url_rule(
+         '/data/consult/stream',
+          view_func=WorkerDataConsultFactStream.as_view('data_consult_fact_stream'),
+          methods=['GET']
+)
+
 class TryAllLocked(SwaggerView):
     operationId = "try_all_locked"
 
@@ -726,6 +1114,113 @@ app.add_url_rule(
           methods=['GET']
 )
 
+class MoveQueueTasks(SwaggerView):
+    operationId = "move_queue"
+
+    parameters = [
+                {
+                    'name': 'from_queue',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+                {
+                    'name': 'to_queue',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'number of tasks moved',
+                    'schema': MovedTasks,
+                },
+        }
+
+    def get(self):
+        queue = dqueue.core.Queue()
+
+        r = queue.move_queue_tasks(request.args['from_queue'], request.args['to_queue'])
+
+        logger.info("moved: %s", r)
+
+        return jsonify(tasks=r)
+
+
+app.add_url_rule(
+          '/tasks/move_queue',
+          view_func=MoveQueueTasks.as_view('move_queue_tasks'),
+          methods=['GET']
+)
+
+archive_max_batches = int(os.environ.get('DQUEUE_ARCHIVE_API_MAX_BATCHES', '10'))
+archive_max_batch_size = int(os.environ.get('DQUEUE_ARCHIVE_API_MAX_BATCH_SIZE', '10000'))
+
+class ArchiveTasks(SwaggerView):
+    operationId = "archive"
+
+    parameters = [
+                {
+                    'name': 'older_than_days',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'number',
+                },
+                {
+                    'name': 'batch_size',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'integer',
+                },
+                {
+                    'name': 'max_batches',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'integer',
+                    'description': f'at most {archive_max_batches}: the rest is left to the next request',
+                },
+                {
+                    'name': 'queue',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'string',
+                    'description': 'only tasks of this queue; tasks of all queues if not set',
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'archived',
+                },
+        }
+
+    def get(self):
+        queue_name = request.args.get('queue', None)
+        queue = dqueue.core.Queue(queue_name or 'default')
+
+        # the request is served while archiving: batches are limited, so it does not hold a worker for long
+        max_batches = request.args.get('max_batches', archive_max_batches, type=int)
+
+        r = queue.archive_tasks(
+                    older_than_days=request.args.get('older_than_days', None, type=float),
+                    batch_size=min(request.args.get('batch_size', 1000, type=int), archive_max_batch_size),
+                    max_batches=max(0, min(max_batches, archive_max_batches)),
+                    only_this_queue=queue_name is not None,
+                )
+
+        logger.info("archived: %s", r)
+
+        return jsonify(tasks=r)
+
+
+app.add_url_rule(
+          '/tasks/archive',
+          view_func=ArchiveTasks.as_view('archive_tasks'),
+          methods=['GET']
+)
+
 class ViewLogView(SwaggerView):
     operationId = "view"
 
@@ -827,6 +1322,235 @@ app.add_url_rule(
       methods=['GET']
 )
 
+class RollupView(SwaggerView):
+    operationId = "rollup"
+
+    parameters = [
+                {
+                    'name': 'period',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'string',
+                    'enum': ['minute', 'hour'],
+                },
+                {
+                    'name': 'since_hours',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'number',
+                },
+                {
+                    'name': 'group_by',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'string',
+                    'description': 'comma-separated, some of queue, worker_id, factory_name',
+                },
+                {
+                    'name': 'queue',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'string',
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'event counts and spent_s aggregates per time bucket and group',
+                    'schema': Rollup,
+                }
+        }
+
+    def get(self):
+        queue_name = request.args.get('queue', None)
+
+        queue = dqueue.core.Queue(queue_name or 'default')
+
+        r = queue.get_rollup(period=request.args.get('period', 'minute'),
+                             since_hours=request.args.get('since_hours', 1, type=float),
+                             group_by=[g for g in request.args.get('group_by', 'queue').split(",") if g != ""],
+                             only_this_queue=queue_name is not None)
+
+        return jsonify(buckets=r)
+
+app.add_url_rule(
+     '/metrics/rollup',
+      view_func=RollupView.as_view('metrics_rollup'),
+      methods=['GET']
+)
+
+class RollupUpdate(SwaggerView):
+    operationId = "rollup_update"
+
+    parameters = [
+                {
+                    'name': 'max_batches',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'integer',
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'events added to the rollup',
+                    'schema': RollupUpdateReport,
+                }
+        }
+
+    def get(self):
+        queue = dqueue.core.Queue()
+
+        r = queue.rollup_event_log(max_batches=request.args.get('max_batches', None, type=int))
+
+        return jsonify(r)
+
+app.add_url_rule(
+     '/metrics/rollup/update',
+      view_func=RollupUpdate.as_view('metrics_rollup_update'),
+      methods=['GET']
+)
+
+class QueryTraceView(SwaggerView):
+    operationId = "query_trace"
+
+    parameters = [
+                {
+                    'name': 'n',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'integer',
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'database statements of the serving process, by total time, and the slowest executions',
+                    'schema': QueryTraceReport,
+                }
+        }
+
+    def get(self):
+        return jsonify(tracing.report(request.args.get('n', None, type=int)))
+
+app.add_url_rule(
+     '/metrics/queries',
+      view_func=auth.login_required(QueryTraceView.as_view('metrics_queries')),
+      methods=['GET']
+)
+
+class LogRetention(SwaggerView):
+    operationId = "retention"
+
+    parameters = [
+                {
+                    'name': 'max_chunks',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'integer',
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'deleted events and deletion throughput, per retention policy',
+                    'schema': RetentionReport,
+                }
+        }
+
+    def get(self):
+        queue = dqueue.core.Queue()
+
+        r = queue.apply_event_log_retention(max_chunks=request.args.get('max_chunks', None, type=int))
+
+        logger.info("log retention api clears %d entries in %.3g s", r['deleted'], r['elapsed_s'])
+
+        return jsonify(r)
+
+app.add_url_rule(
+     '/log/retention',
+      view_func=LogRetention.as_view('log_retention'),
+      methods=['GET']
+)
+
+class ProfileList(SwaggerView):
+    operationId = "list_profiles"
+
+    responses = {
+            200: {
+                    'description': 'stored profiles of requests and guardian passes, newest first',
+                    'schema': {'type': 'array', 'items': ProfileSummary},
+                }
+        }
+
+    def get(self):
+        return jsonify(profiling.list_profiles())
+
+app.add_url_rule(
+     '/profiles/list',
+      view_func=auth.login_required(ProfileList.as_view('profiles_list')),
+      methods=['GET']
+)
+
+class ProfileView(SwaggerView):
+    operationId = "get_profile"
+
+    produces = ['application/json', 'text/plain', 'application/octet-stream']
+
+    parameters = [
+                {
+                    'name': 'profile_id',
+                    'in': 'query',
+                    'required': True,
+                    'type': 'string',
+                },
+                {
+                    'name': 'format',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'string',
+                    'enum': ['summary', 'text', 'pstats'],
+                    'default': 'summary',
+                },
+                {
+                    'name': 'sort',
+                    'in': 'query',
+                    'required': False,
+                    'type': 'string',
+                    'default': 'cumulative',
+                },
+            ]
+
+    responses = {
+            200: {
+                    'description': 'summary with DB query timings, pstats report as text, or pstats dump to load with pstats.Stats',
+                },
+            400: {
+                    'description': 'no such profile',
+                },
+        }
+
+    def get(self):
+        profile_id = request.args.get('profile_id', '')
+        format = request.args.get('format', 'summary')
+
+        try:
+            if format == 'text':
+                return Response(profiling.stats_text(profile_id, sort=request.args.get('sort', 'cumulative')), mimetype='text/plain')
+            elif format == 'pstats':
+                with open(profiling.profile_path(profile_id, ".prof"), "rb") as f:
+                    return Response(f.read(), mimetype='application/octet-stream')
+            else:
+                return jsonify(profiling.load_summary(profile_id))
+        except profiling.ProfileNotFound as e:
+            return Response(f"no such profile: {e}", status=400)
+
+app.add_url_rule(
+     '/profiles/get',
+      view_func=auth.login_required(ProfileView.as_view('profiles_get')),
+      methods=['GET']
+)
+
 class TaskLogView(SwaggerView):
     operationId = "logTask"
 
@@ -989,13 +1713,14 @@ class WorkerQuestion(SwaggerView):
         worker_id = request.args.get('worker_id')
         task_data = request.json['task_data']
         submission_data = request.json['submission_data']
+        priority = request.json.get('priority', 0)
 
         queue = dqueue.core.Queue(worker_id=worker_id, queue=queue)
 
         print("got:", worker_id, task_data)
 
         try:
-            task_entry = queue.put(task_data, submission_data=submission_data)
+            task_entry = queue.put(task_data, submission_data=submission_data, priority=priority)
             logger.warning("questioned task: %s", task_entry)
             return jsonify(
                         task_entry
@@ -15,7 +15,7 @@ from flask_httpauth import HTTPTokenAuth
 
 
 from flask import Flask
-from flask import render_template,make_response,request,jsonify
+from flask import render_template,make_response,request,jsonify,Response
 
 import dqueue.core as core
 import dqueue.tools as tools
@@ -24,6 +24,7 @@ from dqueue.core import model_to_dict
 
 import dqueue.api
 import dqueue.database
+import dqueue.metrics
 
 logger = logging.getLogger(__name__)
 
@@ -86,8 +87,10 @@ class ReverseProxied(object):
 app.wsgi_app = ReverseProxied(app.wsgi_app)# type: ignore
 
 ## stats
+import sqlalchemy
 from flask_sqlalchemy import SQLAlchemy
 from flask_statistics import Statistics
+from dqueue.requeststats import RequestSampler, WeightedStatisticsQueries
 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:////tmp/database.db"
 
@@ -111,6 +114,8 @@ class Request(request_db.Model):
     browser = request_db.Column(request_db.String(1000))
     platform = request_db.Column(request_db.String(1000))
     mimetype = request_db.Column(request_db.String(1000))
+    # requests this row stands for: 1/sample_rate of the sampler which recorded it
+    weight = request_db.Column(request_db.Float, nullable=False, default=1., server_default="1")
 
 try: 
     db.create_all()
@@ -122,7 +127,22 @@ try:
 except:
     pass
 
-statistics = Statistics(app, request_db, Request)
+# tables created before rows were weighted
+try:
+    with app.app_context():
+        if "weight" not in [c['name'] for c in sqlalchemy.inspect(request_db.engine).get_columns("request")]:
+            with request_db.engine.begin() as connection:
+                connection.execute(sqlalchemy.text("ALTER TABLE request ADD COLUMN weight FLOAT NOT NULL DEFAULT 1"))
+except Exception as e:
+    logger.warning("unable to add weight column to request statistics: %s", e)
+
+# flask_statistics writes each request synchronously: it only serves the view, requests are recorded by the sampler
+statistics = Statistics(app, request_db, Request, disable_f=lambda: True)
+statistics.api = WeightedStatisticsQueries(request_db, Request)
+request_sampler = RequestSampler(app, request_db, Request)
+
+import dqueue.profiling
+dqueue.profiling.install(app)
 
 
 @app.before_request
@@ -130,22 +150,21 @@ def before_request():
     if app.debug:
         print(request.method, request.endpoint, request.headers)
         
-    if dqueue.database.db is None:
-        dqueue.database.db = dqueue.database.connect_db()
-
     try:
-        dqueue.database.db.connect()
-        logger.debug("connecting to db before request %s", dqueue.database.db)
+        dqueue.database.checkout_connection()
+        logger.debug("checked out db connection for request %s", dqueue.database.db)
     except Exception as e:
         logger.warning("db access error: %s", e)
 
 
-@app.after_request
-def after_request(response):
-    if dqueue.database.db is not None:
-        dqueue.database.db.close()
-        logger.debug("disconnecting from the db after request %s", dqueue.database.db)
-    return response
+@app.teardown_request
+def teardown_request(exception=None):
+    # also after failed requests: the connection always goes back to the pool
+    try:
+        dqueue.database.release_connection()
+        logger.debug("released db connection after request %s", dqueue.database.db)
+    except Exception as e:
+        logger.warning("db release error: %s", e)
 
 
 @app.errorhandler(peewee.OperationalError)
@@ -159,6 +178,11 @@ def stats():
     return render_template('task_stats.html', bystate=dqueue.tools.stats())
 
 
+@app.route('/metrics')
+def metrics():
+    return Response(dqueue.metrics.registry.exposition(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/purge')
 def purge():
     nentries=core.TaskEntry.delete().execute(database=None)
@@ -0,0 +1,176 @@
+"""
+content-addressed store for large task payloads, kept out of TaskEntry rows
+
+payloads are stored under the sha256 of their canonical JSON, so identical payloads of different tasks are stored once;
+TaskEntry keeps only the hash and the size. Blobs are never deleted here: they may be shared between tasks.
+"""
+
+import os
+import io
+import hashlib
+import tempfile
+import logging
+
+from typing import Union, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# where blobs are stored: a directory (or file:///directory), or s3://endpoint/bucket; empty keeps all payloads in the rows
+blob_store_url = os.environ.get('DQUEUE_BLOB_STORE', '')
+
+# smaller payloads stay in the rows: a blob costs an extra round trip
+blob_min_size = int(os.environ.get('DQUEUE_BLOB_MIN_SIZE', '16384'))
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class LocalBlobStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def __repr__(self):
+        return f"[{self.__class__.__name__}: {self.directory}]"
+
+    def path(self, sha: str) -> str:
+        return os.path.join(self.directory, sha[:2], sha)
+
+    def exists(self, sha: str) -> bool:
+        return os.path.exists(self.path(sha))
+
+    def put(self, sha: str, data: bytes):
+        fn = self.path(sha)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+        # complete file or nothing: concurrent writers of the same blob write the same content
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_fn, fn)
+
+    def get(self, sha: str) -> bytes:
+        try:
+            with open(self.path(sha), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise BlobNotFound(sha)
+
+
+class S3BlobStore:
+    "any S3-compatible service, e.g. minio"
+
+    def __init__(self, endpoint: str, bucket: str, secure: bool=True):
+        import minio # type: ignore
+
+        self.endpoint = endpoint
+        self.bucket = bucket
+        self.client = minio.Minio(endpoint,
+                                  access_key=os.environ.get('DQUEUE_BLOB_S3_ACCESS_KEY'),
+                                  secret_key=os.environ.get('DQUEUE_BLOB_S3_SECRET_KEY'),
+                                  secure=secure)
+
+        if not self.client.bucket_exists(bucket):
+            self.client.make_bucket(bucket)
+
+    def __repr__(self):
+        return f"[{self.__class__.__name__}: {self.endpoint}/{self.bucket}]"
+
+    def exists(self, sha: str) -> bool:
+        try:
+            self.client.stat_object(self.bucket, sha)
+            return True
+        except Exception as e:
+            logger.debug("blob %s not found in %s: %s", sha, self, e)
+            return False
+
+    def put(self, sha: str, data: bytes):
+        self.client.put_object(self.bucket, sha, io.BytesIO(data), len(data), content_type="application/json")
+
+    def get(self, sha: str) -> bytes:
+        try:
+            r = self.client.get_object(self.bucket, sha)
+        except Exception as e:
+            raise BlobNotFound(sha, e)
+
+        try:
+            return r.read()
+        finally:
+            r.close()
+            r.release_conn()
+
+
+def open_store(url: str):
+    u = urlparse(url)
+
+    if u.scheme in ("s3", "s3+http"):
+        return S3BlobStore(u.netloc, u.path.strip("/"), secure=(u.scheme == "s3"))
+    elif u.scheme in ("", "file"):
+        return LocalBlobStore(u.path)
+    else:
+        raise RuntimeError(f"unknown blob store {url}; expecting a directory, file:///directory or s3://endpoint/bucket")
+
+
+_store = None
+
+
+def get_store():
+    global _store
+
+    if _store is None and blob_store_url != '':
+        _store = open_store(blob_store_url)
+        logger.info("using blob store %s", _store)
+
+    return _store
+
+
+def put(data: str) -> Union[Tuple[str, int], None]:
+    """
+    stores payload if it is worth it, returns its hash and size; None means the payload should stay in the row
+    """
+
+    store = get_store()
+
+    if store is None or len(data) < blob_min_size:
+        return None
+
+    b = data.encode()
+    sha = blob_hash(b)
+
+    if not store.exists(sha):
+        store.put(sha, b)
+    else:
+        logger.debug("blob %s already stored", sha)
+
+    return sha, len(b)
+
+
+def get(sha: str) -> str:
+    store = get_store()
+
+    if store is None:
+        raise BlobNotFound(sha, "no blob store configured: set DQUEUE_BLOB_STORE")
+
+    b = store.get(sha)
+
+    if blob_hash(b) != sha:
+        raise BlobNotFound(sha, "stored blob does not match its hash")
+
+    return b.decode()
+
+
+def inline_entry(entry: dict) -> dict:
+    "replaces references to blobs in a TaskEntry dict with the payloads, as if they were stored in the row"
+
+    if entry.get('task_dict_blob') is not None:
+        entry['task_dict_string'] = get(entry['task_dict_blob'])
+
+    if entry.get('execution_info_blob') is not None:
+        entry['execution_info'] = get(entry['execution_info_blob'])
+
+    return entry
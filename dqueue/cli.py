@@ -14,23 +14,21 @@ import datetime
 import random
 import socket
 from termcolor import colored
-from collections import defaultdict
-import pylogstash
 
 from dqueue import from_uri
 from dqueue.core import Queue, Task
 from dqueue.proxy import QueueProxy
 
 import dqueue.core as core 
+import dqueue.profiling as profiling
+import dqueue.logshipping as logshipping
 
 import coloredlogs
 
 logger = logging.getLogger()
 
-try:
-    log_stasher = pylogstash.LogStasher(sep="/")
-except Exception as e:
-    log_stasher = pylogstash.LogStasher()
+# sent by a background thread: a slow logstash does not delay offers
+log_stasher = logshipping.AsyncLogStasher(sep="/")
 
 @click.group()
 @click.option("-q", "--quiet", default=False, is_flag=True)
@@ -202,6 +200,39 @@ def viewtask(obj, key, follow):
 def logcli():
     pass
 
+def merge_rollup(buckets, group: str) -> dict:
+    "rollup buckets merged over time, by group"
+
+    merged = {} # type: dict
+    for b in buckets:
+        m = merged.setdefault(b[group], dict(n_events=0, n_started=0, n_done=0, n_failed=0, last_active=None))
+        for f in "n_events", "n_started", "n_done", "n_failed":
+            m[f] += b[f]
+        if b['last_active'] is not None and (m['last_active'] is None or b['last_active'] > m['last_active']):
+            m['last_active'] = b['last_active']
+    return merged
+
+
+def log_rollup_info(queue, window):
+    "per-queue and per-worker activity over the window, from the rollup: counted as of the last rollup run"
+
+    since_hours = window / 3600.
+
+    for q, m in sorted(merge_rollup(queue.get_rollup(period="minute", since_hours=since_hours, group_by=["queue"]), "queue").items()):
+        print(f"\033[37m{q:>20s}: started {m['n_started']:4d} done {m['n_done']:4d} failed {m['n_failed']:4d} events {m['n_events']:5d}\033[0m")
+
+    workers = merge_rollup(queue.get_rollup(period="minute", since_hours=since_hours, group_by=["worker_id"]), "worker_id")
+    recent_workers = [k for k in workers if not k.startswith('oda-dqueue-')]
+    print(f"\033[1;31m{len(recent_workers):>5d} recent workers:\033[0m \033[1;35m{', '.join(recent_workers)}\033[0m")
+
+    now = datetime.datetime.now()
+    for k in recent_workers:
+        v = workers[k]
+        ago = (now - datetime.datetime.fromisoformat(v['last_active'])).total_seconds() if v['last_active'] is not None else float('nan')
+        print(f"\033[37m- {ago:4.0f}s ago {k[:30]:30}" +
+              f" {v['n_done']:3d} / {v['n_events']:4d}\033[0m")
+
+
 @logcli.command()
 @click.pass_obj
 @click.option("--follow", "-f", is_flag=True, default=False)
@@ -216,8 +247,6 @@ def view(obj, follow, since=0, window=60):
 
     task_info_cache={}
 
-    active_workers = defaultdict(dict)
-
     while True:
         new_messages = obj['queue'].view_log(since=since)['event_log']
 
@@ -262,15 +291,6 @@ def view(obj, follow, since=0, window=60):
                     name=name,
                     **l))
 
-            w = active_workers[l['worker_id']]
-            w['last_active_timestamp'] = l["timestamp_seconds"]
-            if l['message'] == "task done":
-                w['stats_done'] = w.get('stats_done', 0) + 1
-            w['stats_all'] = w.get('stats_all', 0) + 1
-            w['last_message'] = l['message']
-            w['last_name'] = name
-            w['last_task_key'] = l['task_key']
-
             logger.debug(l)
             
 
@@ -295,18 +315,7 @@ def view(obj, follow, since=0, window=60):
         if time.time() - last_info_time > 5:
 
             log_info(obj['queue'])
-
-            recent_workers = [k for k, v in active_workers.items() if
-                                    v['last_active_timestamp']>time.mktime(time.gmtime())-window and not k.startswith('oda-dqueue-')]
-            print(f"\033[1;31m{len(recent_workers):>5d} recent workers:\033[0m \033[1;35m{', '.join(recent_workers)}\033[0m")
-
-            for k,v in active_workers.items():
-                if k.startswith('oda-dqueue-'): continue
-                if not v['last_active_timestamp']>time.mktime(time.gmtime())-window: continue
-
-                print(f"\033[37m- {time.mktime(time.gmtime())-v['last_active_timestamp']:4.0f}s ago {k[:30]:30}" + 
-                      f" {v.get('stats_done', 0):3d} / {v.get('stats_all', 0):4d}" +
-                      f" {v['last_message']:40s} {v['last_name']:20s} {v['last_task_key']:10s}\033[0m")
+            log_rollup_info(obj['queue'], window)
 
             last_info_time = time.time()
 
@@ -325,6 +334,21 @@ def clear(obj, before, kind):
 
 ###
 
+@logcli.command()
+@click.pass_obj
+@click.option("--period", "-p", default="minute", type=click.Choice(["minute", "hour"]))
+@click.option("--since-hours", "-s", default=1., type=float)
+@click.option("--group-by", "-g", default="worker_id,factory_name")
+def rollup(obj, period, since_hours, group_by):
+    buckets = obj['queue'].get_rollup(period=period, since_hours=since_hours, group_by=group_by.split(","))
+
+    for b in buckets:
+        group = " ".join(f"{b[g]:30s}" for g in group_by.split(","))
+        p50 = f"{b['spent_s_p50']:8.3g}" if b['spent_s_p50'] is not None else f"{'-':>8s}"
+        print(f"{b['bucket']} {group} " + 
+              colored(f"started {b['n_started']:4d} done {b['n_done']:4d} failed {b['n_failed']:4d}", "cyan") +
+              f" events {b['n_events']:5d} spent_s p50 {p50}")
+
 @cli.group("data")
 def datacli():
     pass
@@ -362,13 +386,30 @@ def consult(obj, dag, output):
 def list_facts(obj):
     pass
 
+@datacli.command("index")
+def index_facts():
+    "index fact buckets of the datalake, for existence checks; on the server"
+    import dqueue.facts as facts
+
+    print("indexed", facts.index_datalake(), "fact buckets")
+
 ###
 
+@cli.command()
+@click.argument("from_queue")
+@click.argument("to_queue")
+@click.pass_obj
+def move_queue(obj, from_queue, to_queue):
+    n = obj['queue'].move_queue_tasks(from_queue, to_queue)
+    print(colored("moved:", "green"), n)
+
 @cli.command()
 @click.option('-w', '--watch', default=None, type=int)
 @click.pass_obj
 def guardian(obj, watch):
     while True:
+        profile = profiling.start("guardian")
+
         #expre
         print("exiure some tasks")
         r = obj['queue'].expire_tasks()
@@ -384,10 +425,17 @@ def guardian(obj, watch):
         task_data=obj['queue'].forgive_task_failures()
         print(colored("forgiven:", "green"), task_data)
         
+        print("archiving old tasks")
+        r = obj['queue'].archive_tasks(max_batches=10)
+        print(colored("archived:", "green"), r)
+
+        # aggregate events before they are cleared
+        r = obj['queue'].rollup_event_log(max_batches=10)
+        print(f"rolled up {r['events']} events")
+
         #clear event log 
-        N = obj['queue'].clear_event_log(leave_last=100)
-        #N = obj['queue'].clear_event_log(only_older_than_days=2./24.)
-        print(f"cleared event log of {N} entries")
+        r = obj['queue'].apply_event_log_retention(max_chunks=100)
+        print(f"cleared event log of {r['deleted']} entries in {r['elapsed_s']:.3g} s, {r['rows_per_s']:.0f} rows/s")
 
         # stats
 
@@ -418,6 +466,8 @@ def guardian(obj, watch):
                         } 
                     )
 
+        profiling.finish(profile)
+
         print("sleeping", watch)
 
         if not watch:
@@ -434,10 +484,11 @@ def get(obj, only_users):
 
 @cli.command()
 @click.argument("task_data")
+@click.option("-p", "--priority", default=0, type=int)
 @click.pass_obj
-def question(obj, task_data):
+def question(obj, task_data, priority):
     j_task_data=json.loads(task_data)
-    r = obj['queue'].put(j_task_data)
+    r = obj['queue'].put(j_task_data, priority=priority)
     print(colored("questioned:", "green"), task_data, ":", r)
 
 @cli.command()
@@ -626,8 +677,9 @@ def execute(obj):
 @click.argument("target")
 @click.option("-m", "--module", multiple=True)
 @click.option("-a", "--assume", multiple=True)
+@click.option("-p", "--priority", default=0, type=int)
 @click.pass_obj
-def ask(obj, target, module, assume):
+def ask(obj, target, module, assume, priority):
     task_data = dict(
                 object_identity=dict(
                     assumptions=[
@@ -649,6 +701,7 @@ def ask(obj, target, module, assume):
                 callbacks=[],
                 request_origin="cli",
                 ),
+            priority=priority,
             )
 
     #print("odahub responds", r)
@@ -30,20 +30,63 @@ from typing import NewType, Dict, Union, List
 
 import dqueue.dqtyping as dqtyping
 from dqueue.entry import decode_entry_data
+import dqueue.retention as retention
+import dqueue.rollup as rollup
+import dqueue.metrics as metrics
+import dqueue.tracing as tracing
+import dqueue.extralogging as extralogging
+import dqueue.logshipping as logshipping
+from dqueue.extralogging import Lazy
+import dqueue.database as database
+import dqueue.blobstore as blobstore
 
 import pymysql
 import peewee # type: ignore
 
-from dqueue.database import EventLog, TaskEntry, TaskProperties, TaskWorkerKnowledge, db, model_to_dict, CallbackQueue
+from dqueue.database import EventLog, TaskEntry, ArchivedTaskEntry, TaskProperties, TaskWorkerKnowledge, UserShare, RunningCounter, db, model_to_dict, CallbackQueue, query_hooks
 from peewee import JOIN, fn
 
+if metrics.metrics_enabled:
+    query_hooks.append(metrics.observe_query)
+
+if tracing.tracing_enabled:
+    query_hooks.append(tracing.trace_query)
+
 sleep_multiplier = 1
-n_failed_retries = int(os.environ.get('DQUEUE_FAILED_N_RETRY','20'))
+n_failed_retries = database.n_failed_retries
 
-try:
-    log_stasher = pylogstash.LogStasher(sep="/")
-except Exception as e:
-    log_stasher = pylogstash.LogStasher()
+# retries of failed tasks are delayed exponentially: base, 2*base, 4*base... up to max
+retry_backoff_s = float(os.environ.get('DQUEUE_RETRY_BACKOFF_S', '5'))
+retry_backoff_max_s = float(os.environ.get('DQUEUE_RETRY_BACKOFF_MAX_S', '3600'))
+
+# state transitions failing on db errors are retried after reconnecting, with delays doubling up to this
+move_retry_max_delay_s = float(os.environ.get('DQUEUE_MOVE_RETRY_MAX_DELAY_S', '30'))
+
+
+def retry_not_before(n_times_failed: int) -> datetime.datetime:
+    delay_s = min(retry_backoff_max_s, retry_backoff_s * 2**max(0, min(n_times_failed - 1, 30))) * sleep_multiplier
+    return datetime.datetime.now() + datetime.timedelta(seconds=delay_s)
+
+def without_failure_count(extra: dict) -> dict:
+    extra = dict(extra)
+    extra.pop(TaskEntry.n_failed, None)
+    extra.pop(TaskEntry.not_before, None)
+    return extra
+
+# offers go round-robin between users submitting to the queue, within the same priority
+fair_share = os.environ.get('DQUEUE_FAIR_SHARE', 'yes') == 'yes'
+
+# maximum number of tasks reserved or running at the same time, in one queue and for one user; 0 is unlimited
+max_running_per_queue = int(os.environ.get('DQUEUE_MAX_RUNNING_PER_QUEUE', '0'))
+max_running_per_user = int(os.environ.get('DQUEUE_MAX_RUNNING_PER_USER', '0'))
+
+occupying_states = ["reserved", "running"]
+
+# done and failed tasks older than this are moved to the archive table; 0 disables archiving
+archive_after_days = float(os.environ.get('DQUEUE_ARCHIVE_AFTER_DAYS', '30'))
+
+# sent by a background thread: a slow logstash does not delay offers
+log_stasher = logshipping.AsyncLogStasher(sep="/")
 
 def get_logger(name):
     level = getattr(logging, os.environ.get('DQUEUE_LOG_LEVEL', 'INFO'))
@@ -63,9 +106,18 @@ def get_logger(name):
 
 logger = get_logger(__name__)
 
+# per-offer and per-event detail: its level can be raised on its own, e.g. to WARNING while the rest logs INFO
+hot_logger = logging.getLogger(__name__ + ".hot")
+if os.environ.get('DQUEUE_HOT_PATH_LOG_LEVEL', '') != '':
+    hot_logger.setLevel(getattr(logging, os.environ['DQUEUE_HOT_PATH_LOG_LEVEL']))
+
+rate_limited = extralogging.RateLimited(hot_logger)
+
 def log(*args,**kwargs):
-    severity=kwargs.get('severity','warning').upper()
-    logger.log(getattr(logging,severity)," ".join([repr(arg) for arg in list(args)+list(kwargs.items())]))
+    severity=getattr(logging, kwargs.get('severity','warning').upper())
+    # arguments are often tasks and entries: not formatted unless emitted
+    if hot_logger.isEnabledFor(severity):
+        hot_logger.log(severity," ".join([repr(arg) for arg in list(args)+list(kwargs.items())]))
 
 
 class Empty(Exception):
@@ -120,6 +172,29 @@ class Task:
             return 0
         return self.execution_info.get('n_times_failed', 0)
  
+    @property
+    def user_email(self) -> str:
+        "submitter of the task, as far as it can be recovered from the submission info"
+
+        if self.submission_info.get('user_email') is not None:
+            return self.submission_info['user_email']
+
+        try:
+            callback = self.submission_info['callbacks'][0]
+            user_job_token = parse_qs(callback.split("?",1)[1])['token'][0]
+            token_payload = user_job_token.split(".")[1]
+            return json.loads(base64.b64decode(token_payload + "=" * (-len(token_payload) % 4)))['sub']
+        except Exception as e:
+            logger.debug("unable to find user in submission info: %s", e)
+            return "anonymous"
+
+    @property
+    def factory_name(self) -> str:
+        try:
+            return self.task_data['object_identity']['factory_name']
+        except (KeyError, TypeError):
+            return "unknown"
+
     def note_failure(self):
         if self.execution_info is None:
             logger.warning("no execution info: not noting failure")
@@ -166,7 +241,7 @@ class Task:
             raise RuntimeError(f"failed to build Task from entry {entry}")
 
 
-        print(task_dict['task_data'].keys())
+        logger.debug("task data keys: %s", Lazy(lambda: list(task_dict['task_data'].keys())))
 
         self=cls(task_dict['task_data'])
         self.depends_on=task_dict.get('depends_on', [])
@@ -175,12 +250,34 @@ class Task:
 
         return self
 
+    @classmethod
+    def from_entry(cls, entry):
+        "task from TaskEntry, or its dict: the task as put, with execution info and dependencies stored with the state"
+
+        if not isinstance(entry, dict):
+            entry = model_to_dict(entry)
+
+        entry = blobstore.inline_entry(dict(entry))
+
+        self = cls.from_task_dict(entry['task_dict_string'])
+
+        if entry.get('execution_info') is not None:
+            self.execution_info = json.loads(entry['execution_info'])
+
+        if entry.get('depends_on') is not None:
+            self.depends_on = json.loads(entry['depends_on'])
+
+        return self
+
         
 
 
     @property
     def key(self):
-        return self.get_key(True)
+        # hashed once: the key is used in most log lines about the task, and task data is not changed once the task is made
+        if getattr(self, '_computed_key', None) is None:
+            self._computed_key = self.get_key(True)
+        return self._computed_key
 
     def get_key(self,key=True):
         if hasattr(self, '_key'):
@@ -243,12 +340,12 @@ class Task:
                     pt = l['key']
                     s = l['value']
 
-                    logger.info("scoring worker knowledge: %s %s %s, current score %s", op, pt, s, entry_score)
+                    hot_logger.debug("scoring worker knowledge: %s %s %s, current score %s", op, pt, s, entry_score)
                 
                     s_d = json.loads(
                                 json.dumps(reduce(lambda D,x:D[x], pt, self.task_data)).replace('null', '"None"')
                             )
-                    logger.info("scoring on task data selection %s", s_d)
+                    hot_logger.debug("scoring on task data selection %s", s_d)
 
                     if op == "any-of":
                         if s in s_d:
@@ -259,10 +356,10 @@ class Task:
                     else:
                         raise RuntimeError(f"unknown operation {op} in score_worker_knowledge")
 
-                    logger.info("now score %s", score)
+                    hot_logger.debug("now score %s", score)
                 
                 score *= entry_score
-                logger.info("entry score %s, total score %s", entry_score, score)
+                hot_logger.debug("entry score %s, total score %s", entry_score, score)
 
                 if score <= 0:
                     break
@@ -335,10 +432,11 @@ class Queue:
         self.queue=queue
         self.current_task=None
         self.current_task_status=None
+        self.current_task_version=None
         self.logger = logging.getLogger(repr(self))
 
-    def find_task_instances(self, task: Task, klist: Union[list, None]=None) -> List[dqtyping.TaskEntry]:
-        ""
+    def find_task_instances(self, task: Task, klist: Union[list, None]=None, inline: bool=False) -> List[dqtyping.TaskEntry]:
+        "entries of the task; payloads kept in the blob store are fetched only if inline, most callers need only the state"
         log("find_task_instances for",task.key,"in",self.queue)
 
         if klist is None:
@@ -348,6 +446,14 @@ class Queue:
                 model_to_dict(task_entry) for task_entry in TaskEntry.select().where(TaskEntry.state << klist, TaskEntry.key==task.key, TaskEntry.queue==self.queue)
             ]
 
+        if len(instances_for_key) == 0:
+            instances_for_key=[
+                    model_to_dict(task_entry) for task_entry in ArchivedTaskEntry.select().where(ArchivedTaskEntry.state << klist, ArchivedTaskEntry.key==task.key, ArchivedTaskEntry.queue==self.queue)
+                ]
+
+        if inline:
+            instances_for_key = [blobstore.inline_entry(i) for i in instances_for_key]
+
         log("found task instances for",task.key,"N == ",len(instances_for_key))
         for i in instances_for_key:
             log(i['state'], str(i['task_dict_string'])[:200])
@@ -401,13 +507,18 @@ class Queue:
                          TaskEntry.key==key,
                         ).execute(database=None)
 
+        if len(r) == 0:
+            r=ArchivedTaskEntry.select().where(
+                             ArchivedTaskEntry.key==key,
+                            ).execute(database=None)
+
         if len(r) > 1:
             raise RuntimeError(f"found multiple entries for key {key}: suspecting database inconsistency!")
 
         if len(r) == 0:
             return None
 
-        r = model_to_dict(r[0])
+        r = blobstore.inline_entry(model_to_dict(r[0]))
 
         if decode:
             decode_entry_data(r)
@@ -415,8 +526,9 @@ class Queue:
         return r
 
 
-    def put(self, task_data: dqtyping.TaskData, submission_data=None, depends_on=None) -> Union[dqtyping.TaskEntry, None]:
-        logger.info("putting in queue task_data %s", task_data)
+    @metrics.timed("dqueue_put_seconds")
+    def put(self, task_data: dqtyping.TaskData, submission_data=None, depends_on=None, priority: int=0) -> Union[dqtyping.TaskEntry, None]:
+        logger.info("putting in queue task_data %s with priority %s", task_data, priority)
 
         assert depends_on is None or type(depends_on) in [list, tuple] # runtime typing!
 
@@ -456,7 +568,7 @@ class Queue:
         if instance_for_key is not None:
             log("found existing instance(s) for this key, no need to put:", instances_for_key)
             self.log_task("task already found", task,instance_for_key['state'])
-            d = instance_for_key
+            d = blobstore.inline_entry(instance_for_key)
             logger.debug("task entry: %s", d)
             return d
 
@@ -470,10 +582,10 @@ class Queue:
 
         def insert_it():
             if depends_on is None:
-                self.insert_task_entry(task, "waiting")
+                self.insert_task_entry(task, "waiting", priority=priority)
                 log("task inserted as waiting")
             else:
-                self.insert_task_entry(task, "locked")
+                self.insert_task_entry(task, "locked", priority=priority)
                 log("task inserted as locked")
         
         insert_it()
@@ -482,7 +594,7 @@ class Queue:
         for i in range(5):
             try:
                 instance_for_key = self.find_task_instances(task)[0]
-                recovered_task = Task.from_task_dict(instance_for_key['task_dict_string']) # type: ignore
+                recovered_task = Task.from_entry(instance_for_key) # type: ignore
                 break
             except Exception as e:
                 logger.warning("race condition?")
@@ -509,11 +621,143 @@ class Queue:
 
             raise Exception("Inconsistent storage")
 
-        logger.debug("successfully put in queue: %s",instance_for_key['task_dict_string'])
+        logger.debug("successfully put in queue: %s", task.key)
+
+        self.note_task_properties(task)
 
         
         instance_for_key['state'] = 'submitted'
-        return instance_for_key
+        return blobstore.inline_entry(instance_for_key)
+
+    def note_task_properties(self, task: Task):
+        TaskProperties.delete().where(TaskProperties.key == task.key).execute(database=None)
+        TaskProperties.insert(
+                        key=task.key,
+                        user_email=task.user_email,
+                        factory_name=task.factory_name,
+                    ).execute(database=None)
+
+    def note_user_claim(self, user_email: str):
+        "moves the user to the back of the round-robin"
+
+        now = datetime.datetime.now()
+
+        n = UserShare.update({
+                        UserShare.last_claimed: now,
+                    })\
+                    .where(UserShare.queue == self.queue, UserShare.user_email == user_email).execute(database=None)
+
+        if n == 0:
+            try:
+                UserShare.insert(
+                            queue=self.queue,
+                            user_email=user_email,
+                            last_claimed=now,
+                        ).execute(database=None)
+            except (pymysql.err.IntegrityError, peewee.IntegrityError) as e:
+                logger.debug("user share for %s was just created concurrently: %s", user_email, e)
+
+    def acquire_running_slot(self, scope: str, name: str, limit: int) -> bool:
+        "takes one of the limited running slots, if any is left; a counter is kept per queue and per user"
+
+        for attempt in range(2):
+            n = RunningCounter.update({
+                            RunningCounter.n_running: RunningCounter.n_running + 1,
+                        })\
+                        .where(RunningCounter.scope == scope, RunningCounter.name == name, RunningCounter.n_running < limit)\
+                        .execute(database=None)
+
+            if n > 0:
+                return True
+
+            if attempt == 0:
+                try:
+                    with db.atomic():
+                        RunningCounter.insert(scope=scope, name=name, n_running=0).execute(database=None)
+                except (pymysql.err.IntegrityError, peewee.IntegrityError):
+                    # counter exists, so it is at the limit
+                    return False
+
+        return False
+
+    def release_running_slots(self, key: str):
+        if max_running_per_queue <= 0 and max_running_per_user <= 0:
+            return
+
+        r = TaskEntry.select(TaskEntry.queue, fn.COALESCE(TaskProperties.user_email, "anonymous").alias('user_email'))\
+                     .join(TaskProperties, JOIN.LEFT_OUTER, on=(TaskEntry.key == TaskProperties.key))\
+                     .where(TaskEntry.key == key)\
+                     .execute(database=None)
+
+        if len(r) == 0:
+            return
+
+        for scope, name in ("queue", r[0].queue), ("user", r[0].user_email):
+            RunningCounter.update({
+                            RunningCounter.n_running: RunningCounter.n_running - 1,
+                        })\
+                        .where(RunningCounter.scope == scope, RunningCounter.name == name, RunningCounter.n_running > 0)\
+                        .execute(database=None)
+
+    def transition(self, key: str, from_states: List[str], to_state: str, expected_version=None, expected_worker_id=None, extra=None) -> bool:
+        """
+        conditional state change: applies only if the task is in one of from_states,
+        and, if expected, still at the version and with the worker seen when it was claimed; returns if it was applied
+        """
+
+        c = (TaskEntry.key == key) & (TaskEntry.state << from_states)
+
+        if expected_version is not None:
+            c &= TaskEntry.version == expected_version
+
+        if expected_worker_id is not None:
+            c &= TaskEntry.worker_id == expected_worker_id
+
+        with db.atomic():
+            n = TaskEntry.update({
+                            TaskEntry.state: to_state,
+                            TaskEntry.modified: datetime.datetime.now(),
+                            TaskEntry.version: TaskEntry.version + 1,
+                            **(extra or {})
+                        })\
+                        .where(c)\
+                        .execute(database=None)
+
+            if n > 0 and set(from_states) <= set(occupying_states) and to_state not in occupying_states:
+                self.release_running_slots(key)
+
+        if n > 0:
+            metrics.inc("dqueue_task_transitions_total", state=to_state)
+
+        return n > 0
+
+    def leave_running(self, key: str, state: str, extra=None, expected_version=None, expected_worker_id=None) -> int:
+        "moves reserved or running task to another state, giving back its running slots"
+
+        return int(self.transition(key, occupying_states, state,
+                                   expected_version=expected_version,
+                                   expected_worker_id=expected_worker_id,
+                                   extra=extra))
+
+    def recount_running_slots(self):
+        "counters may drift when tasks are moved administratively: rebuild them from the task states"
+
+        task_user = fn.COALESCE(TaskProperties.user_email, "anonymous")
+
+        with db.atomic():
+            RunningCounter.update({RunningCounter.n_running: 0}).execute(database=None)
+
+            for scope, group in ("queue", TaskEntry.queue), ("user", task_user):
+                for r in TaskEntry.select(group.alias('name'), fn.COUNT(TaskEntry.key).alias('n'))\
+                                  .join(TaskProperties, JOIN.LEFT_OUTER, on=(TaskEntry.key == TaskProperties.key))\
+                                  .where(TaskEntry.state << occupying_states)\
+                                  .group_by(group)\
+                                  .execute(database=None):
+                    n = RunningCounter.update({RunningCounter.n_running: r.n})\
+                                      .where(RunningCounter.scope == scope, RunningCounter.name == r.name)\
+                                      .execute(database=None)
+                    if n == 0:
+                        RunningCounter.insert(scope=scope, name=r.name, n_running=r.n).execute(database=None)
 
     def note_worker_state(self, worker_state):
         logger.debug("creating new worker state record, worker %s state: %s", self.worker_id, worker_state)
@@ -554,43 +798,72 @@ class Queue:
 
         selection_condition = (
             (TaskEntry.state=="waiting") & (TaskEntry.queue==self.queue) & 
+            ( (TaskEntry.not_before.is_null()) | (TaskEntry.not_before <= datetime.datetime.now()) ) &
             ( (n_denied_knowledge.c.n_denied.is_null()) | (n_denied_knowledge.c.n_denied == 0) ))
 
 
+        task_user = fn.COALESCE(TaskProperties.user_email, "anonymous")
+
         if only_users != 'all':
             selection_condition = selection_condition & (TaskProperties.user_email == only_users)
+
+        if max_running_per_user > 0:
+            saturated_users = (RunningCounter.select(RunningCounter.name)
+                                             .where(RunningCounter.scope == "user", RunningCounter.n_running >= max_running_per_user))
+            selection_condition = selection_condition & (task_user.not_in(saturated_users))
+
+        # most urgent first; within the same priority, the user who was served the longest ago, then the oldest task
+        ordering = [TaskEntry.priority.desc()]
+        if fair_share:
+            ordering.append(UserShare.last_claimed.asc(nulls='first'))
+        ordering.append(TaskEntry.modified)
     
-        select_task = (TaskEntry.select(TaskEntry.key)
+        select_task = (TaskEntry.select(TaskEntry.key, task_user.alias('user_email'))
                                 .join(n_denied_knowledge, JOIN.LEFT_OUTER, on=predicate)
                                 .join(TaskProperties, JOIN.LEFT_OUTER, on=(TaskEntry.key == TaskProperties.key))
+                                .join(UserShare, JOIN.LEFT_OUTER, on=((UserShare.user_email == TaskProperties.user_email) & (UserShare.queue == TaskEntry.queue)))
                                 .where(selection_condition)
-                                .order_by(TaskEntry.modified)
+                                .order_by(*ordering)
                                 .offset(offset)
                                 .limit(1))
 
-        r = select_task.execute(database=None) # not atomic!?
+        # running slots are taken in the same transaction as the reservation: unless the task is reserved, they are given back
+        with db.atomic():
+            if max_running_per_queue > 0 and not self.acquire_running_slot("queue", self.queue, max_running_per_queue):
+                logger.info("%s: queue %s already has %s tasks running", call, self.queue, max_running_per_queue)
+                raise Empty()
 
-        
-        if len(r) == 0:
-            raise Empty()
+            r = select_task.execute(database=None)
+            
+            if len(r) == 0:
+                raise Empty()
 
-        logger.info("%s: pre-selected task %s task %s", call, r[0].key, model_to_dict(r[0]))
+            hot_logger.info("%s: pre-selected task %s task %s", call, r[0].key, Lazy(model_to_dict, r[0]))
 
-        # logger.info("%s: pre-selected task %s", call, r[0].key)
+            # logger.info("%s: pre-selected task %s", call, r[0].key)
 
-        pre_selected_task_key = r[0].key
+            pre_selected_task_key = r[0].key
 
-        t = TaskEntry.update({
-                        TaskEntry.state:"reserved",
-                        TaskEntry.worker_id:self.worker_id,
-                        TaskEntry.modified:datetime.datetime.now(),
-                        TaskEntry.update_expected_in_s:update_expected_in_s
-                    })\
-                    .where(TaskEntry.key == r[0].key)
+            if max_running_per_user > 0 and not self.acquire_running_slot("user", r[0].user_email, max_running_per_user):
+                logger.info("%s: user %s already has %s tasks running", call, r[0].user_email, max_running_per_user)
+                raise Empty()
+
+            t = TaskEntry.update({
+                            TaskEntry.state:"reserved",
+                            TaskEntry.worker_id:self.worker_id,
+                            TaskEntry.modified:datetime.datetime.now(),
+                            TaskEntry.update_expected_in_s:update_expected_in_s,
+                            TaskEntry.version:TaskEntry.version + 1,
+                        })\
+                        .where(TaskEntry.key == r[0].key, TaskEntry.state == "waiting")
+
+            hot_logger.debug("%s: task update sql: %s", call, Lazy(t.sql))
 
-        logger.info("%s: task update sql: %s", call, t.sql())
+            r = t.execute(database=None)
 
-        r = t.execute(database=None)
+            if r == 0:
+                logger.warning("%s: task %s was reserved by someone else", call, pre_selected_task_key)
+                raise Empty()
 
         #entries=TaskEntry.select().where(TaskEntry.worker_id==self.worker_id,TaskEntry.state=="reserved").order_by(TaskEntry.modified.desc()).execute(database=None)
         entries=TaskEntry.select().where(
@@ -608,28 +881,26 @@ class Queue:
 
         entry = entries[0]
 
-        log(call+": post-selected current task: " + entry.key)
+        hot_logger.info("%s: post-selected current task: %s", call, entry.key)
 
         try:
-            self.current_task = Task.from_task_dict(entry.task_dict_string)
+            self.current_task = Task.from_entry(entry)
         except CorruptEntry:
-            r = TaskEntry.update({
-                        TaskEntry.modified:datetime.datetime.now(),
-                        TaskEntry.state: "corrupt",
-                    }).where(TaskEntry.key == entry.key).execute(database=None)
+            r = self.leave_running(entry.key, "corrupt")
 
             logger.error("%s: found corrupt entry %s, marking as so", call, entry.key)
             return None
 
         # validate
         self.current_task_stored_key = self.current_task.key
+        self.current_task_version = entry.version
 
         if self.current_task.key != entry.key:
             logger.error("current task key computed now does not match that found in record")
             logger.error("current task key: %s task: %s", self.current_task.key, self.current_task)
             logger.error("fetched task key: %s entry: %s", entry.key, entry)
 
-        log(call+": selected current task: " + self.current_task.key)
+        hot_logger.info("%s: selected current task: %s", call, self.current_task.key)
 
         if pre_selected_task_key != self.current_task.key:
             logger.error("RACED: pre-selected task %s does not coincide with recovered one: %s; will set %s to waiting", pre_selected_task_key, self.current_task.key, pre_selected_task_key)
@@ -650,23 +921,32 @@ class Queue:
 
             raise Exception("Inconsistent storage")
 
-    def set_current_task_state(self, state, key=None):
+    def set_current_task_state(self, state, key=None) -> int:
+        "moves claimed task between reserved, running and back to waiting; only if the claim is still ours"
+
         if key is None:
+            if self.current_task is None:
+                logger.warning("no current task to set to state %s", state)
+                return 0
             key = self.current_task.key
 
-        logger.info("setting task %s to state %s", key, state)
-        r = TaskEntry.update({
-                        TaskEntry.state:state,
-                    })\
-                    .where( (TaskEntry.key == key) ).limit(1).execute(database=None)
-        logger.info("result %s while setting task %s to state %s", r, key, state)
+        version = None
+        if self.current_task is not None and key == self.current_task.key:
+            version = self.current_task_version
 
-        entries = TaskEntry.select().where(TaskEntry.key == key).order_by(TaskEntry.modified.desc()).limit(1).execute(database=None)
-       # Task.from_task_dict(entries[0].task_dict_string)
-        logger.info("after setting task %s to state %s, found in state %s", key, state, entries[0].state)
+        logger.info("setting task %s version %s to state %s", key, version, state)
 
-        return r
+        won = self.transition(key, occupying_states, state, expected_version=version)
+
+        if won:
+            if version is not None:
+                self.current_task_version = version + 1
+        else:
+            logger.warning("task %s version %s was not in our claim anymore, not set to %s", key, version, state)
+
+        return int(won)
 
+    @metrics.timed("dqueue_offer_seconds")
     def get(self, update_expected_in_s: float=-1, worker_knowledge=None, only_users='all'):
         ""
         logger.info('getting offer for only_users: %s', only_users)
@@ -691,10 +971,14 @@ class Queue:
 
         tried_tasks = 0
         while True:
+            # reserved by get_one_task
             self.get_one_task(update_expected_in_s, offset=offset, prefer_worker_knowledge=worker_knowledge, only_users=only_users)
-            r = self.set_current_task_state("reserved")
             tried_tasks += 1
 
+            if self.current_task is None:
+                time.sleep(1)
+                continue
+
             logger.info("get_one_task set current_task to %s", self.current_task.key)
 
             if tried_tasks > 500: # TODO: HC
@@ -703,10 +987,6 @@ class Queue:
                 self.current_task = None
                 break
 
-            if self.current_task is None:
-                time.sleep(1)
-                continue
-
             skip_this_one = False
 
             # if only_users == 'all':
@@ -715,7 +995,7 @@ class Queue:
             #     try:
             #         logger.info('will search for user info in %s', self.current_task.submission_info)
             #         callback = self.current_task.submission_info['callbacks'][0]
-            #         user_job_token = dict(urllib.parse.parse_qs(callback.split("?",1)[1]))['token'][0]
+            #         user_job_token = parse_qs(callback.split("?",1)[1])['token'][0]
                     
             #         user_sub = json.loads(base64.b64decode(user_job_token.split(".")[1]))['sub']
             #         logger.info('allowed only %s, user token contains %s', only_users, user_sub)
@@ -757,13 +1037,16 @@ class Queue:
         if self.current_task is None:
             raise Empty()
 
-        log("task is running",self.current_task)
+        hot_logger.info("task is running %s", self.current_task)
         r = self.set_current_task_state("running")
         self.current_task_status = "running"
 
+        if fair_share:
+            self.note_user_claim(self.current_task.user_email)
+
         self.log_task("task started")
 
-        log('task',self.current_task.submission_info)
+        hot_logger.info("task %s", self.current_task.submission_info)
 
         return self.current_task
     
@@ -784,7 +1067,7 @@ class Queue:
         ""
         if only_older_than_days is None and only_kind is None and leave_last is None:
             logger.warning('this is very desctructive: clearing all event log')
-            return EventLog.delete().execute(database=None)
+            return retention.delete_chunked()['deleted']
 
         f = []
 
@@ -818,22 +1101,35 @@ class Queue:
         if len(f) > 0:
             F = reduce(lambda x,y: x&y, f)
 
-            N = EventLog.delete().where(F).execute(database=None)
+            N = retention.delete_chunked(F)['deleted']
 
             logger.info("clearing: %s", N)
         else:
             N = 0
 
         return N
+
+    def rollup_event_log(self, max_batches=None, lag_s=None) -> dict:
+        "aggregates new events into the rollup tables"
+        return rollup.run_rollup(max_batches=max_batches, lag_s=lag_s)
+
+    def get_rollup(self, period: str="minute", since_hours: float=1, group_by: List[str]=["queue"], only_this_queue: bool=False) -> List[dict]:
+        return rollup.query_rollup(period,
+                                   since=datetime.datetime.now() - datetime.timedelta(hours=since_hours),
+                                   group_by=group_by,
+                                   queue=self.queue if only_this_queue else None)
+
+    def apply_event_log_retention(self, policies=None, max_chunks=None) -> dict:
+        "deletes old events according to retention policies, in chunks; reports deleted events and throughput"
+        return retention.apply_retention(policies, max_chunks=max_chunks)
     
     def clear_old_worker_events(self):
         ""
         logger.warning('this is very desctructive: clearing event log')
         EventLog.delete().execute(database=None)
 
-    #def move_task(self, fromk: str, tok: str, task, update_entry=False, n_tries_left=1):
-    def move_task(self, fromk: str, tok: str, task, update_entry=None, n_tries_left=1):
-        "moves task"
+    def move_task(self, fromk: str, tok: str, task, update_entry=None, n_tries_left=1, extra=None) -> bool:
+        "moves task from one state to another, if it is still in the first; retries on db errors, reconnecting"
 
         logger.info("%s moving task %s from %s to %s", self, task, fromk, tok)
         logger.info("%s moving task update entry %s", self, update_entry)
@@ -843,48 +1139,42 @@ class Queue:
         else:
             task_key = task
 
-
         retry_delay=2
 
-        if n_tries_left<=0:
-            return
-            
-        extra = {}
+        extra = {TaskEntry.worker_id: self.worker_id, **(extra or {})}
 
-        #if update_entry:
-        #    extra = {TaskEntry.task_dict_string: self.current_task.serialize()}
         if update_entry is not None:
             logger.info("will update entry %s", update_entry)
-            extra = {TaskEntry.task_dict_string: update_entry}
+            extra[TaskEntry.task_dict_string] = update_entry
 
-        try:
-            r = TaskEntry.update({
-                            TaskEntry.state:tok,
-                            TaskEntry.worker_id:self.worker_id,
-                            TaskEntry.modified:datetime.datetime.now(),
-                            **extra
-                        })\
-                        .where(TaskEntry.state==fromk, TaskEntry.key==task_key).execute(database=None)
+        # a dropped connection is always reconnected and retried at least once
+        n_tries = max(2, n_tries_left)
 
-        except Exception as e:
-            logger.error('failed to move task: %s', repr(e))
-            #self.log_task("failed to move task from %s to %s; serialized to %i"%(repr(e),len(serialized)),state="failed_to_lock")
-            self.log_task(f"failed to move task from {fromk} to {tok}: {e.__class__}:{repr(e)}; db: {db } - will try connecting after {retry_delay} s", state="failed_to_lock")
-
-            time.sleep(retry_delay + (30 - n_tries_left))
+        for i_try in range(n_tries):
+            delay = min(retry_delay * 2**i_try, move_retry_max_delay_s)
 
             try:
+                return self.transition(task_key, [fromk], tok, extra=extra)
+            except Exception as e:
+                logger.error('failed to move task: %s', repr(e))
                 try:
-                    db.close()
-                except Exception as e:
-                    self.log_task(f"db close before reconnect failed", state="db_reconnected")
+                    self.log_task(f"failed to move task from {fromk} to {tok}: {e.__class__}:{repr(e)}; db: {db } - will try connecting after {delay} s", state="failed_to_lock", task_key=task_key)
+                except Exception as log_e:
+                    # the connection may be what failed: the event is logged only once it is back
+                    logger.warning("unable to log failed move: %s", repr(log_e))
+
+                if i_try + 1 >= n_tries:
+                    break
 
-                db.connect()
-                self.log_task(f"managed to reconnect!", state="db_reconnected")
-            except peewee.OperationalError as e:
-                self.log_task(f"failed to reconnect! {repr(e)}", state="failed_to_reconnect")
+                time.sleep(delay)
 
-            return self.move_task(fromk, tok, task, update_entry, n_tries_left-1)
+                try:
+                    database.reconnect()
+                    self.log_task(f"managed to reconnect!", state="db_reconnected", task_key=task_key)
+                except peewee.OperationalError as e:
+                    self.log_task(f"failed to reconnect! {repr(e)}", state="failed_to_reconnect", task_key=task_key)
+
+        return False
 
     def purge(self):
         ""
@@ -894,6 +1184,7 @@ class Queue:
         return nentries
 
     
+    @metrics.timed("dqueue_maintenance_seconds", action="unlock")
     def try_all_locked(self, unlock_max = 10):
         ""
         r=[]
@@ -908,7 +1199,7 @@ class Queue:
             task_entry = self.task_by_key(task_key)
             logger.info("trying to unlock %s", task_entry['key'])
 
-            r.append(self.try_to_unlock(Task.from_task_dict(task_entry['task_dict_string'])))
+            r.append(self.try_to_unlock(Task.from_entry(task_entry)))
 
             if r[-1]['state'] != "locked":
                 n_unlocked += 1
@@ -925,10 +1216,19 @@ class Queue:
         #open(nfn, "w").write(task.serialize())
             
 
-    def insert_task_entry(self,task,state):
+    def insert_task_entry(self,task,state,priority=0):
         self.log_task("task created",task,state)
+        metrics.inc("dqueue_task_transitions_total", state=state)
         
         serialized_task = task.serialize()
+
+        # large tasks are stored once in the blob store, identical ones shared
+        blob = blobstore.put(serialized_task)
+        if blob is None:
+            stored_fields = dict(task_dict_string=serialized_task, task_dict_blob=None, task_dict_size=None)
+        else:
+            stored_fields = dict(task_dict_string="", task_dict_blob=blob[0], task_dict_size=blob[1])
+
         log("to insert_task entry: ", dict(
              queue=self.queue,
              key=task.key,
@@ -937,6 +1237,7 @@ class Queue:
              task_dict_string=serialized_task,
              created=datetime.datetime.now(),
              modified=datetime.datetime.now(),
+             priority=priority,
         ))
         
         r = TaskEntry.select(TaskEntry.key == task.key).execute()
@@ -950,9 +1251,10 @@ class Queue:
                              key=task.key,
                              state=state,
                              worker_id=self.worker_id,
-                             task_dict_string=serialized_task,
+                             **stored_fields,
                              created=datetime.datetime.now(),
                              modified=datetime.datetime.now(),
+                             priority=priority,
                             ).execute(database=None)
         except (pymysql.err.IntegrityError, peewee.IntegrityError) as e:
             log("task already inserted, reasserting the queue to",self.queue)
@@ -963,9 +1265,15 @@ class Queue:
                                  key=task.key,
                                  state=state,
                                  worker_id=self.worker_id,
-                                 task_dict_string=serialized_task,
+                                 **stored_fields,
+                                 execution_info=None,
+                                 execution_info_blob=None,
+                                 execution_info_size=None,
+                                 depends_on=None,
                                  created=datetime.datetime.now(),
                                  modified=datetime.datetime.now(),
+                                 priority=priority,
+                                 version=TaskEntry.version + 1,
                             ).where(
                                 TaskEntry.key == task.key,
                             ).execute(database=None)
@@ -981,7 +1289,7 @@ class Queue:
             logger.error("multiple tasks for key %s", task.key)
             raise Exception(f"multiple tasks for key {task.key}")
 
-        if r[0].task_dict_string != serialized_task:
+        if (r[0].task_dict_string, r[0].task_dict_blob) != (stored_fields['task_dict_string'], stored_fields['task_dict_blob']):
             logger.error("insert result was %s but found mismatch between task_dict_string and stored: %s != %s; complete entry %s: could it be because of size limit of peewee db?", 
                     insert_result,
                     r[0].task_dict_string, serialized_task, model_to_dict(r[0]))
@@ -1000,9 +1308,9 @@ class Queue:
         for i_dep, dependency in enumerate(task.depends_on):
             dependency_task=Task(dependency)
 
-            print(("task",task.key,"depends on task", dependency_task.key, i_dep, "/", len(task.depends_on)))
+            hot_logger.debug("task %s depends on task %s %s / %s", task.key, dependency_task.key, i_dep, len(task.depends_on))
             dependency_instances=self.find_task_instances(dependency_task)
-            print(("task instances for",dependency_task.key,len(dependency_instances)))
+            hot_logger.debug("task instances for %s: %s", dependency_task.key, len(dependency_instances))
 
             dependencies.append(dict(states=[]))
 
@@ -1011,10 +1319,10 @@ class Queue:
                 #log("dependency incomplete")
                 dependencies[-1]['states'].append(i['state'])
                 dependencies[-1]['task']=dependency_task
-                print(("task instance for",dependency_task.key,"is",i['state'],"from",i_i,"/",len(dependency_instances)))
+                hot_logger.debug("task instance for %s is %s from %s / %s", dependency_task.key, i['state'], i_i, len(dependency_instances))
 
             if len(dependencies[-1]['states'])==0:
-                print(("job dependencies do not exist, expecting %s"%dependency_task.key))
+                logger.info("job dependencies do not exist, expecting %s", dependency_task.key)
                 #print(dependency_task.serialize())
                 raise DependenciesDoNotExist("job dependencies do not exist, expecting %s"%dependency_task.key)
 
@@ -1073,18 +1381,17 @@ class Queue:
         self.current_task.depends_on = _depends_on
 
         try:
-            serialized=self.current_task.serialize()
+            serialized=json.dumps(_depends_on)
         except Exception as e:
-            logger.error("problem serializing task: %s", e)
-            self.log_task(f"problem serializing task: {e}", state="locking")
+            logger.error("problem serializing dependencies: %s", e)
+            self.log_task(f"problem serializing dependencies: {e}", state="locking")
             raise
 
-        self.log_task("task to lock: serialized to %i"%len(serialized), state="locked")
+        self.log_task("task to lock: dependencies serialized to %i"%len(serialized), state="locked")
 
         self.move_task('running', 'locked', 
                        self.current_task, 
-                       update_entry=self.current_task.serialize(),
-                       #update_entry=True, 
+                       extra={TaskEntry.depends_on: serialized},
                        n_tries_left=30)
         
         self.log_task("task locked from "+str(self.current_task_status),state="locked")
@@ -1093,94 +1400,185 @@ class Queue:
         self.current_task=None
 
 
+    @metrics.timed("dqueue_task_done_seconds")
     def task_done(self):
         if self.current_task is None:
             log("WARNING: trying to claim done task, but no task is current")
             return
 
-        log("task done, closing:",self.current_task.key,self.current_task)
-        log("task done, stored key:",self.current_task_stored_key)
+        hot_logger.info("task done, closing: %s %s", self.current_task.key, self.current_task)
+        hot_logger.info("task done, stored key: %s", self.current_task_stored_key)
 
         self.log_task("task to register done")
 
-        r=TaskEntry.update({
-                    TaskEntry.state:"done",
-                    TaskEntry.task_dict_string:self.current_task.serialize(), # TODO this modifies serialization!
-                    TaskEntry.modified:datetime.datetime.now(),
-                }).where(TaskEntry.key==self.current_task.key).execute(database=None)
-
+        keys = [self.current_task.key]
         if self.current_task_stored_key != self.current_task.key:
-            r=TaskEntry.update({
-                        TaskEntry.state:"done",
-                        TaskEntry.task_dict_string:self.current_task.serialize(),
-                        TaskEntry.modified:datetime.datetime.now(),
-                    }).where(TaskEntry.key==self.current_task_stored_key).execute(database=None)
+            keys.append(self.current_task_stored_key)
 
+        for key in keys:
+            extra = self.execution_info_update()
+
+            if self.complete_claim(key, "done", extra):
+                continue
+
+            # not our claim anymore, but the result is still good
+            if self.transition(key, occupying_states, "done", extra=extra):
+                logger.warning("task %s: %s", key, TaskStolen("completed while claimed by another worker, who will find it done"))
+            elif self.transition(key, ["waiting", "failed", "locked"], "done", extra=extra):
+                logger.warning("task %s completed late, after it was expired or failed", key)
+            else:
+                logger.info("task %s was already done: duplicate completion ignored", key)
 
         self.current_task_status="done"
 
         self.log_task("task done")
-        log('task registered done',self.current_task.key)
+        hot_logger.info("task registered done %s", self.current_task.key)
 
         self.current_task=None
+        self.current_task_version=None
+
+    def execution_info_update(self) -> dict:
+        "the task itself is not rewritten on state transitions: only what changed while it was executed"
+
+        if self.current_task.execution_info is None:
+            return {}
+
+        execution_info = json.dumps(normalize_nested_dict(self.current_task.execution_info), sort_keys=True)
+
+        blob = blobstore.put(execution_info)
+        if blob is None:
+            return {TaskEntry.execution_info: execution_info, TaskEntry.execution_info_blob: None, TaskEntry.execution_info_size: None}
 
+        return {TaskEntry.execution_info: None, TaskEntry.execution_info_blob: blob[0], TaskEntry.execution_info_size: blob[1]}
+
+    def complete_claim(self, key: str, state: str, extra=None) -> bool:
+        "finishes the claim of this worker: the version seen at claim time if known here, otherwise the worker id"
+
+        if self.current_task_version is not None and key == self.current_task_stored_key:
+            return self.transition(key, occupying_states, state, expected_version=self.current_task_version, extra=extra)
+        else:
+            return self.transition(key, occupying_states, state, expected_worker_id=self.worker_id, extra=extra)
+
+    @metrics.timed("dqueue_maintenance_seconds", action="forgive")
     def forgive_task_failures(self) -> int:
-        # this to be made like some sort of mapping!
-        print("will move some tasks around")
-        t = TaskEntry.update({
-                        TaskEntry.queue:"default",
-                    })\
-                    .where(TaskEntry.queue == "queue-osa11").execute(database=None)
-        # /patch 
+        "moves failed tasks which did not exhaust retries back to waiting; retry delay is kept in not_before"
+
+        forgivable = (TaskEntry.state == "failed") & (TaskEntry.n_failed < n_failed_retries)
+
+        now = datetime.datetime.now()
+
+        with db.atomic():
+            EventLog.insert_from(
+                    TaskEntry.select(
+                            TaskEntry.queue,
+                            TaskEntry.key,
+                            peewee.Value("waiting"),
+                            peewee.Value(self.worker_id),
+                            peewee.Value("unset"),
+                            peewee.Value("task failure forgiven, to waiting"),
+                            peewee.Value(now),
+                            peewee.Value(0),
+                        ).where(forgivable),
+                    [EventLog.queue, EventLog.task_key, EventLog.task_state, EventLog.worker_id, EventLog.worker_state,
+                     EventLog.message, EventLog.timestamp, EventLog.spent_s]
+                ).execute(database=None)
+
+            n = TaskEntry.update({
+                            TaskEntry.state: "waiting",
+                            TaskEntry.modified: now,
+                            TaskEntry.version: TaskEntry.version + 1,
+                        }).where(forgivable).execute(database=None)
 
-        entries = TaskEntry.select().where(TaskEntry.state=="failed").order_by(TaskEntry.modified).limit(100).execute(database=None)
+        if n == 0:
+            logger.info("no failed tasks to forgive")
+        else:
+            logger.info("forgiven %s failed tasks", n)
 
-        if len(entries) == 0:
-            logger.info("no failed tasks: will not try to forgive")
+        return n
+
+    def archive_tasks(self, older_than_days: Union[float, None]=None, states=["done", "failed"], batch_size: int=1000, max_batches: Union[int, None]=None, pause_s: float=0.1,
+                      only_this_queue: bool=False) -> int:
+        """
+        moves old finished tasks from TaskEntry to ArchivedTaskEntry, in batches, each in own transaction;
+        interrupted archiving resumes where it stopped, pause between batches lets the workers through;
+        tasks of all queues, unless only_this_queue
+        """
+
+        if older_than_days is None:
+            older_than_days = archive_after_days
+
+        if older_than_days <= 0:
             return 0
 
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than_days)
 
-        for entry in entries:
-            try:
-                self.current_task=Task.from_task_dict(entry.task_dict_string)
-                self.current_task_stored_key=self.current_task.key
-                logger.info("found %s failed tasks: will try to forgive", len(entries))
-            except Exception as e:
-                logger.info("will not forgive task %s with corrupt json, updating modified", entry.key)
-                r=TaskEntry.update({
-                            TaskEntry.modified:datetime.datetime.now(),
-                            TaskEntry.state: "corrupt",
-                        }).where(TaskEntry.key == entry.key).execute(database=None)
-                return 0
+        archived = (TaskEntry.state << states) & (TaskEntry.modified < cutoff)
+        if only_this_queue:
+            archived &= TaskEntry.queue == self.queue
 
-            task = self.current_task
+        fields = [ArchivedTaskEntry.queue, ArchivedTaskEntry.key, ArchivedTaskEntry.state, ArchivedTaskEntry.worker_id,
+                  ArchivedTaskEntry.task_dict_string, ArchivedTaskEntry.created, ArchivedTaskEntry.modified,
+                  ArchivedTaskEntry.update_expected_in_s, ArchivedTaskEntry.priority, ArchivedTaskEntry.n_failed,
+                  ArchivedTaskEntry.execution_info, ArchivedTaskEntry.depends_on,
+                  ArchivedTaskEntry.task_dict_blob, ArchivedTaskEntry.task_dict_size,
+                  ArchivedTaskEntry.execution_info_blob, ArchivedTaskEntry.execution_info_size,
+                  ArchivedTaskEntry.archived]
 
-            history = [model_to_dict(en) for en in EventLog.select().where(EventLog.task_key == task.key).order_by(EventLog.id.desc()).execute(database=None)]
-            n_failed = len([he for he in history if he['task_state'] == "failed"])
-            
-            self.log_task(f"event logs reports failed {n_failed}, task record shows {self.current_task.n_times_failed}", task, "failed")
+        N = 0
+        n_batches = 0
+        t0 = time.time()
+
+        while max_batches is None or n_batches < max_batches:
+            with db.atomic():
+                keys = [e.key for e in TaskEntry.select(TaskEntry.key)
+                                                .where(archived)
+                                                .order_by(TaskEntry.modified)
+                                                .limit(batch_size)
+                                                .execute(database=None)]
+
+                if len(keys) == 0:
+                    break
 
-            n_failed = max(n_failed, self.current_task.n_times_failed)
+                ArchivedTaskEntry.insert_from(
+                        TaskEntry.select(
+                                TaskEntry.queue, TaskEntry.key, TaskEntry.state, TaskEntry.worker_id,
+                                TaskEntry.task_dict_string, TaskEntry.created, TaskEntry.modified,
+                                TaskEntry.update_expected_in_s, TaskEntry.priority, TaskEntry.n_failed,
+                                TaskEntry.execution_info, TaskEntry.depends_on,
+                                TaskEntry.task_dict_blob, TaskEntry.task_dict_size,
+                                TaskEntry.execution_info_blob, TaskEntry.execution_info_size,
+                                peewee.Value(datetime.datetime.now()),
+                            ).where(TaskEntry.key << keys, TaskEntry.state << states),
+                        fields
+                    ).on_conflict_replace().execute(database=None)
 
-            if n_failed < n_failed_retries:
-                self.log_task("task failure forgiven, to waiting", task, "waiting")
-                #time.sleep( (5+2**int(n_failed/2))*sleep_multiplier )
-                r=TaskEntry.update({
-                            TaskEntry.state: "waiting",
-                            TaskEntry.task_dict_string:self.current_task.serialize(),
-                            TaskEntry.modified:datetime.datetime.now(),
-                        }).where(TaskEntry.key == self.current_task.key).execute(database=None)
-            else:
-                self.log_task("task failure permanent",task,"waiting")
+                n = TaskEntry.delete().where(TaskEntry.key << keys, TaskEntry.state << states).execute(database=None)
 
-            self.current_task = None
-            self.current_task_stored_key = None
-            self.current_task_status = None
+            N += n
+            n_batches += 1
 
-        return 1
+            logger.info("archived batch %s of %s tasks, total %s in %.1f s", n_batches, n, N, time.time() - t0)
 
+            if len(keys) < batch_size:
+                break
+
+            time.sleep(pause_s)
 
+        return N
 
+    def move_queue_tasks(self, from_queue: str, to_queue: str) -> int:
+        "administrative remapping of all tasks from one queue to another"
+
+        n = TaskEntry.update({
+                        TaskEntry.queue: to_queue,
+                    })\
+                    .where(TaskEntry.queue == from_queue).execute(database=None)
+
+        logger.info("moved %s tasks from queue %s to queue %s", n, from_queue, to_queue)
+
+        return n
+
+    @metrics.timed("dqueue_task_failed_seconds")
     def task_failed(self,update=lambda x:None):
         update(self.current_task)
 
@@ -1190,14 +1588,32 @@ class Queue:
 
         self.log_task(f"task failed: {self.current_task.n_times_failed} times",self.current_task,"failed")
 
-        r=TaskEntry.update({
-                    TaskEntry.state: "failed",
-                    TaskEntry.task_dict_string:self.current_task.serialize(),
-                    TaskEntry.modified:datetime.datetime.now(),
-                }).where(TaskEntry.key==self.current_task.key).execute(database=None)
+        key = self.current_task.key
+
+        # failures counted with the task, including expiries, which do not reach its execution info
+        stored = TaskEntry.select(TaskEntry.n_failed).where(TaskEntry.key == key).execute(database=None)
+        n_failed = stored[0].n_failed if len(stored) > 0 else self.current_task.n_times_failed - 1
+
+        extra = {
+                **self.execution_info_update(),
+                TaskEntry.not_before: retry_not_before(n_failed + 1),
+                TaskEntry.n_failed: TaskEntry.n_failed + 1,
+            }
+
+        if not self.complete_claim(key, "failed", extra):
+            if self.transition(key, occupying_states, "failed", extra=extra):
+                logger.warning("task %s: %s", key, TaskStolen("failed while claimed by another worker"))
+            elif self.transition(key, ["waiting", "locked"], "failed", extra=extra):
+                logger.warning("task %s failed late, after it was expired", key)
+            elif self.transition(key, ["failed"], "failed", extra=without_failure_count(extra)):
+                # already counted, and delayed, by whoever failed it first
+                logger.warning("task %s failed late, after it was failed", key)
+            else:
+                logger.warning("task %s was already done: failure ignored", key)
 
         self.current_task_status = "failed"
         self.current_task = None
+        self.current_task_version = None
 
 
     def wipe(self,wipe_from=["waiting"]):
@@ -1288,6 +1704,7 @@ class Queue:
                         ).execute(database=None)
 
 
+    @metrics.timed("dqueue_log_task_seconds")
     def log_task(self, message, task=None, state=None, task_key=None):
         ""
 
@@ -1302,7 +1719,7 @@ class Queue:
         if state is None:
             state="undefined"
 
-        logger.info("log_task: task:%s task_key:%s for message:%s at state:%s", task, task_key, message, state)
+        hot_logger.info("log_task: task:%s task_key:%s for message:%s at state:%s", task, task_key, message, state)
 
         # pass
 
@@ -1320,12 +1737,13 @@ class Queue:
 
         try:
             msg['message'] = json.loads(message)
-            logger.info("managed to decode message json: %s", msg['message'])
+            hot_logger.debug("managed to decode message json: %s", msg['message'])
         except Exception as e:
-            logger.warning("unable to decode message: %s - from %s", e, message)
+            # most messages are plain text: once in a while is enough to see it
+            rate_limited.log(logging.INFO, "log_task plain message", "unable to decode message: %s - from %s", e, message)
             msg['message'] = message
 
-        logger.info("to logstash: %s", json.dumps(pylogstash.flatten(msg, sep="/")))
+        hot_logger.debug("to logstash: %s", Lazy(lambda: json.dumps(pylogstash.flatten(msg, sep="/"))))
         log_stasher.log({"oda_"+k:v for k,v in msg.items()})
 
         return EventLog.insert(
@@ -1367,6 +1785,7 @@ class Queue:
 
         return jobs
 
+    @metrics.timed("dqueue_maintenance_seconds", action="expire")
     def expire_tasks(self):
         # yes. all of this can be one cmmand. but we want details
         entries = TaskEntry.select().where(
@@ -1385,30 +1804,32 @@ class Queue:
             if age > expected:
                 logger.warning("to expire key %s state %s", entry.key, entry.state)
 
-                extra = {}
+                # same counter as explicit failures: repeated expiries back off too
+                extra = {
+                        TaskEntry.n_failed: TaskEntry.n_failed + 1,
+                        TaskEntry.not_before: retry_not_before(entry.n_failed + 1),
+                    }
 
                 try:
-                    self.current_task=Task.from_task_dict(entry.task_dict_string)
+                    self.current_task=Task.from_entry(entry)
                     self.current_task_stored_key=self.current_task.key
                 except Exception as e:
                     logger.error("unexpected error in decoding task content: %s", repr(e))
-                    extra = {TaskEntry.task_dict_string: json.dumps({'corrupt_json': entry.task_dict_string})}
+                    extra[TaskEntry.task_dict_string] = json.dumps({'corrupt_json': entry.task_dict_string})
                     self.log_task("task failed - corrupt json", None, "failed", task_key=entry.key)
                     
                 self.log_task("task failed - expired",self.current_task,"failed")
 
-                n = TaskEntry.update({
-                            TaskEntry.state:"failed",
-                            **extra
-                        }).where(
-                            TaskEntry.state=="running",
-                            TaskEntry.key==entry.key,
-                        ).execute(database=None)
+                # only the claim which was found expired: not if the worker finished or it was claimed again meanwhile
+                n = self.leave_running(entry.key, "failed", extra, expected_version=entry.version)
 
                 logger.warning("expired %s", n)
 
                 N += n
 
+        if max_running_per_queue > 0 or max_running_per_user > 0:
+            self.recount_running_slots()
+
         return N
 
 
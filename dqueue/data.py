@@ -12,17 +12,30 @@ import re
 import click
 from urllib.parse import urlparse# type: ignore
 import bravado
+import requests
 
 from dqueue.core import Queue, Empty, Task, CurrentTaskUnfinished
 from dqueue.client import APIClient
 import dqueue.core as core
 
-from typing import Union
+from typing import Union, Iterable, IO, List
 from dqueue import tools
 
 from retrying import retry # type: ignore
 
 import base64
+import hashlib
+import tempfile
+
+import dqueue.factformat as factformat
+
+logger = logging.getLogger(__name__)
+
+stream_chunk_size = 1024*1024
+
+# consulted facts are kept on disk, up to this size in total; 0 disables the cache
+facts_cache_dir = os.environ.get('DQUEUE_FACTS_CACHE_DIR', os.path.join(os.environ.get('HOME', '.'), '.cache', 'dqueue', 'facts'))
+facts_cache_max_mb = float(os.environ.get('DQUEUE_FACTS_CACHE_MAX_MB', '1024'))
 
 class NotFound(Exception):
     pass
@@ -35,19 +48,140 @@ def serialize(d, b64=False):
 
 #TODO: since we do not use minio's native binary store, and encode everything, we overuse space, 50% depending on the data
 
+class FactCache:
+    """
+    consulted facts on local disk, one file per dag, evicting least recently used beyond max_mb;
+    each file starts with sha256 of the rest, and is dropped if it does not match
+    """
+
+    def __init__(self, directory: str=facts_cache_dir, max_mb: float=facts_cache_max_mb):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def path(self, dag) -> str:
+        return os.path.join(self.directory, hashlib.sha256(serialize(dag).encode()).hexdigest())
+
+    def get(self, dag) -> Union[dict, None]:
+        if not self.enabled:
+            return None
+
+        fn = self.path(dag)
+
+        try:
+            with open(fn, "rb") as f:
+                sha256 = f.readline().strip().decode()
+                content = f.read()
+        except FileNotFoundError:
+            return None
+
+        if hashlib.sha256(content).hexdigest() != sha256:
+            logger.warning("cached fact %s is corrupt, dropping", fn)
+            self.drop(fn)
+            return None
+
+        fact = json.loads(content)
+
+        if json.loads(fact['dag_json']) != dag:
+            logger.warning("cached fact %s is for another dag, dropping", fn)
+            self.drop(fn)
+            return None
+
+        # recently used
+        os.utime(fn)
+
+        return fact
+
+    def put(self, dag, fact: dict):
+        if not self.enabled:
+            return
+
+        content = json.dumps(fact, sort_keys=True).encode()
+
+        if len(content) > self.max_bytes:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        fd, tmp_fn = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(hashlib.sha256(content).hexdigest().encode() + b"\n")
+            f.write(content)
+        os.replace(tmp_fn, self.path(dag))
+
+        self.evict()
+
+    def drop(self, fn: str):
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+
+    def binary_path(self, dag) -> str:
+        "fact downloaded as binary container or raw bytes, mapped from there"
+        return self.path(dag) + ".dqfact"
+
+    def invalidate(self, dag):
+        "the fact of the dag was asserted again: what is cached of it, in any form, is stale"
+        self.drop(self.path(dag))
+        self.drop(self.binary_path(dag))
+
+    def evict(self):
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.is_file() and not e.name.startswith("."):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, fn in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            self.drop(fn)
+            total -= size
+
+
 class DataFacts(APIClient):
+    _fact_cache = None
+
+    @property
+    def fact_cache(self) -> FactCache:
+        if self._fact_cache is None:
+            self._fact_cache = FactCache()
+        return self._fact_cache
+
     def assert_fact(self, dag, data):
-        return self.client.data.assert_fact(
-                    worker_id=self.worker_id,
-                    payload=dict(
-                        dag_json=serialize(dag),
-                        data_json=serialize(data),
-                    )
-                ).response().result
+        fact = dict(
+                    dag_json=serialize(dag),
+                    data_json=serialize(data),
+                )
+
+        try:
+            r = self.client.data.assert_fact(
+                        worker_id=self.worker_id,
+                        payload=fact,
+                    ).response().result
+        finally:
+            self.fact_cache.invalidate(dag)
+
+        # as consulted
+        self.fact_cache.put(dag, fact)
+
+        return r
     
     def consult_fact(self, dag, return_data=True):
+        cached = self.fact_cache.get(dag)
+        if cached is not None:
+            logger.debug("fact found in local cache")
+            return cached
+
         try:
-            return self.client.data.consult_fact(
+            fact = self.client.data.consult_fact(
                         return_data=return_data,
                         worker_id=self.worker_id,
                         payload=dict(
@@ -58,3 +192,152 @@ class DataFacts(APIClient):
             logging.warning("unable to restore")
             raise NotFound(e)
 
+        if return_data:
+            self.fact_cache.put(dag, fact)
+
+        return fact
+
+    def consult_facts(self, dags: list) -> List[Union[dict, None]]:
+        "facts of many dags in one request, None for those not found; locally cached facts are not asked for"
+
+        result = [self.fact_cache.get(dag) for dag in dags] # type: List[Union[dict, None]]
+
+        missing = [i for i, fact in enumerate(result) if fact is None]
+
+        if len(missing) == 0:
+            return result
+
+        r = requests.post(self.leader.strip("/") + "/data/consult_many",
+                          params=dict(worker_id=self.worker_id),
+                          json=dict(dags_json=[serialize(dags[i]) for i in missing]),
+                          headers={'Authorization': "Bearer " + self.token},
+                          stream=True)
+
+        r.raise_for_status()
+
+        # in the order they are restored
+        for line in r.iter_lines():
+            if not line:
+                continue
+
+            answer = json.loads(line)
+            i = missing[answer['index']]
+
+            if answer['found']:
+                fact = dict(dag_json=answer['dag_json'], data_json=answer['data_json'])
+                self.fact_cache.put(dags[i], fact)
+                result[i] = fact
+            elif 'error' in answer:
+                logger.warning("unable to restore fact %s: %s", i, answer['error'])
+
+        return result
+
+    def facts_exist(self, dags: list) -> List[bool]:
+        "whether facts of each of the dags are known, in one request; locally cached facts are not asked for"
+
+        exists = [os.path.exists(self.fact_cache.path(dag)) if self.fact_cache.enabled else False for dag in dags]
+
+        unknown = [i for i, e in enumerate(exists) if not e]
+
+        if len(unknown) > 0:
+            r = self.client.data.facts_exist(
+                        worker_id=self.worker_id,
+                        payload=dict(
+                            dags_json=[serialize(dags[i]) for i in unknown],
+                        )
+                    ).response().result
+
+            for i, e in zip(unknown, r['exists']):
+                exists[i] = e
+
+        return exists
+
+    def assert_fact_stream(self, dag, data: Union[bytes, IO[bytes], Iterable[bytes]]) -> dict:
+        """
+        stores raw bytes as fact, without JSON encoding: data may be a file opened in binary mode or an iterable of chunks,
+        which are sent as they are read
+        """
+
+        try:
+            r = requests.post(self.leader.strip("/") + "/data/assert/stream",
+                              params=dict(worker_id=self.worker_id, dag_json=serialize(dag)),
+                              data=data,
+                              headers={
+                                  'Authorization': "Bearer " + self.token,
+                                  'Content-Type': "application/octet-stream",
+                              })
+        finally:
+            # also if it failed: it may have been stored
+            self.fact_cache.invalidate(dag)
+
+        r.raise_for_status()
+
+        return r.json()
+
+    def consult_fact_stream(self, dag, output: Union[IO[bytes], None]=None) -> Union[bytes, None]:
+        "raw fact, written to output chunk by chunk if given, otherwise returned"
+
+        r = requests.get(self.leader.strip("/") + "/data/consult/stream",
+                         params=dict(worker_id=self.worker_id, dag_json=serialize(dag)),
+                         headers={'Authorization': "Bearer " + self.token},
+                         stream=True)
+
+        if r.status_code == 400:
+            logger.warning("unable to restore raw fact: %s", r.text)
+            raise NotFound(r.text)
+
+        r.raise_for_status()
+
+        if output is None:
+            return r.content
+
+        for chunk in r.iter_content(stream_chunk_size):
+            output.write(chunk)
+
+        return None
+
+    def assert_fact_binary(self, dag, data) -> dict:
+        "stores fact as binary container: bytes and arrays in data are sent and stored raw"
+
+        with tempfile.TemporaryFile() as f:
+            factformat.write(f, dag, data)
+            f.seek(0)
+            return self.assert_fact_stream(dag, f)
+
+    def consult_fact_binary(self, dag) -> Union[factformat.FactFile, factformat.JSONFact]:
+        """
+        fact with binary values as bytes or arrays, memory-mapped from a local file if stored as container;
+        JSON facts are read with the same interface
+        """
+
+        fn = self.fact_cache.binary_path(dag)
+
+        downloaded = not os.path.exists(fn)
+        if downloaded:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+            try:
+                fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".tmp-")
+                with os.fdopen(fd, "wb") as f:
+                    self.consult_fact_stream(dag, output=f)
+                os.replace(tmp_fn, fn)
+            except NotFound:
+                os.remove(tmp_fn)
+                fact = self.consult_fact(dag)
+                return factformat.JSONFact(json.loads(fact['dag_json']), json.loads(fact['data_json']))
+
+        try:
+            fact = factformat.FactFile(fn)
+        except factformat.NotAContainer:
+            # raw fact: bytes as they were asserted
+            with open(fn, "rb") as f:
+                fact = factformat.JSONFact(dag, f.read())
+
+        # only once mapped: eviction may remove this file, if it alone is larger than the cache
+        if not self.fact_cache.enabled:
+            # stays mapped
+            os.remove(fn)
+        elif downloaded:
+            self.fact_cache.evict()
+
+        return fact
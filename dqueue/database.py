@@ -3,20 +3,50 @@ import os
 import peewee # type: ignore
 import logging
 import datetime
+import time
+import json
+
+import dqueue.metrics as metrics
 
 # beware that insert task may fail if mysql field is too small!
 
 logger = logging.getLogger(__name__)
 
 from playhouse.db_url import connect # type: ignore
+from playhouse.pool import PooledDatabase # type: ignore
 from playhouse.shortcuts import model_to_dict, dict_to_model # type: ignore
 
+# callables (sql, params, duration_s, cursor) called after every query, for metrics and tracing
+query_hooks = []
+
+def install_query_hooks(db):
+    execute_sql = db.execute_sql
+
+    def execute_sql_with_hooks(sql, params=None, *args, **kwargs):
+        t0 = time.time()
+        cursor = None
+        try:
+            cursor = execute_sql(sql, params, *args, **kwargs)
+            return cursor
+        finally:
+            if len(query_hooks) > 0:
+                duration_s = time.time() - t0
+                for hook in query_hooks:
+                    try:
+                        hook(sql, params, duration_s, cursor)
+                    except Exception as e:
+                        logger.debug("query hook %s failed: %s", hook, e)
+
+    db.execute_sql = execute_sql_with_hooks
+
 # use http://docs.peewee-orm.com/projects/flask-peewee/en/latest/index.html
 def connect_db():
     try:
         db = connect(os.environ.get("DQUEUE_DATABASE_URL","mysql+pool://root@localhost/dqueue?max_connections=42&stale_timeout=8001.2"))
         logger.info(f"successfully connected to db: {db}")
 
+        install_query_hooks(db)
+
         return db
 
     except Exception as e:
@@ -24,6 +54,76 @@ def connect_db():
 
 db = connect_db()
 
+# connections taken for a request are pinged first: a connection dropped by the server is replaced, not handed out
+checkout_ping = os.environ.get('DQUEUE_DB_CHECKOUT_PING', 'yes') == 'yes'
+
+# failed tasks are forgiven, back to waiting, until they failed this many times
+n_failed_retries = int(os.environ.get('DQUEUE_FAILED_N_RETRY','20'))
+
+
+def ping_connection() -> bool:
+    conn = db.connection()
+
+    try:
+        if hasattr(conn, 'ping'):
+            conn.ping(reconnect=False) # type: ignore
+        return True
+    except Exception as e:
+        logger.warning("db connection failed health check: %s", e)
+        return False
+
+
+def reconnect():
+    "drops the connection of this thread, also from the pool, and opens a new one"
+    try:
+        if isinstance(db, PooledDatabase):
+            db.manual_close()
+        else:
+            db.close()
+    except Exception as e:
+        logger.warning("db close before reconnect failed: %s", e)
+
+    db.connect(reuse_if_open=True)
+
+
+def checkout_connection():
+    "connection for this thread, for the duration of a request: from the pool if the database is pooled"
+    db.connect(reuse_if_open=True)
+
+    healthy = True
+    if checkout_ping and not ping_connection():
+        healthy = False
+        reconnect()
+
+    metrics.inc("dqueue_db_checkouts_total", healthy=healthy)
+    note_pool_metrics()
+
+
+def release_connection():
+    "returns connection of this thread to the pool, or closes it"
+    if not db.is_closed():
+        db.close()
+
+    note_pool_metrics()
+
+
+def pool_stats() -> dict:
+    if not isinstance(db, PooledDatabase):
+        return dict(pooled=False, in_use=0 if db.is_closed() else 1, idle=0)
+
+    return dict(
+            pooled=True,
+            in_use=len(db._in_use),
+            idle=len(db._connections),
+            max_connections=db._max_connections,
+        )
+
+
+def note_pool_metrics():
+    s = pool_stats()
+    metrics.set_gauge("dqueue_db_pool_connections", s['in_use'], state="in_use")
+    metrics.set_gauge("dqueue_db_pool_connections", s['idle'], state="idle")
+
 
 class CallbackQueue(peewee.Model):
     database = None
@@ -54,12 +154,40 @@ class TaskWorkerKnowledge(peewee.Model):
 class TaskProperties(peewee.Model):
     database = None
 
-    key = peewee.CharField()
-    user_email =  peewee.CharField()
+    key = peewee.CharField(unique=True)
+    user_email =  peewee.CharField(index=True)
+    factory_name = peewee.CharField(default="unknown", index=True)
     
     class Meta:
         database = db
 
+
+class UserShare(peewee.Model):
+    database = None
+
+    queue = peewee.CharField()
+    user_email = peewee.CharField()
+    last_claimed = peewee.DateTimeField(null=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('queue', 'user_email'), True),
+        )
+
+class RunningCounter(peewee.Model):
+    database = None
+
+    scope = peewee.CharField() # queue or user
+    name = peewee.CharField()
+    n_running = peewee.IntegerField(default=0)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('scope', 'name'), True),
+        )
+
 class TaskEntry(peewee.Model):
     database = None
 
@@ -76,8 +204,72 @@ class TaskEntry(peewee.Model):
 
     update_expected_in_s = peewee.FloatField(default=-1)
 
+    priority = peewee.IntegerField(default=0)
+
+    # failed tasks are retried with a delay: they are not offered before this time
+    not_before = peewee.DateTimeField(null=True, index=True)
+
+    # how many times the task failed, compared to the retry limit without decoding the task
+    n_failed = peewee.IntegerField(default=0, index=True)
+
+    # incremented on every state transition: a worker holding an older version lost its claim
+    version = peewee.IntegerField(default=0)
+
+    # written by state transitions instead of rewriting task_dict_string, which is written once at put:
+    # when set, they take precedence over the same fields of the task
+    execution_info = peewee.TextField(null=True)
+    depends_on = peewee.TextField(null=True)
+
+    # large payloads are kept in the blob store, by hash: then the text fields above are empty
+    task_dict_blob = peewee.CharField(null=True, max_length=64)
+    task_dict_size = peewee.IntegerField(null=True)
+    execution_info_blob = peewee.CharField(null=True, max_length=64)
+    execution_info_size = peewee.IntegerField(null=True)
+
     class Meta:
         database = db
+        indexes = (
+            # offer path: waiting tasks of a queue, most urgent and oldest first
+            (('queue', 'state', 'priority', 'modified'), False),
+        )
+
+
+class ArchivedTaskEntry(peewee.Model):
+    "done and failed tasks moved out of TaskEntry, to keep the offer and summary queries on a small table"
+
+    database = None
+
+    queue = peewee.CharField(default="default")
+
+    key = peewee.CharField(primary_key=True)
+    state = peewee.CharField()
+    worker_id = peewee.CharField()
+
+    task_dict_string = peewee.TextField()
+
+    created = peewee.DateTimeField()
+    modified = peewee.DateTimeField()
+
+    update_expected_in_s = peewee.FloatField(default=-1)
+
+    priority = peewee.IntegerField(default=0)
+    n_failed = peewee.IntegerField(default=0)
+
+    execution_info = peewee.TextField(null=True)
+    depends_on = peewee.TextField(null=True)
+
+    task_dict_blob = peewee.CharField(null=True, max_length=64)
+    task_dict_size = peewee.IntegerField(null=True)
+    execution_info_blob = peewee.CharField(null=True, max_length=64)
+    execution_info_size = peewee.IntegerField(null=True)
+
+    archived = peewee.DateTimeField(index=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('queue', 'state'), False),
+        )
 
 
 class EventLog(peewee.Model):
@@ -89,18 +281,167 @@ class EventLog(peewee.Model):
     worker_id = peewee.CharField()
     worker_state = peewee.CharField(default="unset")
 
-    timestamp = peewee.DateTimeField(default=datetime.datetime.now)
+    timestamp = peewee.DateTimeField(default=datetime.datetime.now, index=True)
     message = peewee.CharField(default="unset")
     
     spent_s = peewee.FloatField(default=0)
 
     class Meta:
         database = db
+        indexes = (
+            # retention and task history
+            (('task_key', 'id'), False),
+        )
+
+
+class EventLogRollup(peewee.Model):
+    "EventLog aggregated in time buckets, per queue, worker and factory name"
+
+    period = peewee.CharField() # minute or hour
+    bucket = peewee.DateTimeField()
+
+    queue = peewee.CharField(default="default")
+    worker_id = peewee.CharField()
+    factory_name = peewee.CharField(default="unknown")
+
+    n_events = peewee.IntegerField(default=0)
+    n_started = peewee.IntegerField(default=0)
+    n_done = peewee.IntegerField(default=0)
+    n_failed = peewee.IntegerField(default=0)
+
+    spent_s_sum = peewee.FloatField(default=0)
+    spent_s_count = peewee.IntegerField(default=0)
+    spent_s_sketch = peewee.TextField(default="{}") # json, counts in logarithmic bins
+
+    last_active = peewee.DateTimeField(null=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('period', 'bucket', 'queue', 'worker_id', 'factory_name'), True),
+        )
+
+
+class RollupWatermark(peewee.Model):
+    "last EventLog id processed by a job over the event log: included in the rollup, scanned by retention"
+
+    name = peewee.CharField(primary_key=True)
+    last_id = peewee.IntegerField(default=0)
+
+    class Meta:
+        database = db
+
+
+class FactIndex(peewee.Model):
+    "datalake buckets of asserted facts: existence is checked here, not in the datalake"
+
+    bucket = peewee.CharField(primary_key=True)
+    format = peewee.CharField(default="json")
+    size = peewee.IntegerField(null=True)
+    asserted = peewee.DateTimeField(index=True)
+
+    class Meta:
+        database = db
+
+
+def n_times_failed_of(entry) -> int:
+    "failures noted in the execution info of a stored task, as it was before TaskEntry.n_failed"
+
+    n = 0
+    for s in entry.execution_info, entry.task_dict_string:
+        try:
+            d = json.loads(s)
+        except (TypeError, ValueError):
+            continue
+
+        if s is entry.task_dict_string:
+            d = d.get('execution_info')
+
+        if isinstance(d, dict):
+            n = max(n, int(d.get('n_times_failed') or 0))
+
+    return n
+
+
+def backfill_n_failed(n_failed_retries: int=n_failed_retries) -> int:
+    """
+    the new column is 0 for existing tasks: failed tasks get the count they had, from the event log and from the task,
+    as forgiving counted it before; failed tasks with no trace of their failures are taken as out of retries,
+    since they may have been exhausted before, and are not forgiven again
+    """
+
+    failed_events = EventLog.select(EventLog.task_key, peewee.fn.COUNT(EventLog.id).alias('n_events'))\
+                            .where(EventLog.task_state == "failed")\
+                            .group_by(EventLog.task_key)
+
+    n_events = {e.task_key: e.n_events for e in failed_events.execute(database=None)}
+
+    entries = TaskEntry.select(TaskEntry.key, TaskEntry.task_dict_string, TaskEntry.execution_info)\
+                       .where((TaskEntry.state == "failed") & (TaskEntry.n_failed == 0))
+
+    n = 0
+    for entry in entries.execute(database=None):
+        n_failed = max(n_events.get(entry.key, 0), n_times_failed_of(entry))
+        if n_failed == 0:
+            n_failed = n_failed_retries
+
+        n += TaskEntry.update({TaskEntry.n_failed: n_failed}).where(TaskEntry.key == entry.key).execute(database=None)
+
+    logger.warning("backfilled n_failed of %d failed tasks", n)
+
+    return n
+
+
+# run once, after the column is added: existing rows get what they would have had
+backfills = {
+        ('taskentry', 'n_failed'): backfill_n_failed,
+    }
+
+
+def migrate_schema(models):
+    """
+    create_tables does not touch tables which already exist: add here columns and indexes 
+    which were introduced since the table was created
+    """
+    from playhouse.migrate import SchemaMigrator, migrate # type: ignore
+
+    migrator = SchemaMigrator.from_database(db)
+
+    for model in models:
+        table = model._meta.table_name
+
+        columns = [c.name for c in db.get_columns(table)]
+        added = []
+        for field in model._meta.sorted_fields:
+            if field.column_name not in columns:
+                logger.warning("adding missing column %s.%s", table, field.column_name)
+                migrate(migrator.add_column(table, field.column_name, field))
+                added.append(field.column_name)
+
+        # once all columns are there: a backfill may read the others
+        for column in added:
+            if (table, column) in backfills:
+                backfills[(table, column)]()
+
+        indexes = [i.name for i in db.get_indexes(table)]
+        for index in model._meta.fields_to_index():
+            if index._name not in indexes:
+                logger.warning("adding missing index %s on %s", index._name, table)
+                db.execute(model._schema._create_index(index, safe=False))
+
+
+models = [TaskEntry, ArchivedTaskEntry, EventLog, TaskWorkerKnowledge, TaskProperties, UserShare, RunningCounter, EventLogRollup, RollupWatermark, CallbackQueue, FactIndex]
 
 try:
-    db.create_tables([TaskEntry, EventLog, TaskWorkerKnowledge, TaskProperties, CallbackQueue])
+    db.create_tables(models)
     has_mysql = True
 except peewee.OperationalError:
     has_mysql = False
 except Exception:
     has_mysql = False
+
+if has_mysql:
+    try:
+        migrate_schema(models)
+    except Exception as e:
+        logger.error("unable to migrate db schema: %s", repr(e))
@@ -24,6 +24,12 @@ def decode_entry_data(entry: TaskEntry) -> TaskDict:
     else:
         try:
             task_dict = json.loads(entry['task_dict_string'])   # type: ignore
+
+            # stored with the state, not in the task
+            for k in 'execution_info', 'depends_on':
+                if entry.get(k) is not None: # type: ignore
+                    task_dict[k] = json.loads(entry[k]) # type: ignore
+
             task_dict['submission_info']['callback_parameters']={} # type: ignore
             for callback in task_dict['submission_info'].get('callbacks', []): # type: ignore
                 if callback is not None:
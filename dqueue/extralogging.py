@@ -1,4 +1,12 @@
+import os
+import time
 import logging
+import threading
+
+from typing import Dict
+
+# per-event log lines of hot paths, e.g. for each logged task event, are emitted at most once per interval
+rate_limit_interval_s = float(os.environ.get('DQUEUE_LOG_RATE_LIMIT_S', '10'))
 
 DEBUG_LEVELV_NUM = 9
 
@@ -10,3 +18,51 @@ def debugv(self, message, *args, **kws):
         self._log(DEBUG_LEVELV_NUM, message, args, **kws)
 
 #logging.Logger.debugv = debugv
+
+
+class Lazy:
+    "argument of a log call, computed only if the record is emitted: logger.info('%s', Lazy(model_to_dict, entry))"
+
+    __slots__ = ('f', 'args', 'value')
+
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+        self.value = None
+
+    def __str__(self):
+        # computed once, however many handlers format the record
+        if self.value is None:
+            self.value = str(self.f(*self.args))
+        return self.value
+
+
+class RateLimited:
+    "logs each kind of event at most once per interval; the number of suppressed events is added to the next one"
+
+    def __init__(self, logger: logging.Logger, interval_s: float=rate_limit_interval_s):
+        self.logger = logger
+        self.interval_s = interval_s
+        self.lock = threading.Lock()
+        self.last = {} # type: Dict[str, float]
+        self.suppressed = {} # type: Dict[str, int]
+
+    def log(self, level: int, kind: str, message: str, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        now = time.time()
+
+        with self.lock:
+            if now - self.last.get(kind, 0) < self.interval_s:
+                self.suppressed[kind] = self.suppressed.get(kind, 0) + 1
+                return
+
+            self.last[kind] = now
+            n_suppressed = self.suppressed.pop(kind, 0)
+
+        if n_suppressed > 0:
+            message += " (and %d similar in the last %.3g s)"
+            args = args + (n_suppressed, self.interval_s)
+
+        self.logger.log(level, message, *args)
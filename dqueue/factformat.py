@@ -0,0 +1,251 @@
+"""
+binary container for data facts: large binary values are stored raw, and read memory-mapped, without copying
+
+    magic (8 bytes) | metadata length (uint64, little endian) | metadata JSON | padding | sections
+
+metadata holds the dag, and the data as JSON, where each binary value is replaced by {"$section": i};
+sections are described in metadata by offset from the start of the first section and size, each aligned to 64 bytes.
+bytes are read back as memoryview, numpy arrays (if numpy is available) as arrays over the mapped file.
+
+JSON facts are converted both ways, and read with the same interface: there, bytes are {"$base64": content},
+arrays {"$array": {"dtype": ..., "shape": ..., "$base64": content}}; plain base64 strings under keys ending
+with _content, as in JSON facts written before, are decoded as bytes.
+"""
+
+import io
+import json
+import mmap
+import base64
+import struct
+import logging
+
+from typing import Any, List, Tuple, Union
+
+try:
+    import numpy # type: ignore
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+magic = b"DQFACT01"
+alignment = 64
+header_size = len(magic) + 8
+
+# convention of legacy JSON facts: base64-encoded files are stored under keys with this suffix
+content_suffix = "_content"
+
+base64_marker = "$base64"
+array_marker = "$array"
+
+
+class NotAContainer(Exception):
+    pass
+
+
+def aligned(n: int) -> int:
+    return (n + alignment - 1) // alignment * alignment
+
+
+def is_container(head: bytes) -> bool:
+    return head[:len(magic)] == magic
+
+
+def split_sections(data) -> Tuple[Any, List[dict], List[memoryview]]:
+    "JSON-able data with binary values replaced by references to sections, descriptions of sections, and their content"
+
+    descriptions = [] # type: List[dict]
+    buffers = [] # type: List[memoryview]
+
+    def add(buffer: memoryview, **description) -> dict:
+        descriptions.append(dict(size=buffer.nbytes, **description))
+        buffers.append(buffer)
+        return {"$section": len(buffers) - 1}
+
+    def walk(d):
+        if isinstance(d, (bytes, bytearray, memoryview)):
+            return add(memoryview(d).cast("B"))
+        if numpy is not None and isinstance(d, numpy.ndarray):
+            a = numpy.ascontiguousarray(d)
+            return add(memoryview(a.reshape(-1).view(numpy.uint8)), dtype=a.dtype.str, shape=list(a.shape))
+        if isinstance(d, dict):
+            return {k: walk(v) for k, v in d.items()}
+        if isinstance(d, (list, tuple)):
+            return [walk(v) for v in d]
+        return d
+
+    return walk(data), descriptions, buffers
+
+
+def write(f, dag, data) -> int:
+    "writes fact to a binary file, sequentially: f does not need to be seekable; returns bytes written"
+
+    json_data, descriptions, buffers = split_sections(data)
+
+    offset = 0
+    for description in descriptions:
+        description['offset'] = offset
+        offset = aligned(offset + description['size'])
+
+    metadata = json.dumps(dict(dag=dag, data=json_data, sections=descriptions), sort_keys=True).encode()
+
+    f.write(magic)
+    f.write(struct.pack("<Q", len(metadata)))
+    f.write(metadata)
+
+    position = header_size + len(metadata)
+    f.write(b"\0" * (aligned(position) - position))
+    position = aligned(position)
+
+    data_start = position
+    for description, buffer in zip(descriptions, buffers):
+        f.write(b"\0" * (data_start + description['offset'] - position))
+        f.write(buffer)
+        position = data_start + description['offset'] + description['size']
+
+    return position
+
+
+def dumps(dag, data) -> bytes:
+    f = io.BytesIO()
+    write(f, dag, data)
+    return f.getvalue()
+
+
+class FactFile:
+    "container read through a memory map: sections are views of the file, valid until it is closed"
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if not is_container(self.mmap[:len(magic)]):
+            self.mmap.close()
+            raise NotAContainer(path)
+
+        metadata_size, = struct.unpack("<Q", self.mmap[len(magic):header_size])
+        metadata = json.loads(self.mmap[header_size:header_size + metadata_size])
+
+        self.dag = metadata['dag']
+        self.sections = metadata['sections']
+        self.data_start = aligned(header_size + metadata_size)
+        self.view = memoryview(self.mmap)
+        self.data = self.resolve(metadata['data'])
+
+    def section(self, i: int):
+        description = self.sections[i]
+
+        start = self.data_start + description['offset']
+        buffer = self.view[start:start + description['size']]
+
+        if 'dtype' in description:
+            if numpy is None:
+                logger.warning("numpy not available: array section %s read as bytes", i)
+                return buffer
+            return numpy.frombuffer(buffer, dtype=description['dtype']).reshape(description['shape'])
+
+        return buffer
+
+    def resolve(self, d):
+        if isinstance(d, dict):
+            if set(d) == {"$section"}:
+                return self.section(d["$section"])
+            return {k: self.resolve(v) for k, v in d.items()}
+        if isinstance(d, list):
+            return [self.resolve(v) for v in d]
+        return d
+
+    def close(self):
+        self.data = None
+
+        try:
+            self.view.release()
+            self.mmap.close()
+        except BufferError:
+            # sections, or arrays over them, are still used: the map is closed when they are gone
+            logger.debug("sections of %s still referenced, not closing", self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JSONFact:
+    "JSON fact read with the interface of FactFile: base64-encoded files become bytes"
+
+    def __init__(self, dag, data):
+        self.dag = dag
+        self.data = from_json_data(data)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def from_json_data(data):
+    "decodes binary values of JSON fact data, marked, or, in legacy facts, base64 strings under _content keys"
+
+    if isinstance(data, dict):
+        if set(data) == {base64_marker}:
+            return base64.b64decode(data[base64_marker])
+        if set(data) == {array_marker}:
+            return decode_array(data[array_marker])
+        return {k: base64.b64decode(v) if k.endswith(content_suffix) and isinstance(v, str) else from_json_data(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [from_json_data(v) for v in data]
+    return data
+
+
+def decode_array(description: dict):
+    content = base64.b64decode(description[base64_marker])
+
+    if numpy is None:
+        logger.warning("numpy not available: array read as bytes")
+        return content
+
+    return numpy.frombuffer(content, dtype=description['dtype']).reshape(description['shape'])
+
+
+def to_json_data(data):
+    "JSON fact data, binary values base64-encoded and marked: for consumers of JSON facts, read back by from_json_data"
+
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return {base64_marker: base64.b64encode(data).decode()}
+    if numpy is not None and isinstance(data, numpy.ndarray):
+        return {array_marker: {
+                    'dtype': data.dtype.str,
+                    'shape': list(data.shape),
+                    base64_marker: base64.b64encode(numpy.ascontiguousarray(data).tobytes()).decode(),
+                }}
+    if isinstance(data, dict):
+        return {k: to_json_data(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_json_data(v) for v in data]
+    return data
+
+
+def load(path: str) -> Union[FactFile, JSONFact]:
+    "container, or JSON fact: package of dag and data, or as served, with dag_json and data_json"
+
+    with open(path, "rb") as f:
+        head = f.read(len(magic))
+
+    if is_container(head):
+        return FactFile(path)
+
+    with open(path) as f:
+        package = json.load(f)
+
+    if 'dag_json' in package:
+        return JSONFact(json.loads(package['dag_json']), json.loads(package['data_json']))
+
+    return JSONFact(package['dag'], package['data'])
@@ -0,0 +1,696 @@
+"""
+data facts stored and restored as raw bytes, streamed in chunks
+
+JSON facts (/data/assert) are built in memory, twice encoded and uploaded whole: for large binary payloads,
+the request body is spooled to a temporary file while it arrives and uploaded from there, so that memory use
+does not depend on the size of the fact. Raw facts share the bucket of the JSON facts of the same dag,
+as object "data.bin", with "data.bin.meta" describing it; a raw fact replaces the JSON fact, "data" and "meta".
+"""
+
+import os
+import io
+import json
+import time
+import datetime
+import hashlib
+import tempfile
+import queue
+import threading
+import logging
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from typing import Iterator, Tuple, Union, List, Dict, Any
+
+import odakb.datalake # type: ignore
+
+import dqueue.metrics as metrics
+import dqueue.factformat as factformat
+from dqueue.database import FactIndex
+from dqueue.perprocess import PerProcess
+
+logger = logging.getLogger(__name__)
+
+chunk_size = int(os.environ.get('DQUEUE_FACTS_CHUNK_SIZE', str(1024*1024)))
+
+# spooled request bodies are kept in memory up to this size, larger ones go to disk
+spool_max_memory = int(os.environ.get('DQUEUE_FACTS_SPOOL_MAX_MEMORY', str(8*1024*1024)))
+
+# restored JSON facts are kept in memory of each server process, up to this size in total; 0 disables
+restored_max_mb = float(os.environ.get('DQUEUE_FACTS_RESTORED_MAX_MB', '256'))
+
+# bloom filter of known fact buckets, in each server process: 8 Mbit hold a million buckets with ~2% false positives
+bloom_bits = int(os.environ.get('DQUEUE_FACTS_BLOOM_BITS', str(8*1024*1024)))
+bloom_hashes = int(os.environ.get('DQUEUE_FACTS_BLOOM_HASHES', '6'))
+
+# facts asserted by other processes are seen by the filter with this margin, for transactions committed late
+index_refresh_margin_s = float(os.environ.get('DQUEUE_FACTS_INDEX_REFRESH_MARGIN_S', '60'))
+
+# facts restored concurrently for batch consults, in each server process
+consult_threads = int(os.environ.get('DQUEUE_FACTS_CONSULT_THREADS', '8'))
+
+# asserted JSON facts are written here and uploaded in background; empty uploads them within the request
+spool_dir = os.environ.get('DQUEUE_FACTS_SPOOL_DIR', '')
+upload_threads = int(os.environ.get('DQUEUE_FACTS_UPLOAD_THREADS', '2'))
+upload_backoff_s = float(os.environ.get('DQUEUE_FACTS_UPLOAD_BACKOFF_S', '5'))
+upload_backoff_max_s = float(os.environ.get('DQUEUE_FACTS_UPLOAD_BACKOFF_MAX_S', '600'))
+# facts failing this many uploads are parked in the dead-letter directory of the spool, and still served from there
+upload_max_attempts = int(os.environ.get('DQUEUE_FACTS_UPLOAD_MAX_ATTEMPTS', '20'))
+
+raw_object_name = "data.bin"
+raw_meta_object_name = "data.bin.meta"
+
+# objects of JSON facts, as odakb.datalake.store writes them; raw facts written before had their meta in "meta" too
+json_object_names = ["data", "meta"]
+legacy_meta_object_name = "meta"
+
+
+class FactNotFound(Exception):
+    pass
+
+
+def fact_bucket(dag) -> str:
+    return "odahub-" + odakb.datalake.form_bucket_name(dag)
+
+
+class RestoredFacts(PerProcess):
+    """
+    least recently used restored facts, as served: serialized dag and data.
+    Facts of a dag do not change once asserted, except if asserted again: then they are dropped here,
+    in this process; other processes may serve the previous fact until it is evicted
+    """
+
+    def __init__(self, max_mb: float=restored_max_mb):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.init_per_process()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.facts = OrderedDict() # type: OrderedDict
+        self.size = 0
+
+    def get(self, bucket: str) -> Union[dict, None]:
+        with self.lock:
+            fact = self.facts.get(bucket)
+
+            if fact is not None:
+                self.facts.move_to_end(bucket)
+
+            return fact
+
+    def put(self, bucket: str, fact: dict):
+        size = len(fact['dag_json']) + len(fact['data_json'])
+
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            self.drop_locked(bucket)
+
+            self.facts[bucket] = fact
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self.drop_locked(next(iter(self.facts)))
+
+    def drop(self, bucket: str):
+        with self.lock:
+            self.drop_locked(bucket)
+
+    def drop_locked(self, bucket: str):
+        fact = self.facts.pop(bucket, None)
+        if fact is not None:
+            self.size -= len(fact['dag_json']) + len(fact['data_json'])
+
+
+restored = RestoredFacts()
+
+
+class BloomFilter:
+    def __init__(self, n_bits: int=bloom_bits, n_hashes: int=bloom_hashes):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.bits = bytearray((n_bits + 7) // 8)
+
+    def positions(self, item: str) -> List[int]:
+        d = hashlib.sha256(item.encode()).digest()
+        h1 = int.from_bytes(d[:8], 'little')
+        h2 = int.from_bytes(d[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, item: str):
+        for p in self.positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(item))
+
+
+class KnownFacts(PerProcess):
+    """
+    buckets of asserted facts: FactIndex table, with a Bloom filter of it in each process.
+    Before answering, the filter takes in what was asserted since it was last refreshed, so that
+    a bucket not in the filter is not known, without asking the table; buckets in the filter are confirmed in the table
+    """
+
+    def __init__(self):
+        self.init_per_process()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.bloom = None # type: Union[BloomFilter, None]
+        self.last_asserted = None # type: Union[datetime.datetime, None]
+
+    def refresh(self):
+        with self.lock:
+            if self.bloom is None:
+                bloom = BloomFilter()
+                q = FactIndex.select(FactIndex.bucket, FactIndex.asserted)
+            else:
+                bloom = self.bloom
+                q = FactIndex.select(FactIndex.bucket, FactIndex.asserted)\
+                              .where(FactIndex.asserted >= self.last_asserted - datetime.timedelta(seconds=index_refresh_margin_s))
+
+            last_asserted = self.last_asserted
+
+            for r in q.execute(database=None):
+                bloom.add(r.bucket)
+                if last_asserted is None or r.asserted > last_asserted:
+                    last_asserted = r.asserted
+
+            self.bloom = bloom
+            self.last_asserted = last_asserted or datetime.datetime.now()
+
+    def note(self, bucket: str, format: str="json", size: Union[int, None]=None, asserted: Union[datetime.datetime, None]=None):
+        FactIndex.insert(
+                    bucket=bucket,
+                    format=format,
+                    size=size,
+                    asserted=asserted or datetime.datetime.now(),
+                ).on_conflict_replace().execute(database=None)
+
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(bucket)
+
+    def forget(self, bucket: str):
+        # stays in the filters, but is not confirmed anymore
+        FactIndex.delete().where(FactIndex.bucket == bucket).execute(database=None)
+
+    def known(self, buckets: List[str]) -> Dict[str, bool]:
+        self.refresh()
+
+        candidates = [b for b in set(buckets) if b in self.bloom]
+
+        confirmed = set() # type: set
+        if len(candidates) > 0:
+            confirmed = set(r.bucket for r in FactIndex.select(FactIndex.bucket).where(FactIndex.bucket << candidates).execute(database=None))
+
+        metrics.inc("dqueue_facts_exists_total", len(set(buckets)) - len(candidates), answer="filtered")
+        metrics.inc("dqueue_facts_exists_total", len(confirmed), answer="confirmed")
+        metrics.inc("dqueue_facts_exists_total", len(candidates) - len(confirmed), answer="false_positive")
+
+        return {b: b in confirmed for b in buckets}
+
+
+known = KnownFacts()
+
+
+class FactSpool(PerProcess):
+    """
+    asserted facts waiting for upload to the datalake, one file per bucket, written durably before the assert returns.
+    A bucket asserted again before upload is uploaded once, with the last content.
+    An upload first claims the file, moving it to a directory of the uploading process, so that processes sharing
+    the spool do not upload it twice. Uploads are retried with exponential backoff, up to upload_max_attempts,
+    and then parked in the dead-letter directory.
+    Facts left by previous processes, pending or claimed by a process which is gone, are picked up on first use
+    """
+
+    dead_letter_dir = "dead"
+    claimed_dir_prefix = "uploading-"
+
+    def __init__(self, directory: str=spool_dir, n_threads: int=upload_threads, max_attempts: int=upload_max_attempts):
+        self.directory = directory
+        self.n_threads = n_threads
+        self.max_attempts = max_attempts
+        self.init_per_process()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.queue = queue.Queue() # type: queue.Queue
+        self.queued = set() # type: set
+        self.started = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory != ''
+
+    def path(self, bucket: str) -> str:
+        return os.path.join(self.directory, bucket + ".json")
+
+    def claimed_path(self, bucket: str, pid: Union[int, None]=None) -> str:
+        if pid is None:
+            pid = os.getpid()
+        return os.path.join(self.directory, f"{self.claimed_dir_prefix}{pid}", bucket + ".json")
+
+    def dead_letter_path(self, bucket: str) -> str:
+        return os.path.join(self.directory, self.dead_letter_dir, bucket + ".json")
+
+    def claimed_pids(self) -> List[int]:
+        try:
+            return [int(fn[len(self.claimed_dir_prefix):]) for fn in os.listdir(self.directory)
+                    if fn.startswith(self.claimed_dir_prefix) and fn[len(self.claimed_dir_prefix):].isdigit()]
+        except FileNotFoundError:
+            return []
+
+    def put(self, bucket: str, package_json: str):
+        os.makedirs(self.directory, exist_ok=True)
+
+        fd, tmp_fn = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(package_json.encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_fn, self.path(bucket))
+
+        # the rename itself
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        self.enqueue(bucket)
+
+    def get(self, bucket: str) -> Union[dict, None]:
+        "package of the fact, if not uploaded yet: the last asserted, then one being uploaded, then one given up"
+
+        if not self.enabled:
+            return None
+
+        # also picks up what previous processes left
+        self.start()
+
+        candidates = [self.path(bucket)] + \
+                     [self.claimed_path(bucket, pid) for pid in self.claimed_pids()] + \
+                     [self.dead_letter_path(bucket)]
+
+        for fn in candidates:
+            try:
+                with open(fn) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                pass
+
+        return None
+
+    def pending(self) -> List[str]:
+        try:
+            return [fn[:-len(".json")] for fn in os.listdir(self.directory) if fn.endswith(".json") and not fn.startswith(".")]
+        except FileNotFoundError:
+            return []
+
+    def recover_orphans(self):
+        "facts claimed by processes which are gone are returned to the spool, unless asserted again since"
+
+        for pid in self.claimed_pids():
+            if pid == os.getpid() or process_alive(pid):
+                continue
+
+            claimed_dir = os.path.dirname(self.claimed_path("", pid))
+
+            for fn in os.listdir(claimed_dir):
+                if not fn.endswith(".json"):
+                    continue
+
+                bucket = fn[:-len(".json")]
+                if os.path.exists(self.path(bucket)):
+                    os.remove(os.path.join(claimed_dir, fn))
+                else:
+                    os.replace(os.path.join(claimed_dir, fn), self.path(bucket))
+                logger.warning("recovered spooled fact %s claimed by gone process %s", bucket, pid)
+
+            try:
+                os.rmdir(claimed_dir)
+            except OSError:
+                pass
+
+    def start(self):
+        "uploader threads are started on first use"
+
+        with self.lock:
+            if self.started:
+                return
+
+            self.started = True
+
+            for i in range(self.n_threads):
+                threading.Thread(target=self.upload_loop, daemon=True, name=f"facts-upload-{i}").start()
+
+        try:
+            self.recover_orphans()
+        except Exception as e:
+            logger.error("unable to recover spooled facts of gone processes: %s", e)
+
+        for bucket in self.pending():
+            self.enqueue(bucket)
+
+    def enqueue(self, bucket: str, attempt: int=0):
+        self.start()
+
+        with self.lock:
+            if bucket in self.queued:
+                return
+            self.queued.add(bucket)
+
+        self.queue.put((bucket, attempt))
+
+    def upload_loop(self):
+        while True:
+            bucket, attempt = self.queue.get()
+
+            with self.lock:
+                self.queued.discard(bucket)
+
+            self.upload(bucket, attempt)
+
+    def claim(self, bucket: str) -> Union[str, None]:
+        "moves the last asserted content to this process; retries keep what this process claimed before"
+
+        fn = self.claimed_path(bucket)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+        try:
+            os.replace(self.path(bucket), fn)
+        except FileNotFoundError:
+            if not os.path.exists(fn):
+                return None
+
+        return fn
+
+    def upload(self, bucket: str, attempt: int=0) -> bool:
+        fn = self.claim(bucket)
+        if fn is None:
+            logger.debug("spooled fact %s already uploaded, or claimed by another process", bucket)
+            return True
+
+        try:
+            st = os.stat(fn)
+            with open(fn) as f:
+                package = json.load(f)
+        except FileNotFoundError:
+            logger.debug("spooled fact %s already uploaded", bucket)
+            return True
+
+        try:
+            odakb.datalake.store(package, bucket_name=bucket)
+        except Exception as e:
+            if attempt + 1 >= self.max_attempts:
+                os.makedirs(os.path.dirname(self.dead_letter_path(bucket)), exist_ok=True)
+                os.replace(fn, self.dead_letter_path(bucket))
+                logger.error("giving up upload of spooled fact %s after %s attempts, left in %s: %s",
+                             bucket, attempt + 1, self.dead_letter_path(bucket), e)
+                metrics.inc("dqueue_facts_uploads_total", outcome="dead")
+                return False
+
+            delay = min(upload_backoff_s * 2**attempt, upload_backoff_max_s)
+            logger.warning("unable to upload spooled fact %s, attempt %s, will retry in %.1f s: %s", bucket, attempt, delay, e)
+            metrics.inc("dqueue_facts_uploads_total", outcome="retry")
+
+            timer = threading.Timer(delay, self.enqueue, args=(bucket, attempt + 1))
+            timer.daemon = True
+            timer.start()
+            return False
+
+        # unless claimed again meanwhile, asserted again: then it is uploaded again
+        st_now = os.stat(fn) if os.path.exists(fn) else None
+        if st_now is not None and (st_now.st_ino, st_now.st_mtime_ns) == (st.st_ino, st.st_mtime_ns):
+            os.remove(fn)
+
+        # an earlier content given up is superseded
+        if os.path.exists(self.dead_letter_path(bucket)):
+            os.remove(self.dead_letter_path(bucket))
+
+        metrics.inc("dqueue_facts_uploads_total", outcome="ok")
+        logger.info("uploaded spooled fact %s after %s failed attempts", bucket, attempt)
+
+        return True
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+upload_spool = FactSpool()
+
+
+def spooled(bucket: str) -> Union[dict, None]:
+    "JSON fact as served, if it is not uploaded yet"
+
+    package = upload_spool.get(bucket)
+    if package is None:
+        return None
+
+    return dict(
+            dag_json=json.dumps(package['dag'], sort_keys=True),
+            data_json=json.dumps(package['data'], sort_keys=True),
+        )
+
+
+def restore(dag, bucket: Union[str, None]=None) -> dict:
+    "JSON fact as served, serialized dag and data; from the spool if not uploaded yet, from memory if restored recently"
+
+    if bucket is None:
+        bucket = fact_bucket(dag)
+
+    fact = spooled(bucket)
+    if fact is not None:
+        return fact
+
+    fact = restored.get(bucket)
+    metrics.inc("dqueue_facts_restored_total", cache="miss" if fact is None else "hit")
+
+    if fact is None:
+        meta, payload = odakb.datalake.restore(bucket, return_metadata=True)
+
+        if payload['dag'] != dag:
+            raise RuntimeError(f"fact in {bucket} is for another dag")
+
+        fact = dict(
+                dag_json=json.dumps(payload['dag'], sort_keys=True),
+                data_json=json.dumps(payload['data'], sort_keys=True),
+            )
+
+        restored.put(bucket, fact)
+
+    return fact
+
+
+_executor = None # type: Union[ThreadPoolExecutor, None]
+_executor_pid = None # type: Union[int, None]
+
+
+def get_executor() -> ThreadPoolExecutor:
+    "shared by all requests of the process, so that it bounds datalake concurrency of the process"
+
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=consult_threads, thread_name_prefix="consult-facts")
+        _executor_pid = os.getpid()
+
+    return _executor
+
+
+def consult_many(dags: list) -> Iterator[Dict[str, Any]]:
+    """
+    facts of many dags, as they are restored, concurrently: each with index of its dag;
+    dags without known facts are answered first, without reaching the datalake.
+    The index is checked right away, restoring is started when answers are iterated
+    """
+
+    buckets = [fact_bucket(dag) for dag in dags]
+
+    known_buckets = known.known(buckets)
+
+    def answers():
+        futures = {}
+        for i, (dag, bucket) in enumerate(zip(dags, buckets)):
+            if known_buckets[bucket]:
+                futures[get_executor().submit(restore, dag, bucket)] = i
+            else:
+                yield dict(index=i, found=False)
+
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                yield dict(index=i, found=True, **future.result())
+            except Exception as e:
+                logger.warning("unable to restore fact %s of batch: %s", buckets[i], e)
+                yield dict(index=i, found=False, error=repr(e))
+
+    return answers()
+
+
+def index_datalake(client=None) -> int:
+    "notes fact buckets found in the datalake, e.g. asserted before there was an index"
+
+    if client is None:
+        client = odakb.datalake.get_minio()
+
+    N = 0
+    for bucket in client.list_buckets():
+        if bucket.name.startswith("odahub-b-"):
+            known.note(bucket.name, format="unknown", asserted=bucket.creation_date.replace(tzinfo=None))
+            N += 1
+
+    logger.info("indexed %s fact buckets from datalake", N)
+
+    return N
+
+
+def spool(stream, chunk_size: int=chunk_size) -> Tuple[tempfile.SpooledTemporaryFile, int, str]:
+    "copies stream to a temporary file, chunk by chunk, returns it rewound, with size and sha256"
+
+    f = tempfile.SpooledTemporaryFile(max_size=spool_max_memory)
+    h = hashlib.sha256()
+    size = 0
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+
+        f.write(chunk)
+        h.update(chunk)
+        size += len(chunk)
+
+    f.seek(0)
+
+    return f, size, h.hexdigest()
+
+
+def store_stream(dag, stream, client=None) -> dict:
+    "stores raw fact read from stream, without keeping it in memory"
+
+    if client is None:
+        client = odakb.datalake.get_minio()
+
+    bucket = fact_bucket(dag)
+
+    t0 = time.time()
+
+    f, size, sha256 = spool(stream)
+
+    t_spooled = time.time()
+
+    # raw bytes, or the binary fact container
+    fmt = "container" if factformat.is_container(f.read(len(factformat.magic))) else "raw"
+    f.seek(0)
+
+    try:
+        if not client.bucket_exists(bucket):
+            client.make_bucket(bucket)
+
+        # minio uploads large objects in parts, reading from the file
+        client.put_object(bucket, raw_object_name, f, size, content_type="application/octet-stream")
+
+        meta = json.dumps(dict(dag=dag, format=fmt, size=size, sha256=sha256)).encode()
+        client.put_object(bucket, raw_meta_object_name, io.BytesIO(meta), len(meta), content_type="application/json")
+
+        # the JSON fact of the same dag, if any, is replaced: it would be served instead otherwise
+        for object_name in json_object_names:
+            client.remove_object(bucket, object_name)
+    finally:
+        f.close()
+
+    restored.drop(bucket)
+    known.note(bucket, format=fmt, size=size)
+
+    report = dict(
+            bucket=bucket,
+            format=fmt,
+            size=size,
+            sha256=sha256,
+            spool_s=t_spooled - t0,
+            upload_s=time.time() - t_spooled,
+        )
+
+    logger.info("stored raw fact: %s", report)
+
+    return report
+
+
+def raw_meta(dag, client=None) -> Union[dict, None]:
+    "meta of the raw fact for dag, None if there is none"
+
+    if client is None:
+        client = odakb.datalake.get_minio()
+
+    bucket = fact_bucket(dag)
+
+    try:
+        client.stat_object(bucket, raw_object_name)
+    except Exception as e:
+        logger.debug("no raw fact in %s: %s", bucket, e)
+        return None
+
+    for object_name in raw_meta_object_name, legacy_meta_object_name:
+        try:
+            meta = client.get_object(bucket, object_name)
+            try:
+                return json.loads(meta.read())
+            finally:
+                meta.close()
+                meta.release_conn()
+        except Exception as e:
+            logger.debug("no raw fact meta %s in %s: %s", object_name, bucket, e)
+
+    return None
+
+
+def restore_container_as_json(dag, client=None) -> dict:
+    "JSON fact as served, for consumers of JSON facts, from a fact stored as binary container"
+
+    if client is None:
+        client = odakb.datalake.get_minio()
+
+    with tempfile.NamedTemporaryFile(suffix=".dqfact") as f:
+        client.fget_object(fact_bucket(dag), raw_object_name, f.name)
+
+        with factformat.FactFile(f.name) as fact:
+            return dict(
+                    dag_json=json.dumps(fact.dag, sort_keys=True),
+                    data_json=json.dumps(factformat.to_json_data(fact.data), sort_keys=True),
+                )
+
+
+def open_stream(dag, client=None, chunk_size: int=chunk_size) -> Tuple[dict, Iterator[bytes]]:
+    "meta and chunks of the raw fact for dag"
+
+    if client is None:
+        client = odakb.datalake.get_minio()
+
+    meta = raw_meta(dag, client=client)
+    if meta is None:
+        raise FactNotFound(fact_bucket(dag))
+
+    r = client.get_object(fact_bucket(dag), raw_object_name)
+
+    def chunks():
+        try:
+            for chunk in r.stream(chunk_size):
+                yield chunk
+        finally:
+            r.close()
+            r.release_conn()
+
+    return meta, chunks()
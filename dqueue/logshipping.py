@@ -0,0 +1,205 @@
+"""
+logstash shipping off the request path: messages are queued in memory and sent in batches by a background thread
+
+the queue is bounded: when logstash is slow or down, the oldest messages are dropped and counted, offers are not delayed;
+messages are sent as pylogstash sends them, one JSON document per connection, or, with DQUEUE_LOGSTASH_JSON_LINES=yes,
+a batch per connection as newline-delimited JSON, for inputs with the json_lines codec
+"""
+
+import os
+import json
+import time
+import atexit
+import socket
+import threading
+import logging
+
+from collections import deque
+from typing import List, Optional
+
+import pylogstash # type: ignore
+
+import dqueue.metrics as metrics
+from dqueue.perprocess import PerProcess
+
+logger = logging.getLogger(__name__)
+
+# no means each message is sent in the calling thread, as before
+async_enabled = os.environ.get('DQUEUE_LOGSTASH_ASYNC', 'yes') == 'yes'
+max_queued = int(os.environ.get('DQUEUE_LOGSTASH_MAX_QUEUED', '10000'))
+batch_size = int(os.environ.get('DQUEUE_LOGSTASH_BATCH_SIZE', '100'))
+flush_interval_s = float(os.environ.get('DQUEUE_LOGSTASH_FLUSH_INTERVAL_S', '1'))
+timeout_s = float(os.environ.get('DQUEUE_LOGSTASH_TIMEOUT_S', '2'))
+json_lines = os.environ.get('DQUEUE_LOGSTASH_JSON_LINES', 'no') == 'yes'
+
+# time to deliver what is queued when the process exits
+exit_flush_s = float(os.environ.get('DQUEUE_LOGSTASH_EXIT_FLUSH_S', '2'))
+
+
+class AsyncLogStasher(PerProcess):
+    "log(msg) as pylogstash.LogStasher, which finds the logstash entrypoint; sending is left to a background thread"
+
+    def __init__(self, url: str=None, sep: str="/", max_queued: int=max_queued, batch_size: int=batch_size,
+                 flush_interval_s: float=flush_interval_s, timeout_s: float=timeout_s, json_lines: bool=json_lines,
+                 async_enabled: bool=async_enabled):
+        try:
+            self.stasher = pylogstash.LogStasher(url, sep=sep)
+        except TypeError:
+            # older pylogstash
+            self.stasher = pylogstash.LogStasher(url)
+
+        self.url = getattr(self.stasher, 'url', None) # type: Optional[str]
+        self.sep = getattr(self.stasher, 'sep', sep)
+        self.context = {} # type: dict
+
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.timeout_s = timeout_s
+        self.json_lines = json_lines
+        self.async_enabled = async_enabled
+
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_failed = 0
+
+        self.init_per_process()
+
+        atexit.register(self.flush, exit_flush_s)
+
+    def __repr__(self):
+        return f"[{self.__class__.__name__}: {self.url}, {len(self.queue)} queued]"
+
+    def reset(self):
+        self.lock = threading.Condition()
+        self.queue = deque() # type: deque
+        self.thread = None # type: Optional[threading.Thread]
+
+    def set_context(self, c: dict):
+        self.context = c
+
+    def log(self, msg):
+        if not self.async_enabled:
+            self.send([msg])
+            return
+
+        self.enqueue(msg)
+        self.start()
+
+    def enqueue(self, msg) -> bool:
+        "queues the message, dropping the oldest if full; False if something was dropped"
+
+        if isinstance(msg, dict):
+            # the caller may reuse the dict
+            msg = dict(msg)
+
+        with self.lock:
+            dropped = len(self.queue) >= self.max_queued
+            if dropped:
+                self.queue.popleft()
+                self.n_dropped += 1
+
+            self.queue.append(msg)
+
+            if len(self.queue) >= self.batch_size:
+                self.lock.notify()
+
+        if dropped:
+            metrics.inc("dqueue_logstash_messages_total", outcome="dropped")
+
+        return not dropped
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.send_loop, daemon=True, name="logstash-send")
+                self.thread.start()
+
+    def take_batch(self) -> List:
+        with self.lock:
+            n = min(self.batch_size, len(self.queue))
+            return [self.queue.popleft() for i in range(n)]
+
+    def send_loop(self):
+        while True:
+            with self.lock:
+                if len(self.queue) < self.batch_size:
+                    self.lock.wait(self.flush_interval_s)
+
+            batch = self.take_batch()
+            if len(batch) == 0:
+                continue
+
+            if not self.send(batch):
+                # logstash is unavailable: wait before the next attempt, meanwhile the oldest are dropped if need be
+                time.sleep(self.flush_interval_s)
+
+    def flush(self, timeout_s: float=None) -> int:
+        "sends what is queued, in the calling thread; returns the number of messages sent"
+
+        deadline = None if timeout_s is None else time.time() + timeout_s
+
+        n = 0
+        while deadline is None or time.time() < deadline:
+            batch = self.take_batch()
+            if len(batch) == 0:
+                break
+            if self.send(batch):
+                n += len(batch)
+
+        return n
+
+    def encode(self, msg) -> bytes:
+        if isinstance(msg, str):
+            return msg.encode()
+        elif isinstance(msg, dict):
+            return json.dumps(pylogstash.flatten({**self.context, **msg}, sep=self.sep)).encode()
+        else:
+            raise RuntimeError(f"unknown type of message: {type(msg)}")
+
+    def send(self, batch: List) -> bool:
+        payloads = []
+        for msg in batch:
+            try:
+                payloads.append(self.encode(msg))
+            except Exception as e:
+                logger.warning("unable to encode message for logstash: %s", e)
+
+        n_sent = 0
+        try:
+            if self.url is None:
+                for payload in payloads:
+                    logger.debug("logstash fallback: %s", payload)
+                n_sent = len(payloads)
+            elif self.json_lines:
+                self.send_payload(b"".join(payload + b"\n" for payload in payloads))
+                n_sent = len(payloads)
+            else:
+                for payload in payloads:
+                    self.send_payload(payload)
+                    n_sent += 1
+            ok = True
+        except OSError as e:
+            n_failed = len(payloads) - n_sent
+            self.n_failed += n_failed
+            metrics.inc("dqueue_logstash_messages_total", n_failed, outcome="failed")
+            logger.warning("unable to send %d messages to logstash %s: %s", n_failed, self.url, e)
+            ok = False
+
+        if n_sent > 0:
+            self.n_sent += n_sent
+            metrics.inc("dqueue_logstash_messages_total", n_sent, outcome="sent")
+
+        return ok
+
+    def send_payload(self, payload: bytes):
+        host, port = self.url.rsplit(":", 1)
+
+        with socket.create_connection((host, int(port)), timeout=self.timeout_s) as sock:
+            sock.sendall(payload)
+
+    def stats(self) -> dict:
+        return dict(queued=len(self.queue), sent=self.n_sent, dropped=self.n_dropped, failed=self.n_failed)
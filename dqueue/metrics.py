@@ -0,0 +1,331 @@
+"""
+in-process metrics: counters and latency histograms, exposed in prometheus text format
+
+each process (e.g. gunicorn worker) keeps own values and a background thread periodically writes them to a file
+in DQUEUE_METRICS_DIR; exposition merges the files of all processes; counters of exited processes are merged into
+one file, so that counters do not go back when a worker is restarted: the directory should be emptied when the whole
+service starts
+"""
+
+import os
+import json
+import fcntl
+import time
+import atexit
+import tempfile
+import threading
+import functools
+import logging
+
+from typing import Dict, Tuple, Union
+
+from dqueue.perprocess import PerProcess
+
+logger = logging.getLogger(__name__)
+
+metrics_enabled = os.environ.get('DQUEUE_METRICS', 'yes') == 'yes'
+metrics_dir = os.environ.get('DQUEUE_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'dqueue-metrics'))
+flush_interval_s = float(os.environ.get('DQUEUE_METRICS_FLUSH_INTERVAL_S', '1'))
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def labels_key(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry(PerProcess):
+    def __init__(self, buckets=default_buckets, directory: str=None):
+        self.buckets = buckets
+        self.directory = directory or metrics_dir
+        self.descriptions = {} # type: Dict[str, str]
+        self.init_per_process()
+
+    def reset(self):
+        "a forked process counts from zero, into own file: what the parent counted stays in the file of the parent"
+
+        self.lock = threading.Lock()
+        self.counters = {} # type: Dict[Tuple[str, Labels], float]
+        self.histograms = {} # type: Dict[Tuple[str, Labels], list]
+        self.gauges = {} # type: Dict[Tuple[str, Labels], float]
+        self.flusher = None # type: Union[threading.Thread, None]
+
+    def describe(self, name: str, description: str):
+        self.descriptions[name] = description
+
+    def inc(self, name: str, value: float=1, **labels):
+        k = (name, labels_key(labels))
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+        self.start_flusher()
+
+    def set(self, name: str, value: float, **labels):
+        k = (name, labels_key(labels))
+        with self.lock:
+            self.gauges[k] = value
+        self.start_flusher()
+
+    def observe(self, name: str, value: float, **labels):
+        k = (name, labels_key(labels))
+        with self.lock:
+            h = self.histograms.get(k)
+            if h is None:
+                # bucket counts, then +Inf, sum, count
+                h = self.histograms[k] = [0] * (len(self.buckets) + 1) + [0., 0]
+
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    h[i] += 1
+                    break
+            else:
+                h[len(self.buckets)] += 1
+
+            h[-2] += value
+            h[-1] += 1
+        self.start_flusher()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(
+                    buckets=list(self.buckets),
+                    counters=[[name, list(labels), v] for (name, labels), v in self.counters.items()],
+                    histograms=[[name, list(labels), list(h)] for (name, labels), h in self.histograms.items()],
+                    gauges=[[name, list(labels), v] for (name, labels), v in self.gauges.items()],
+                )
+
+    @property
+    def filename(self) -> str:
+        return os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+
+    @property
+    def exited_filename(self) -> str:
+        return os.path.join(self.directory, "metrics-exited.json")
+
+    def flush(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_snapshot(self.filename, self.snapshot())
+        except Exception as e:
+            logger.warning("unable to write metrics to %s: %s", self.directory, e)
+
+    def start_flusher(self):
+        "the flusher thread is started on first use"
+
+        if self.flusher is not None:
+            return
+
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self.flush_loop, daemon=True, name="metrics-flush")
+
+        self.flusher.start()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(flush_interval_s)
+            self.flush()
+
+    def prune_exited(self):
+        "counters and histograms of exited processes are added to one file, and their own files removed"
+
+        with open(os.path.join(self.directory, ".exited.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            exited = [os.path.join(self.directory, fn) for fn in os.listdir(self.directory)
+                      if fn.startswith("metrics-") and fn.endswith(".json") and fn[len("metrics-"):-len(".json")].isdigit()]
+            exited = [fn for fn in exited if not process_alive(fn)]
+
+            if len(exited) == 0:
+                return
+
+            filenames = exited
+            if os.path.exists(self.exited_filename):
+                filenames = [self.exited_filename] + exited
+
+            merged = merge_snapshots(filenames, self.buckets)
+            write_snapshot(self.exited_filename, dict(
+                    buckets=list(self.buckets),
+                    counters=[[name, list(labels), v] for (name, labels), v in merged['counters'].items()],
+                    histograms=[[name, list(labels), h] for (name, labels), h in merged['histograms'].items()],
+                    gauges=[],
+                ))
+
+            for fn in exited:
+                os.remove(fn)
+
+            logger.info("merged metrics of %s exited processes", len(exited))
+
+    def collect(self) -> dict:
+        "merges metrics of all processes"
+
+        self.flush()
+
+        try:
+            self.prune_exited()
+        except Exception as e:
+            logger.warning("unable to merge metrics of exited processes in %s: %s", self.directory, e)
+
+        try:
+            filenames = [os.path.join(self.directory, fn) for fn in os.listdir(self.directory) if fn.startswith("metrics-") and fn.endswith(".json")]
+        except FileNotFoundError:
+            filenames = []
+
+        return merge_snapshots(filenames, self.buckets)
+
+    def exposition(self) -> str:
+        "text exposition format, https://prometheus.io/docs/instrumenting/exposition_formats/"
+
+        collected = self.collect()
+
+        def format_labels(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            if len(labels) == 0:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + "}"
+
+        lines = []
+
+        for kind, metrics in ("counter", collected['counters']), ("gauge", collected['gauges']), ("histogram", collected['histograms']):
+            for name in sorted(set(name for name, _ in metrics)):
+                if name in self.descriptions:
+                    lines.append(f"# HELP {name} {self.descriptions[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+                for (n, labels), v in sorted(metrics.items()):
+                    if n != name:
+                        continue
+
+                    if kind in ("counter", "gauge"):
+                        lines.append(f"{name}{format_labels(labels)} {v}")
+                    else:
+                        cumulative = 0
+                        for b, c in zip(self.buckets, v):
+                            cumulative += c
+                            lines.append(f"{name}_bucket{format_labels(labels, le=b)} {cumulative}")
+                        cumulative += v[len(self.buckets)]
+                        lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {cumulative}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {v[-2]}")
+                        lines.append(f"{name}_count{format_labels(labels)} {v[-1]}")
+
+        return "\n".join(lines) + "\n"
+
+
+def write_snapshot(filename: str, snapshot: dict):
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_fn, filename)
+    except Exception:
+        os.remove(tmp_fn)
+        raise
+
+
+def merge_snapshots(filenames, buckets) -> dict:
+    counters = {} # type: Dict[Tuple[str, Labels], float]
+    histograms = {} # type: Dict[Tuple[str, Labels], list]
+    gauges = {} # type: Dict[Tuple[str, Labels], float]
+
+    for fn in filenames:
+        try:
+            with open(fn) as f:
+                snapshot = json.load(f)
+        except Exception as e:
+            logger.warning("unable to read metrics from %s: %s", fn, e)
+            continue
+
+        if tuple(snapshot['buckets']) != tuple(buckets):
+            logger.warning("metrics in %s have different buckets, skipping", fn)
+            continue
+
+        for name, labels, v in snapshot['counters']:
+            k = (name, tuple(tuple(l) for l in labels))
+            counters[k] = counters.get(k, 0) + v
+
+        for name, labels, h in snapshot['histograms']:
+            k = (name, tuple(tuple(l) for l in labels))
+            if k in histograms:
+                histograms[k] = [a + b for a, b in zip(histograms[k], h)]
+            else:
+                histograms[k] = h
+
+        # gauges describe current state: exited processes do not count
+        if process_alive(fn):
+            for name, labels, v in snapshot.get('gauges', []):
+                k = (name, tuple(tuple(l) for l in labels))
+                gauges[k] = gauges.get(k, 0) + v
+
+    return dict(counters=counters, histograms=histograms, gauges=gauges)
+
+
+def process_alive(filename: str) -> bool:
+    try:
+        pid = int(os.path.basename(filename)[len("metrics-"):-len(".json")])
+        os.kill(pid, 0)
+        return True
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+
+
+registry = Registry()
+
+atexit.register(registry.flush)
+
+
+def inc(name: str, value: float=1, **labels):
+    if metrics_enabled:
+        registry.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    if metrics_enabled:
+        registry.observe(name, value, **labels)
+
+
+def set_gauge(name: str, value: float, **labels):
+    if metrics_enabled:
+        registry.set(name, value, **labels)
+
+
+def timed(name: str, **labels):
+    "decorator, observes duration of the call in histogram name, labeled with the outcome: ok or exception class"
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            t0 = time.time()
+            outcome = "ok"
+            try:
+                return f(*args, **kwargs)
+            except Exception as e:
+                outcome = e.__class__.__name__
+                raise
+            finally:
+                observe(name, time.time() - t0, outcome=outcome, **labels)
+        return wrapper
+    return decorator
+
+
+def observe_query(sql, params, duration_s, cursor):
+    statement = sql.lstrip().split(" ", 1)[0].upper() if sql else "UNKNOWN"
+    observe("dqueue_db_query_seconds", duration_s, statement=statement)
+
+
+registry.describe("dqueue_offer_seconds", "time to offer a task to a worker (claim)")
+registry.describe("dqueue_put_seconds", "time to put a task")
+registry.describe("dqueue_task_done_seconds", "time to register task done")
+registry.describe("dqueue_task_failed_seconds", "time to register task failed")
+registry.describe("dqueue_log_task_seconds", "time to log task event")
+registry.describe("dqueue_maintenance_seconds", "time of maintenance passes: expire, unlock, forgive")
+registry.describe("dqueue_db_query_seconds", "time of database queries")
+registry.describe("dqueue_db_pool_connections", "database connections of the pool, in use and idle")
+registry.describe("dqueue_db_checkouts_total", "database connections checked out for requests, by health check result")
+registry.describe("dqueue_facts_restored_total", "consulted facts, served from memory (hit) or restored from storage (miss)")
+registry.describe("dqueue_facts_exists_total", "fact existence checks: filtered out by the bloom filter, confirmed in the index, or false positives of the filter")
+registry.describe("dqueue_facts_uploads_total", "uploads of spooled facts to the datalake, by outcome")
+registry.describe("dqueue_logstash_messages_total", "messages to logstash: sent, failed to send, or dropped when the queue was full")
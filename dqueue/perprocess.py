@@ -0,0 +1,37 @@
+"""
+state which belongs to one process, like locks, queues and background threads: a forked worker starts own
+
+after fork, only the forking thread runs in the child, and locks may be left held by threads which are gone;
+the state is set up again in the child before anything else runs there, so no thread can see it half-replaced
+"""
+
+import os
+import weakref
+import logging
+
+logger = logging.getLogger(__name__)
+
+_instances = weakref.WeakSet() # type: weakref.WeakSet
+
+
+class PerProcess:
+    "per-process state is set up by reset(), called by init_per_process() and again in each forked child"
+
+    def reset(self):
+        raise NotImplementedError
+
+    def init_per_process(self):
+        self.reset()
+        _instances.add(self)
+
+
+def reset_after_fork():
+    for instance in list(_instances):
+        try:
+            instance.reset()
+        except Exception as e:
+            logger.error("unable to reset %s after fork: %s", instance, e)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,233 @@
+"""
+opt-in profiles of API requests and guardian passes: cProfile of the call, and timings of each DB query made in it
+
+a sampled fraction of requests and passes is profiled (DQUEUE_PROFILE_SAMPLE_RATE), and, if allowed, any request
+carrying the profile header; each profile is stored in DQUEUE_PROFILE_DIR as a pstats dump and a JSON summary,
+oldest removed beyond DQUEUE_PROFILE_MAX_KEEP
+"""
+
+import os
+import io
+import re
+import json
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import tempfile
+import threading
+import contextlib
+import logging
+
+from typing import List, Optional
+
+from dqueue.database import query_hooks
+
+logger = logging.getLogger(__name__)
+
+# fraction of requests and guardian passes profiled; 0 profiles only on request by header
+sample_rate = float(os.environ.get('DQUEUE_PROFILE_SAMPLE_RATE', '0'))
+profile_dir = os.environ.get('DQUEUE_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'dqueue-profiles'))
+max_keep = int(os.environ.get('DQUEUE_PROFILE_MAX_KEEP', '200'))
+
+# anyone who can reach the API can make a request slower with the header: off unless asked for
+header_enabled = os.environ.get('DQUEUE_PROFILE_HEADER_ENABLED', 'no') == 'yes'
+header = "X-DQueue-Profile"
+
+# queries kept in each profile summary, slowest first
+max_queries = int(os.environ.get('DQUEUE_PROFILE_MAX_QUERIES', '100'))
+
+local = threading.local()
+
+
+class ProfileNotFound(Exception):
+    pass
+
+
+class Profile:
+    "profile of one call; cProfile allows only one active profiler per thread, nested profiles are not started"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.id = "{}-{}-{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), safe_name(name), os.getpid(), uuid.uuid4().hex[:8])
+        self.profiler = cProfile.Profile()
+        self.queries = [] # type: List[dict]
+        self.started = None # type: Optional[float]
+        self.duration_s = None # type: Optional[float]
+
+    def start(self):
+        self.started = time.time()
+        local.profile = self
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        local.profile = None
+        self.duration_s = time.time() - self.started
+
+    def note_query(self, sql, params, duration_s, cursor):
+        self.queries.append(dict(sql=sql, n_params=len(params or ()), duration_s=duration_s))
+
+    def summary(self) -> dict:
+        queries = sorted(self.queries, key=lambda q: -q['duration_s'])
+
+        return dict(
+                id=self.id,
+                name=self.name,
+                pid=os.getpid(),
+                started=self.started,
+                duration_s=self.duration_s,
+                n_queries=len(self.queries),
+                queries_s=sum(q['duration_s'] for q in self.queries),
+                queries=queries[:max_queries],
+            )
+
+    def save(self, directory: str=None) -> str:
+        directory = directory or profile_dir
+        os.makedirs(directory, exist_ok=True)
+
+        self.profiler.dump_stats(os.path.join(directory, self.id + ".prof"))
+
+        # summary last: a profile is listed only once complete
+        fn = os.path.join(directory, self.id + ".json")
+        with open(fn + ".tmp", "w") as f:
+            json.dump(self.summary(), f)
+        os.replace(fn + ".tmp", fn)
+
+        logger.info("profile %s of %s: %.3g s, %d queries", self.id, self.name, self.duration_s, len(self.queries))
+
+        return fn
+
+
+def safe_name(name: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in name).strip("_")[:64]
+
+
+def note_query(sql, params, duration_s, cursor):
+    profile = getattr(local, 'profile', None)
+    if profile is not None:
+        profile.note_query(sql, params, duration_s, cursor)
+
+
+query_hooks.append(note_query)
+
+
+def sampled() -> bool:
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def start(name: str, force: bool=False) -> Optional[Profile]:
+    "starts a profile if this call is sampled, or forced; None if not profiled"
+
+    if not (force or sampled()) or getattr(local, 'profile', None) is not None:
+        return None
+
+    profile = Profile(name)
+    profile.start()
+    return profile
+
+
+def finish(profile: Optional[Profile]):
+    if profile is None:
+        return
+
+    profile.stop()
+
+    try:
+        profile.save()
+        prune()
+    except Exception as e:
+        logger.warning("unable to store profile %s: %s", profile.id, e)
+
+
+@contextlib.contextmanager
+def profiled(name: str, force: bool=False):
+    profile = start(name, force)
+    try:
+        yield profile
+    finally:
+        finish(profile)
+
+
+def list_profiles(directory: str=None) -> List[dict]:
+    "summaries of stored profiles, newest first, without the queries"
+
+    directory = directory or profile_dir
+
+    summaries = []
+    for fn in os.listdir(directory) if os.path.isdir(directory) else []:
+        if not fn.endswith(".json"):
+            continue
+
+        try:
+            with open(os.path.join(directory, fn)) as f:
+                s = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug("skipping profile %s: %s", fn, e)
+            continue
+
+        s.pop('queries', None)
+        summaries.append(s)
+
+    return sorted(summaries, key=lambda s: -s['started'])
+
+
+def profile_path(profile_id: str, suffix: str, directory: str=None) -> str:
+    if re.fullmatch(r"[A-Za-z0-9_-]+", profile_id) is None:
+        raise ProfileNotFound(profile_id)
+
+    fn = os.path.join(directory or profile_dir, profile_id + suffix)
+
+    if not os.path.exists(fn):
+        raise ProfileNotFound(profile_id)
+
+    return fn
+
+
+def load_summary(profile_id: str, directory: str=None) -> dict:
+    with open(profile_path(profile_id, ".json", directory)) as f:
+        return json.load(f)
+
+
+def stats_text(profile_id: str, sort: str="cumulative", limit: int=50, directory: str=None) -> str:
+    "readable report of the profile, as pstats prints it"
+
+    out = io.StringIO()
+    stats = pstats.Stats(profile_path(profile_id, ".prof", directory), stream=out)
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def prune(directory: str=None) -> int:
+    "removes the oldest profiles beyond max_keep"
+
+    directory = directory or profile_dir
+
+    ids = sorted(fn[:-len(".json")] for fn in os.listdir(directory) if fn.endswith(".json"))
+
+    n = 0
+    for profile_id in ids[:max(0, len(ids) - max_keep)]:
+        for suffix in ".json", ".prof":
+            try:
+                os.remove(os.path.join(directory, profile_id + suffix))
+            except FileNotFoundError:
+                pass
+        n += 1
+
+    return n
+
+
+def install(app):
+    "profiles sampled requests, and those with the header if allowed"
+
+    from flask import g, request
+
+    @app.before_request
+    def start_request_profile():
+        force = header_enabled and request.headers.get(header, '') not in ('', '0', 'no')
+        g.profile = start(f"{request.method} {request.path}", force)
+
+    @app.teardown_request
+    def finish_request_profile(exception=None):
+        finish(g.pop('profile', None))
@@ -60,6 +60,22 @@ class QueueProxy(DataFacts, Queue):
                                      leave_last=leave_last,
                                      ).response().result
     
+    def rollup_event_log(self, max_batches=None):
+        return self.client.metrics.rollup_update(max_batches=max_batches).response().result
+
+    def get_rollup(self, period="minute", since_hours=1, group_by=["queue"], only_this_queue=False):
+        return self.client.metrics.rollup(period=period,
+                                          since_hours=since_hours,
+                                          group_by=",".join(group_by),
+                                          queue=self.queue if only_this_queue else None,
+                                          ).response().result['buckets']
+
+    def apply_event_log_retention(self, policies=None, max_chunks=None):
+        if policies is not None:
+            raise NotImplementedError("retention policies are configured on the server")
+
+        return self.client.log.retention(max_chunks=max_chunks).response().result
+
     def view_log(self, task_key=None, since=0):
         if task_key is None:
             task_key = ""
@@ -117,12 +133,13 @@ class QueueProxy(DataFacts, Queue):
     def insert_task_entry(self,task,state):
         raise NotImplementedError
 
-    def put(self,task_data, submission_data=None, depends_on=None):
+    def put(self,task_data, submission_data=None, depends_on=None, priority=0):
         return self.client.worker.questionTask(
                     worker_id=self.worker_id,
                     task_payload=dict(
                         task_data=task_data,
                         submission_data=submission_data,
+                        priority=priority,
                     ),
                     queue=self.queue,
                 ).response().result
@@ -132,7 +149,7 @@ class QueueProxy(DataFacts, Queue):
         if self.current_task is not None:
             raise CurrentTaskUnfinished(self.current_task)
 
-        print('proxy q requesting for users:', only_users)
+        self.logger.debug('proxy q requesting for users: %s', only_users)
 
         r = self.client.worker.getOffer(worker_id=self.worker_id, 
                                         queue=self.queue, 
@@ -261,6 +278,16 @@ class QueueProxy(DataFacts, Queue):
     def expire_tasks(self):
         return self.client.tasks.expire().response().result
 
+    def move_queue_tasks(self, from_queue, to_queue):
+        return self.client.tasks.move_queue(from_queue=from_queue, to_queue=to_queue).response().result['tasks']
+
+    def archive_tasks(self, older_than_days=None, batch_size=1000, max_batches=None, only_this_queue=False):
+        return self.client.tasks.archive(older_than_days=older_than_days,
+                                         batch_size=batch_size,
+                                         max_batches=max_batches,
+                                         queue=self.queue if only_this_queue else None,
+                                         ).response().result
+
     def callback(self, url, params):
         """
         """
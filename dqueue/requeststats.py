@@ -0,0 +1,165 @@
+"""
+request statistics for the /statistics view, collected without touching the database in the request path:
+sampled requests are buffered in memory and written in batches by a background thread;
+each row stands for 1/sample_rate requests, and the view counts rows by this weight
+"""
+
+import os
+import time
+import random
+import atexit
+import datetime
+import threading
+import logging
+
+from collections import defaultdict, deque
+
+from flask import Flask, g, request
+from flask_statistics.utils import StatisticsQueries
+from sqlalchemy import desc, func
+
+from dqueue.perprocess import PerProcess
+
+logger = logging.getLogger(__name__)
+
+# fraction of requests recorded; 0 disables request statistics
+sample_rate = float(os.environ.get('DQUEUE_REQUEST_STATS_SAMPLE_RATE', '1'))
+flush_interval_s = float(os.environ.get('DQUEUE_REQUEST_STATS_FLUSH_INTERVAL_S', '5'))
+max_buffered = int(os.environ.get('DQUEUE_REQUEST_STATS_MAX_BUFFERED', '10000'))
+
+
+class RequestSampler(PerProcess):
+    def __init__(self, app: Flask, db, model, sample_rate: float=sample_rate, flush_interval_s: float=flush_interval_s, max_buffered: int=max_buffered):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.sample_rate = sample_rate
+        self.flush_interval_s = flush_interval_s
+        self.max_buffered = max_buffered
+
+        self.n_dropped = 0
+        self.init_per_process()
+
+        if self.sample_rate > 0:
+            app.before_request(self.before_request)
+            app.after_request(self.after_request)
+            app.teardown_request(self.teardown_request)
+
+            atexit.register(self.flush)
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.buffer = deque() # type: deque
+        self.thread = None # type: threading.Thread
+
+    def before_request(self):
+        g.request_stats_sampled = random.random() < self.sample_rate
+
+        if g.request_stats_sampled:
+            g.request_stats_start_time = time.time()
+            g.request_stats_date = datetime.datetime.utcnow()
+            g.request_stats_status_code = 500
+            g.request_stats_size = None
+            g.request_stats_mimetype = None
+
+    def after_request(self, response):
+        if g.get('request_stats_sampled', False):
+            g.request_stats_status_code = response.status_code
+            g.request_stats_size = response.content_length
+            g.request_stats_mimetype = response.mimetype
+
+        return response
+
+    def teardown_request(self, exception=None):
+        if not g.get('request_stats_sampled', False):
+            return
+
+        try:
+            self.record(dict(
+                    response_time=time.time() - g.request_stats_start_time,
+                    status_code=g.request_stats_status_code,
+                    size=g.request_stats_size,
+                    method=request.method,
+                    remote_address=request.environ.get("HTTP_X_REAL_IP", request.remote_addr),
+                    path=request.path,
+                    referrer=request.referrer,
+                    browser=f"{request.user_agent.browser} {request.user_agent.version}",
+                    platform=request.user_agent.platform,
+                    user_agent=request.user_agent.string,
+                    date=g.request_stats_date,
+                    mimetype=g.request_stats_mimetype,
+                    exception=None if exception is None else repr(exception),
+                    weight=1. / self.sample_rate,
+                ))
+        except Exception as e:
+            logger.warning("unable to record request statistics: %s", e)
+
+    def record(self, row: dict):
+        with self.lock:
+            if len(self.buffer) >= self.max_buffered:
+                self.buffer.popleft()
+                self.n_dropped += 1
+
+            self.buffer.append(row)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.flush_loop, daemon=True, name="request-stats-flush")
+                self.thread.start()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval_s)
+            self.flush()
+
+    def flush(self) -> int:
+        with self.lock:
+            rows = list(self.buffer)
+            self.buffer.clear()
+
+        if len(rows) == 0:
+            return 0
+
+        try:
+            with self.app.app_context():
+                self.db.session.bulk_insert_mappings(self.model, rows)
+                self.db.session.commit()
+                self.db.session.remove()
+        except Exception as e:
+            logger.warning("unable to store %s request statistics rows: %s", len(rows), e)
+            return 0
+
+        logger.debug("stored %s request statistics rows, %s dropped so far", len(rows), self.n_dropped)
+
+        return len(rows)
+
+
+class WeightedStatisticsQueries(StatisticsQueries):
+    "hits of the /statistics view, counted by the weight of sampled rows; unique visitors are counted as sampled"
+
+    def get_routes_data(self, start_date: datetime.datetime, end_date: datetime.datetime):
+        query = (self.db.session.query(self.model.path,
+                                       func.sum(self.model.weight).label("hits"),
+                                       func.count(self.model.remote_address.distinct()).label("unique_hits"),
+                                       func.max(self.model.date).label("last_requested"),
+                                       func.avg(self.model.response_time).label("average_response_time"))
+                 .group_by(self.model.path)
+                 .order_by(desc("hits")))
+
+        return self._add_date_filter_to_query(query, start_date, end_date).all()
+
+    def get_user_chart_data(self, start_date: datetime.datetime, end_date: datetime.datetime, path: str=None):
+        query = self.db.session.query(self.model.date, self.model.remote_address, self.model.weight)
+        query = self._add_date_filter_to_query(query, start_date, end_date)
+
+        if path is not None:
+            query = query.filter(self.model.path == path)
+
+        hits = defaultdict(float) # type: dict
+        unique_hits = defaultdict(set) # type: dict
+
+        for r in query.all():
+            hits[str(r.date.date())] += r.weight
+            unique_hits[str(r.date.date())].add(r.remote_address)
+
+        return [{"x": date, "y": round(n)} for date, n in hits.items()], \
+               [{"x": date, "y": len(addresses)} for date, addresses in unique_hits.items()]
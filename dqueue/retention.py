@@ -0,0 +1,266 @@
+import os
+import time
+import datetime
+import logging
+
+from typing import Union, List
+
+import peewee # type: ignore
+
+from dqueue.database import EventLog, RollupWatermark
+import dqueue.rollup as rollup
+
+logger = logging.getLogger(__name__)
+
+# event log retention defaults, per kind of event; 0 disables the rule
+task_events_max_age_days = float(os.environ.get('DQUEUE_EVENTLOG_TASK_MAX_AGE_DAYS', '7'))
+task_events_keep_last = int(os.environ.get('DQUEUE_EVENTLOG_TASK_KEEP_LAST', '50'))
+worker_events_max_age_days = float(os.environ.get('DQUEUE_EVENTLOG_WORKER_MAX_AGE_DAYS', str(2./24.)))
+
+default_chunk_size = int(os.environ.get('DQUEUE_EVENTLOG_CHUNK_SIZE', '1000'))
+default_chunk_pause_s = float(os.environ.get('DQUEUE_EVENTLOG_CHUNK_PAUSE_S', '0.05'))
+
+# time one retention pass may take; 0 is unbounded
+pass_max_s = float(os.environ.get('DQUEUE_EVENTLOG_RETENTION_MAX_S', '60'))
+
+# only events already aggregated by the rollup job are deleted: no means retention does not wait for the rollup
+rolled_up_only = os.environ.get('DQUEUE_EVENTLOG_RETENTION_ROLLED_UP_ONLY', 'yes') == 'yes'
+
+
+def kind_condition(kind: Union[str, None]):
+    if kind is None or kind == "all":
+        return None
+    elif kind == "task":
+        return EventLog.worker_state == "unset"
+    elif kind == "worker":
+        return EventLog.worker_state != "unset"
+    else:
+        raise RuntimeError(f"unknown kind {kind}; expecting 'task' or 'worker'")
+
+
+class RetentionPolicy:
+    """
+    events of one kind ("task", "worker" or "all") are kept for max_age_days;
+    for task events, at most keep_last per task
+    """
+
+    def __init__(self, kind: str, max_age_days: float=0, keep_last: int=0):
+        kind_condition(kind)
+
+        self.kind = kind
+        self.max_age_days = max_age_days
+        self.keep_last = keep_last
+
+    def __repr__(self):
+        return f"[{self.__class__.__name__}: {self.kind} max_age_days={self.max_age_days} keep_last={self.keep_last}]"
+
+
+def default_policies() -> List[RetentionPolicy]:
+    return [
+        RetentionPolicy("task", max_age_days=task_events_max_age_days, keep_last=task_events_keep_last),
+        RetentionPolicy("worker", max_age_days=worker_events_max_age_days),
+    ]
+
+
+class Budget:
+    "chunks and time a whole retention pass may take; shared by all deletions of the pass"
+
+    def __init__(self, max_chunks: Union[int, None]=None, max_s: Union[float, None]=None):
+        self.max_chunks = max_chunks
+        self.max_s = max_s
+        self.started = time.time()
+        self.n_chunks = 0
+
+    def exhausted(self) -> bool:
+        if self.max_chunks is not None and self.n_chunks >= self.max_chunks:
+            return True
+        if self.max_s is not None and time.time() - self.started >= self.max_s:
+            return True
+        return False
+
+
+def delete_chunked(condition=None, chunk_size: int=None, pause_s: float=None, max_chunks: Union[int, None]=None, budget: Budget=None) -> dict:
+    """
+    deletes events matching condition, chunk_size matching ids at a time, oldest first, each chunk after the previous:
+    no statement touches more than chunk_size rows, so the table is never locked for long;
+    stops when the budget is exhausted, by default max_chunks of this call
+    """
+
+    if chunk_size is None:
+        chunk_size = default_chunk_size
+
+    if pause_s is None:
+        pause_s = default_chunk_pause_s
+
+    if budget is None:
+        budget = Budget(max_chunks)
+
+    t0 = time.time()
+
+    N = 0
+    n_chunks = 0
+    last_id = 0
+
+    while not budget.exhausted():
+        # from where the last chunk ended: rows kept before it are not scanned again
+        c = EventLog.id > last_id
+        if condition is not None:
+            c &= condition
+
+        ids = [e.id for e in EventLog.select(EventLog.id).where(c).order_by(EventLog.id).limit(chunk_size).execute(database=None)]
+        if len(ids) == 0:
+            break
+
+        last_id = ids[-1]
+
+        N += EventLog.delete().where(EventLog.id.in_(ids)).execute(database=None)
+        n_chunks += 1
+        budget.n_chunks += 1
+
+        if len(ids) < chunk_size:
+            break
+
+        if pause_s > 0:
+            time.sleep(pause_s)
+
+    elapsed_s = time.time() - t0
+
+    report = dict(
+            deleted=N,
+            chunks=n_chunks,
+            elapsed_s=elapsed_s,
+            rows_per_s=N / elapsed_s if elapsed_s > 0 else 0,
+        )
+
+    logger.info("deleted events in chunks: %s", report)
+
+    return report
+
+
+def keep_last_per_task(keep_last: int, budget: Budget=None, max_id: Union[int, None]=None, **chunk_kwargs) -> dict:
+    "deletes all but keep_last most recent events of every task; with max_id, only events up to it"
+
+    F = kind_condition("task")
+
+    # the most recent are found among all events of the task, those deleted only among the first max_id
+    deleted_F = F if max_id is None else F & (EventLog.id <= max_id)
+
+    if budget is None:
+        budget = Budget(chunk_kwargs.pop('max_chunks', None))
+
+    t0 = time.time()
+    N = 0
+    n_chunks = 0
+
+    if budget.exhausted():
+        return dict(deleted=0, chunks=0, elapsed_s=0, rows_per_s=0)
+
+    # only tasks with events since the last complete pass can have become crowded
+    watermark = f"retention-keep-last-{keep_last}"
+    since_id = rollup.rolled_up_id(watermark)
+
+    if max_id is not None:
+        until_id = max_id
+    else:
+        until_id = EventLog.select(peewee.fn.MAX(EventLog.id)).scalar(database=None) or 0
+
+    # tasks with events past until_id are scanned again in the next pass, when more of them may be deleted
+    recent_tasks = EventLog.select(EventLog.task_key)\
+                           .where(F, EventLog.id > since_id)\
+                           .distinct()
+
+    crowded_tasks = EventLog.select(EventLog.task_key)\
+                            .where(F, EventLog.task_key << recent_tasks)\
+                            .group_by(EventLog.task_key)\
+                            .having(peewee.fn.COUNT(EventLog.id) > keep_last)\
+                            .execute(database=None)
+
+    complete = True
+    for crowded_task in crowded_tasks:
+        if budget.exhausted():
+            complete = False
+            break
+
+        oldest_kept = EventLog.select(EventLog.id)\
+                              .where(F, EventLog.task_key == crowded_task.task_key)\
+                              .order_by(EventLog.id.desc())\
+                              .offset(keep_last - 1)\
+                              .limit(1)\
+                              .execute(database=None)
+
+        if len(oldest_kept) == 0:
+            continue
+
+        r = delete_chunked(deleted_F & (EventLog.task_key == crowded_task.task_key) & (EventLog.id < oldest_kept[0].id), budget=budget, **chunk_kwargs)
+        N += r['deleted']
+        n_chunks += r['chunks']
+
+    # an interrupted pass is scanned again from the same place
+    if complete and not budget.exhausted() and until_id > since_id:
+        RollupWatermark.insert(name=watermark, last_id=until_id).on_conflict_replace().execute(database=None)
+
+    elapsed_s = time.time() - t0
+
+    return dict(
+            deleted=N,
+            chunks=n_chunks,
+            elapsed_s=elapsed_s,
+            rows_per_s=N / elapsed_s if elapsed_s > 0 else 0,
+        )
+
+
+def apply_retention(policies: Union[List[RetentionPolicy], None]=None, max_chunks: Union[int, None]=None, max_s: Union[float, None]=None,
+                    rolled_up_only: bool=rolled_up_only, **chunk_kwargs) -> dict:
+    """
+    applies retention policies, returns what was deleted and how fast, per policy;
+    max_chunks and max_s bound the whole pass, the rest is left to the next one;
+    if rolled_up_only, events past the rollup watermark are kept until they are aggregated
+    """
+
+    if policies is None:
+        policies = default_policies()
+
+    max_id = rollup.rolled_up_id() if rolled_up_only else None
+
+    if max_s is None and pass_max_s > 0:
+        max_s = pass_max_s
+
+    budget = Budget(max_chunks, max_s)
+
+    report = dict(deleted=0, elapsed_s=0, policies=[])
+
+    for policy in policies:
+        policy_report = dict(kind=policy.kind, max_age_days=policy.max_age_days, keep_last=policy.keep_last, deleted=0, elapsed_s=0)
+
+        if policy.max_age_days > 0:
+            F = EventLog.timestamp < datetime.datetime.now() - datetime.timedelta(days=policy.max_age_days)
+
+            kind_F = kind_condition(policy.kind)
+            if kind_F is not None:
+                F = F & kind_F
+
+            if max_id is not None:
+                F = F & (EventLog.id <= max_id)
+
+            r = delete_chunked(F, budget=budget, **chunk_kwargs)
+            policy_report['deleted'] += r['deleted']
+            policy_report['elapsed_s'] += r['elapsed_s']
+
+        if policy.keep_last > 0 and policy.kind == "task":
+            r = keep_last_per_task(policy.keep_last, budget=budget, max_id=max_id, **chunk_kwargs)
+            policy_report['deleted'] += r['deleted']
+            policy_report['elapsed_s'] += r['elapsed_s']
+
+        policy_report['rows_per_s'] = policy_report['deleted'] / policy_report['elapsed_s'] if policy_report['elapsed_s'] > 0 else 0
+
+        report['policies'].append(policy_report)
+        report['deleted'] += policy_report['deleted']
+        report['elapsed_s'] += policy_report['elapsed_s']
+
+    report['rows_per_s'] = report['deleted'] / report['elapsed_s'] if report['elapsed_s'] > 0 else 0
+    report['chunks'] = budget.n_chunks
+    report['max_id'] = max_id
+
+    logger.info("event log retention: %s", report)
+
+    return report
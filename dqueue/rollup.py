@@ -0,0 +1,272 @@
+import os
+import json
+import math
+import time
+import datetime
+import logging
+
+from collections import defaultdict
+from typing import Union, List
+
+import peewee # type: ignore
+
+from dqueue.database import EventLog, EventLogRollup, RollupWatermark, TaskProperties, db
+
+logger = logging.getLogger(__name__)
+
+periods = ["minute", "hour"]
+
+group_keys = ["queue", "worker_id", "factory_name"]
+
+# spent_s quantiles are kept in logarithmic bins, each sketch_gamma wider than previous: ~5% relative error
+sketch_gamma = 1.1
+sketch_min_s = 1e-3
+
+# events are rolled up only once this old: ids are assigned at insert but rows become visible at commit,
+# so a newer event may show up before an older one, and must not be left behind the watermark
+rollup_lag_s = float(os.environ.get('DQUEUE_ROLLUP_LAG_S', '60'))
+
+
+def bucket_start(timestamp: datetime.datetime, period: str) -> datetime.datetime:
+    if period == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    elif period == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    else:
+        raise RuntimeError(f"unknown rollup period {period}; expecting one of {periods}")
+
+
+def sketch_bin(x: float) -> int:
+    if x <= sketch_min_s:
+        return 0
+    return int(math.ceil(math.log(x / sketch_min_s, sketch_gamma)))
+
+
+def sketch_bin_value(i: int) -> float:
+    if i <= 0:
+        return sketch_min_s
+    return sketch_min_s * 2 * sketch_gamma**i / (sketch_gamma + 1)
+
+
+def merge_sketches(*sketches: dict) -> dict:
+    merged = defaultdict(int) # type: dict
+    for sketch in sketches:
+        for i, n in sketch.items():
+            merged[int(i)] += n
+    return dict(merged)
+
+
+def sketch_quantile(sketch: dict, q: float) -> Union[float, None]:
+    N = sum(sketch.values())
+    if N == 0:
+        return None
+
+    rank = q * (N - 1)
+    seen = 0
+    for i in sorted(sketch, key=int):
+        seen += sketch[i]
+        if seen > rank:
+            return sketch_bin_value(int(i))
+
+    return sketch_bin_value(int(max(sketch, key=int)))
+
+
+def classify(event: EventLog) -> str:
+    if event.message == "task started":
+        return "started"
+    if event.message == "task done":
+        return "done"
+    if event.task_state == "failed" and event.message.startswith("task failed"):
+        return "failed"
+    return "other"
+
+
+def aggregate(events) -> dict:
+    "aggregates events in memory, by period, bucket and group"
+
+    aggregates = {} # type: dict
+
+    for event in events:
+        kind = classify(event)
+
+        for period in periods:
+            k = (period, bucket_start(event.timestamp, period), event.queue, event.worker_id, event.factory_name or "unknown")
+
+            a = aggregates.get(k)
+            if a is None:
+                a = aggregates[k] = dict(n_events=0, n_started=0, n_done=0, n_failed=0,
+                                         spent_s_sum=0., spent_s_count=0, spent_s_sketch=defaultdict(int),
+                                         last_active=event.timestamp)
+
+            a['n_events'] += 1
+            if kind != "other":
+                a['n_' + kind] += 1
+
+            if event.spent_s is not None and event.spent_s > 0:
+                a['spent_s_sum'] += event.spent_s
+                a['spent_s_count'] += 1
+                a['spent_s_sketch'][sketch_bin(event.spent_s)] += 1
+
+            a['last_active'] = max(a['last_active'], event.timestamp)
+
+    return aggregates
+
+
+def store(aggregates: dict):
+    for (period, bucket, queue, worker_id, factory_name), a in aggregates.items():
+        key_condition = (
+                (EventLogRollup.period == period) &
+                (EventLogRollup.bucket == bucket) &
+                (EventLogRollup.queue == queue) &
+                (EventLogRollup.worker_id == worker_id) &
+                (EventLogRollup.factory_name == factory_name)
+            )
+
+        existing = EventLogRollup.select().where(key_condition).execute(database=None)
+
+        if len(existing) == 0:
+            EventLogRollup.insert(
+                    period=period, bucket=bucket, queue=queue, worker_id=worker_id, factory_name=factory_name,
+                    n_events=a['n_events'], n_started=a['n_started'], n_done=a['n_done'], n_failed=a['n_failed'],
+                    spent_s_sum=a['spent_s_sum'], spent_s_count=a['spent_s_count'],
+                    spent_s_sketch=json.dumps(dict(a['spent_s_sketch'])),
+                    last_active=a['last_active'],
+                ).execute(database=None)
+        else:
+            e = existing[0]
+            EventLogRollup.update({
+                    EventLogRollup.n_events: EventLogRollup.n_events + a['n_events'],
+                    EventLogRollup.n_started: EventLogRollup.n_started + a['n_started'],
+                    EventLogRollup.n_done: EventLogRollup.n_done + a['n_done'],
+                    EventLogRollup.n_failed: EventLogRollup.n_failed + a['n_failed'],
+                    EventLogRollup.spent_s_sum: EventLogRollup.spent_s_sum + a['spent_s_sum'],
+                    EventLogRollup.spent_s_count: EventLogRollup.spent_s_count + a['spent_s_count'],
+                    EventLogRollup.spent_s_sketch: json.dumps(merge_sketches(json.loads(e.spent_s_sketch), a['spent_s_sketch'])),
+                    EventLogRollup.last_active: max(e.last_active or a['last_active'], a['last_active']),
+                }).where(key_condition).execute(database=None)
+
+
+def run_rollup(batch_size: int=10000, max_batches: Union[int, None]=None, watermark: str="eventlog", lag_s: Union[float, None]=None) -> dict:
+    """
+    rolls up events past the watermark, one batch per transaction;
+    the watermark moves only if nobody else moved it meanwhile, so concurrent runs do not count events twice;
+    it stops at the first event younger than lag_s, which may still have uncommitted predecessors
+    """
+
+    if lag_s is None:
+        lag_s = rollup_lag_s
+
+    t0 = time.time()
+    too_recent = datetime.datetime.now() - datetime.timedelta(seconds=lag_s)
+    N = 0
+    n_batches = 0
+
+    while max_batches is None or n_batches < max_batches:
+        with db.atomic() as transaction:
+            w = RollupWatermark.select().where(RollupWatermark.name == watermark).execute(database=None)
+            if len(w) == 0:
+                RollupWatermark.insert(name=watermark, last_id=0).on_conflict_ignore().execute(database=None)
+                last_id = 0
+            else:
+                last_id = w[0].last_id
+
+            events = list(EventLog.select(EventLog, TaskProperties.factory_name)
+                                  .join(TaskProperties, peewee.JOIN.LEFT_OUTER, on=(EventLog.task_key == TaskProperties.key))
+                                  .where(EventLog.id > last_id)
+                                  .order_by(EventLog.id)
+                                  .limit(batch_size)
+                                  .objects()
+                                  .execute(database=None))
+
+            n_fetched = len(events)
+
+            for i, event in enumerate(events):
+                if event.timestamp >= too_recent:
+                    events = events[:i]
+                    break
+
+            if len(events) == 0:
+                break
+
+            new_last_id = events[-1].id
+
+            moved = RollupWatermark.update({RollupWatermark.last_id: new_last_id})\
+                                   .where(RollupWatermark.name == watermark, RollupWatermark.last_id == last_id)\
+                                   .execute(database=None)
+
+            if moved == 0:
+                logger.warning("rollup watermark %s moved concurrently, leaving it to the other job", watermark)
+                transaction.rollback()
+                break
+
+            store(aggregate(events))
+
+        N += len(events)
+        n_batches += 1
+
+        if n_fetched < batch_size or len(events) < n_fetched:
+            break
+
+    elapsed_s = time.time() - t0
+
+    report = dict(events=N, batches=n_batches, elapsed_s=elapsed_s)
+    logger.info("rolled up event log: %s", report)
+
+    return report
+
+
+def rolled_up_id(watermark: str="eventlog") -> int:
+    "last EventLog id aggregated: events up to it may be deleted without losing them from the rollup"
+
+    w = RollupWatermark.select().where(RollupWatermark.name == watermark).execute(database=None)
+    if len(w) == 0:
+        return 0
+
+    return w[0].last_id
+
+
+def query_rollup(period: str="minute", since: Union[datetime.datetime, None]=None, group_by: List[str]=["queue"], queue: Union[str, None]=None) -> List[dict]:
+    "rollup buckets merged over the groups which are not asked for"
+
+    for g in group_by:
+        if g not in group_keys:
+            raise RuntimeError(f"unknown rollup group {g}; expecting some of {group_keys}")
+
+    if period not in periods:
+        raise RuntimeError(f"unknown rollup period {period}; expecting one of {periods}")
+
+    c = EventLogRollup.period == period
+    if since is not None:
+        c &= EventLogRollup.bucket >= bucket_start(since, period)
+    if queue is not None:
+        c &= EventLogRollup.queue == queue
+
+    merged = {} # type: dict
+
+    for r in EventLogRollup.select().where(c).order_by(EventLogRollup.bucket).execute(database=None):
+        k = (r.bucket,) + tuple(getattr(r, g) for g in group_by)
+
+        m = merged.get(k)
+        if m is None:
+            m = merged[k] = dict(bucket=r.bucket.isoformat(), **{g: getattr(r, g) for g in group_by},
+                                 n_events=0, n_started=0, n_done=0, n_failed=0,
+                                 spent_s_sum=0., spent_s_count=0, spent_s_sketch={}, last_active=r.last_active)
+
+        for f in "n_events", "n_started", "n_done", "n_failed", "spent_s_sum", "spent_s_count":
+            m[f] += getattr(r, f)
+
+        m['spent_s_sketch'] = merge_sketches(m['spent_s_sketch'], json.loads(r.spent_s_sketch))
+
+        if r.last_active is not None and (m['last_active'] is None or r.last_active > m['last_active']):
+            m['last_active'] = r.last_active
+
+    result = []
+    for m in merged.values():
+        sketch = m.pop('spent_s_sketch')
+        m['spent_s_mean'] = m['spent_s_sum'] / m['spent_s_count'] if m['spent_s_count'] > 0 else None
+        for q in 50, 90, 99:
+            m[f'spent_s_p{q}'] = sketch_quantile(sketch, q / 100.)
+        m['last_active'] = m['last_active'].isoformat() if m['last_active'] is not None else None
+        result.append(m)
+
+    return result
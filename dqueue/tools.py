@@ -14,6 +14,7 @@ import json
 import dqueue.core as core
 from dqueue.database import model_to_dict, TaskEntry, EventLog
 from dqueue.entry import decode_entry_data
+import dqueue.blobstore as blobstore
 
 import peewee # type: ignore
 
@@ -29,11 +30,6 @@ db = core.db
 logger=logging.getLogger(__name__)
 
 def stats():
-    try:
-        db.connect()
-    except peewee.OperationalError as e:
-        pass
-
     decode = bool(request.args.get('raw'))
 
     print("searching for entries")
@@ -49,18 +45,12 @@ def stats():
         bystate[entry.state] += 1
         #bystate[entry.state].append(entry)
 
-    db.close()
 
     return {k:v for k,v in bystate.items()}
 
 
 
 def list_tasks(include_task_data=True, decode=True, state="any", json_filter=None):
-    try:
-        db.connect()
-    except peewee.OperationalError as e:
-        pass
-
     logger.info("searching for entries")
     date_N_days_ago = datetime.datetime.now() - datetime.timedelta(days=float(request.args.get('since',1)))
 
@@ -72,7 +62,7 @@ def list_tasks(include_task_data=True, decode=True, state="any", json_filter=Non
     if json_filter:
         c &= core.TaskEntry.task_dict_string.contains(json_filter)
 
-    entries = [ model_to_dict(entry) for entry in core.TaskEntry.\
+    entries = [ blobstore.inline_entry(model_to_dict(entry)) for entry in core.TaskEntry.\
                                                   select().\
                                                   where(c).\
                                                   order_by(core.TaskEntry.modified.desc()).\
@@ -98,7 +88,6 @@ def list_tasks(include_task_data=True, decode=True, state="any", json_filter=Non
 
         logger.info("spent %f s decoding %d entries", tspent, len(entries))
 
-    db.close()
 
 
     return entries
@@ -139,7 +128,6 @@ def task_info(key):
     except:
         r = entry['entry']
 
-    db.close()
     return r
 
 def purge():
@@ -0,0 +1,141 @@
+"""
+per-process tracing of database statements: which of the statements made for each offer, put or maintenance pass dominate
+
+each statement is traced by its text, as sent with placeholders, and the types of its parameters; aggregated are
+count, total and maximum duration and affected rows; the slowest executions of the last window are kept,
+and those slower than DQUEUE_SLOW_QUERY_S are logged
+"""
+
+import os
+import time
+import heapq
+import threading
+import logging
+
+from typing import Dict, List, Tuple
+
+from dqueue.perprocess import PerProcess
+
+logger = logging.getLogger(__name__)
+
+tracing_enabled = os.environ.get('DQUEUE_QUERY_TRACING', 'yes') == 'yes'
+slow_query_s = float(os.environ.get('DQUEUE_SLOW_QUERY_S', '0.5'))
+top_n = int(os.environ.get('DQUEUE_QUERY_TRACE_TOP', '20'))
+window_s = float(os.environ.get('DQUEUE_QUERY_TRACE_WINDOW_S', '3600'))
+
+# statements with many shapes, e.g. IN with lists of any length, would grow the table without bound
+max_statements = int(os.environ.get('DQUEUE_QUERY_TRACE_MAX_STATEMENTS', '1000'))
+other_statement = ("(other statements)", "")
+
+# logged statements are cut to this length
+max_sql_length = 1000
+
+
+def params_shape(params) -> str:
+    return ",".join(type(p).__name__ for p in params or ())
+
+
+def rows_of(cursor) -> int:
+    "affected rows as reported by the driver, -1 if unknown, e.g. for SELECT with sqlite"
+    try:
+        return cursor.rowcount
+    except Exception:
+        return -1
+
+
+class QueryTracer(PerProcess):
+    def __init__(self, top_n: int=top_n, slow_query_s: float=slow_query_s, window_s: float=window_s, max_statements: int=max_statements):
+        self.top_n = top_n
+        self.slow_query_s = slow_query_s
+        self.window_s = window_s
+        self.max_statements = max_statements
+        self.init_per_process()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.statements = {} # type: Dict[Tuple[str, str], list]
+        self.slowest = [] # type: List[tuple]
+        self.n_traced = 0
+        self.last_expired = 0.
+
+    def trace(self, sql, params, duration_s, cursor):
+        shape = params_shape(params)
+        rows = rows_of(cursor) if cursor is not None else -1
+        now = time.time()
+
+        with self.lock:
+            self.n_traced += 1
+
+            k = (sql, shape)
+            s = self.statements.get(k)
+            if s is None:
+                if len(self.statements) >= self.max_statements:
+                    k = other_statement
+                    s = self.statements.get(k)
+
+                if s is None:
+                    # count, total duration, maximum duration, affected rows
+                    s = self.statements[k] = [0, 0., 0., 0]
+
+            s[0] += 1
+            s[1] += duration_s
+            s[2] = max(s[2], duration_s)
+            s[3] += max(rows, 0)
+
+            if now - self.last_expired > 1:
+                self.expire(now)
+
+            # min-heap of the slowest: the fastest of them is replaced
+            record = (duration_s, now, sql, shape, rows)
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, record)
+            elif duration_s > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, record)
+
+        if duration_s > self.slow_query_s:
+            logger.warning("slow query %.3g s, %s rows, params (%s): %s", duration_s, rows, shape, sql[:max_sql_length])
+
+    def expire(self, now: float):
+        self.last_expired = now
+
+        kept = [r for r in self.slowest if now - r[1] < self.window_s]
+        if len(kept) < len(self.slowest):
+            heapq.heapify(kept)
+            self.slowest = kept
+
+    def report(self, n: int=None) -> dict:
+        "statements by total time, and the slowest executions, slowest first"
+
+        n = n or self.top_n
+
+        with self.lock:
+            self.expire(time.time())
+
+            statements = sorted(self.statements.items(), key=lambda x: -x[1][1])[:n]
+            slowest = sorted(self.slowest, reverse=True)
+            n_traced = self.n_traced
+
+        return dict(
+                pid=os.getpid(),
+                n_traced=n_traced,
+                n_statements=len(self.statements),
+                statements=[
+                        dict(sql=sql, params=shape, count=s[0], total_s=s[1], mean_s=s[1] / s[0], max_s=s[2], rows=s[3])
+                        for (sql, shape), s in statements
+                    ],
+                slowest=[
+                        dict(sql=sql, params=shape, duration_s=duration_s, timestamp=timestamp, rows=rows)
+                        for duration_s, timestamp, sql, shape, rows in slowest
+                    ],
+            )
+
+
+tracer = QueryTracer()
+
+
+def trace_query(sql, params, duration_s, cursor):
+    tracer.trace(sql, params, duration_s, cursor)
+
+
+def report(n: int=None) -> dict:
+    return tracer.report(n)
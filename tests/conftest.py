@@ -1,5 +1,9 @@
+import os
 import pytest
 
+# failed tasks are retried right away in tests, unless a test asks for backoff
+os.environ.setdefault('DQUEUE_RETRY_BACKOFF_S', '0')
+
 import dqueue.api
 
 @pytest.fixture(scope="session")
@@ -3,6 +3,7 @@ import json
 from flask import url_for
 import os
 import base64
+import io
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -48,3 +49,302 @@ class TestLiveServer:
         assert light_payload
 
         print("light payload:", light_payload)
+
+def test_spool_fact():
+    import io
+    import hashlib
+    import dqueue.facts as facts
+
+    data = os.urandom(3*1024*1024 + 17)
+
+    f, size, sha256 = facts.spool(io.BytesIO(data), chunk_size=1024*1024)
+
+    assert size == len(data)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert f.read() == data
+
+def test_fact_caches(tmpdir):
+    import dqueue.facts as facts
+    from dqueue.data import FactCache
+
+    dag = ["F", ["a1"]]
+    fact = dict(dag_json=json.dumps(dag), data_json=json.dumps("x" * 1000))
+
+    cache = FactCache(str(tmpdir), max_mb=2.5/1024)
+
+    assert cache.get(dag) is None
+    cache.put(dag, fact)
+    assert cache.get(dag) == fact
+
+    # corrupt entries are dropped
+    fn = cache.path(dag)
+    content = open(fn, "rb").read()
+    open(fn, "wb").write(content[:-2] + b"}}")
+    assert cache.get(dag) is None
+    assert not os.path.exists(fn)
+
+    # least recently used are evicted
+    for i in range(3):
+        cache.put(["F", i], dict(dag_json=json.dumps(["F", i]), data_json=json.dumps("x" * 1000)))
+    assert cache.get(["F", 0]) is None
+    assert cache.get(["F", 2]) is not None
+
+    restored = facts.RestoredFacts(max_mb=2.5/1024)
+    for i in range(3):
+        restored.put(f"b{i}", fact)
+    assert restored.get("b0") is None
+    assert restored.get("b2") == fact
+    restored.drop("b2")
+    assert restored.get("b2") is None
+
+def test_facts_exist(client):
+    import dqueue.facts as facts
+
+    dags = [["F", "exists", i] for i in range(5)]
+
+    facts.known.note(facts.fact_bucket(dags[1]))
+    facts.known.note(facts.fact_bucket(dags[3]), format="raw", size=10)
+
+    r = client.post("data/exists?worker_id=test", json=dict(dags_json=[json.dumps(d) for d in dags]))
+    assert r.status_code == 200
+    assert r.json['exists'] == [False, True, False, True, False]
+
+    # noted by another process: found by the refresh
+    facts.known.bloom = facts.BloomFilter()
+    assert facts.known.known([facts.fact_bucket(dags[1])]) == {facts.fact_bucket(dags[1]): True}
+
+    facts.known.forget(facts.fact_bucket(dags[1]))
+    assert facts.known.known([facts.fact_bucket(dags[1])]) == {facts.fact_bucket(dags[1]): False}
+
+def test_consult_many(client):
+    import dqueue.facts as facts
+
+    dags = [["F", "consult-many", i] for i in range(4)]
+
+    for i in 0, 2:
+        bucket = facts.fact_bucket(dags[i])
+        facts.known.note(bucket)
+        facts.restored.put(bucket, dict(dag_json=json.dumps(dags[i]), data_json=json.dumps(f"data-{i}")))
+
+    r = client.post("data/consult_many?worker_id=test", json=dict(dags_json=[json.dumps(d) for d in dags]))
+    assert r.status_code == 200
+
+    answers = {a['index']: a for a in map(json.loads, r.data.decode().splitlines())}
+    assert sorted(answers) == [0, 1, 2, 3]
+    assert [answers[i]['found'] for i in range(4)] == [True, False, True, False]
+    assert json.loads(answers[2]['data_json']) == "data-2"
+
+def test_fact_spool(tmpdir, monkeypatch):
+    import odakb.datalake
+    import dqueue.facts as facts
+
+    spool = facts.FactSpool(str(tmpdir), n_threads=0)
+
+    spool.put("odahub-b-test", json.dumps(dict(dag=["F"], data="spooled")))
+    assert spool.get("odahub-b-test") == dict(dag=["F"], data="spooled")
+    assert spool.pending() == ["odahub-b-test"]
+
+    def store_unavailable(package, bucket_name):
+        raise RuntimeError("datalake unavailable")
+
+    monkeypatch.setattr(odakb.datalake, "store", store_unavailable)
+    assert not spool.upload("odahub-b-test")
+    assert spool.get("odahub-b-test") is not None
+
+    stored = {}
+    monkeypatch.setattr(odakb.datalake, "store", lambda package, bucket_name: stored.update({bucket_name: package}))
+    assert spool.upload("odahub-b-test", attempt=1)
+    assert stored == {"odahub-b-test": dict(dag=["F"], data="spooled")}
+    assert spool.get("odahub-b-test") is None
+
+def test_fact_spool_claims_and_gives_up(tmpdir, monkeypatch):
+    import subprocess
+    import odakb.datalake
+    import dqueue.facts as facts
+
+    spool = facts.FactSpool(str(tmpdir), n_threads=0, max_attempts=2)
+
+    def store_unavailable(package, bucket_name):
+        raise RuntimeError("datalake unavailable")
+
+    monkeypatch.setattr(odakb.datalake, "store", store_unavailable)
+
+    # claimed by the uploading process: another one sharing the spool does not find it
+    spool.put("odahub-b-claimed", json.dumps(dict(dag=["F"], data="claimed")))
+    assert not spool.upload("odahub-b-claimed")
+    assert spool.pending() == []
+    assert os.path.exists(spool.claimed_path("odahub-b-claimed"))
+    assert spool.get("odahub-b-claimed") == dict(dag=["F"], data="claimed")
+
+    # the last attempt parks it in the dead-letter directory, where it is still served from
+    assert not spool.upload("odahub-b-claimed", attempt=1)
+    assert not os.path.exists(spool.claimed_path("odahub-b-claimed"))
+    assert os.path.exists(spool.dead_letter_path("odahub-b-claimed"))
+    assert spool.get("odahub-b-claimed") == dict(dag=["F"], data="claimed")
+
+    # claimed by a process which is gone: back to the spool
+    p = subprocess.Popen(["true"])
+    p.wait()
+    os.makedirs(os.path.dirname(spool.claimed_path("odahub-b-orphan", p.pid)))
+    with open(spool.claimed_path("odahub-b-orphan", p.pid), "w") as f:
+        json.dump(dict(dag=["F"], data="orphan"), f)
+
+    spool = facts.FactSpool(str(tmpdir), n_threads=0)
+    spool.start()
+    assert spool.pending() == ["odahub-b-orphan"]
+    assert spool.claimed_pids() == [os.getpid()]
+
+    stored = {}
+    monkeypatch.setattr(odakb.datalake, "store", lambda package, bucket_name: stored.update({bucket_name: package}))
+    assert spool.upload("odahub-b-orphan")
+    assert stored == {"odahub-b-orphan": dict(dag=["F"], data="orphan")}
+
+class FakeMinio:
+    "objects in memory, by bucket and name"
+
+    class Object(io.BytesIO):
+        def release_conn(self):
+            pass
+
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket_exists(self, bucket):
+        return bucket in self.buckets
+
+    def make_bucket(self, bucket):
+        self.buckets[bucket] = {}
+
+    def put_object(self, bucket, name, f, size, content_type=None):
+        self.buckets[bucket][name] = f.read(size)
+
+    def remove_object(self, bucket, name):
+        self.buckets.get(bucket, {}).pop(name, None)
+
+    def stat_object(self, bucket, name):
+        if name not in self.buckets.get(bucket, {}):
+            raise KeyError(name)
+
+    def get_object(self, bucket, name):
+        self.stat_object(bucket, name)
+        return self.Object(self.buckets[bucket][name])
+
+def test_assert_invalidates_fact_cache(tmpdir, monkeypatch):
+    import dqueue.data
+    import dqueue.factformat as factformat
+    from dqueue.data import DataFacts, FactCache
+
+    dag = ["F", ["asserted-again"]]
+    stored = {}
+
+    def consult_fact_stream(self, dag, output=None):
+        output.write(stored['content'])
+
+    class Response:
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {}
+
+    def post(url, params=None, data=None, headers=None):
+        stored['content'] = data.read()
+        return Response()
+
+    monkeypatch.setattr(DataFacts, "consult_fact_stream", consult_fact_stream)
+    monkeypatch.setattr(dqueue.data.requests, "post", post)
+
+    client = DataFacts.__new__(DataFacts)
+    client._fact_cache = FactCache(str(tmpdir), max_mb=1)
+    client.leader, client.worker_id, client._token = "http://leader", "worker", "token"
+
+    stored['content'] = factformat.dumps(dag, dict(value=b"first"))
+    assert bytes(client.consult_fact_binary(dag).data['value']) == b"first"
+
+    client.assert_fact_binary(dag, dict(value=b"second"))
+    assert not os.path.exists(client.fact_cache.binary_path(dag))
+    assert bytes(client.consult_fact_binary(dag).data['value']) == b"second"
+
+def test_store_stream_replaces_json_fact():
+    import dqueue.facts as facts
+
+    dag = ["F", ["raw-over-json"]]
+    bucket = facts.fact_bucket(dag)
+
+    client = FakeMinio()
+    client.make_bucket(bucket)
+    client.put_object(bucket, "data", io.BytesIO(b'{"data": "json"}'), 16)
+    client.put_object(bucket, "meta", io.BytesIO(b'{}'), 2)
+    facts.restored.put(bucket, dict(dag_json=json.dumps(dag), data_json='"json"'))
+
+    report = facts.store_stream(dag, io.BytesIO(b"raw bytes"), client=client)
+
+    assert sorted(client.buckets[bucket]) == ["data.bin", "data.bin.meta"]
+    assert facts.raw_meta(dag, client=client)['format'] == "raw"
+    assert facts.restored.get(bucket) is None
+    assert facts.known.known([bucket]) == {bucket: True}
+    assert report['size'] == len(b"raw bytes")
+
+def test_fact_container(tmpdir):
+    numpy = pytest.importorskip("numpy")
+    import dqueue.factformat as factformat
+
+    dag = ["F", ["container"]]
+    data = dict(
+            name="image",
+            ima_content=os.urandom(1000),
+            spectrum=numpy.arange(12, dtype=numpy.float32).reshape(3, 4),
+            parts=[b"abc", 1],
+        )
+
+    fn = str(tmpdir.join("fact.dqfact"))
+    with open(fn, "wb") as f:
+        factformat.write(f, dag, data)
+
+    with factformat.load(fn) as fact:
+        assert fact.dag == dag
+        assert fact.data['name'] == "image"
+        assert bytes(fact.data['ima_content']) == data['ima_content']
+        assert (fact.data['spectrum'] == data['spectrum']).all()
+        assert bytes(fact.data['parts'][0]) == b"abc"
+
+        json_data = factformat.to_json_data(fact.data)
+
+    # JSON facts are read with the same interface
+    json_fn = str(tmpdir.join("fact.json"))
+    json.dump(dict(dag=dag, data=json_data), open(json_fn, "w"))
+
+    with factformat.load(json_fn) as fact:
+        assert fact.data['ima_content'] == data['ima_content']
+        assert (fact.data['spectrum'] == data['spectrum']).all()
+        assert fact.data['spectrum'].dtype == data['spectrum'].dtype
+        assert fact.data['parts'] == data['parts']
+
+    # bytes under any key, and arrays, round-trip through JSON
+    data = dict(payload=os.urandom(100), cube=numpy.arange(24, dtype=numpy.int16).reshape(2, 3, 4), text="plain")
+    restored = factformat.from_json_data(json.loads(json.dumps(factformat.to_json_data(data))))
+    assert restored['payload'] == data['payload']
+    assert (restored['cube'] == data['cube']).all() and restored['cube'].shape == (2, 3, 4)
+    assert restored['text'] == "plain"
+
+    # legacy JSON facts: base64 strings under _content keys
+    assert factformat.from_json_data({"ima_content": base64.b64encode(b"legacy").decode()}) == {"ima_content": b"legacy"}
+
+def test_consult_fact_binary_larger_than_cache(tmpdir, monkeypatch):
+    import dqueue.factformat as factformat
+    from dqueue.data import DataFacts, FactCache
+
+    dag = ["F", ["larger-than-cache"]]
+    data = dict(ima_content=os.urandom(4096))
+
+    def consult_fact_stream(self, dag, output=None):
+        factformat.write(output, dag, data)
+
+    monkeypatch.setattr(DataFacts, "consult_fact_stream", consult_fact_stream)
+
+    client = DataFacts.__new__(DataFacts)
+    client._fact_cache = FactCache(str(tmpdir), max_mb=1./1024)
+
+    # evicted right after it is downloaded, but already mapped
+    fact = client.consult_fact_binary(dag)
+    assert bytes(fact.data['ima_content']) == data['ima_content']
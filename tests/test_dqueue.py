@@ -421,3 +421,766 @@ def test_local_queue():
     import dqueue
     
     queue=dqueue.from_uri("test-queue")
+
+def test_priority_and_fair_share():
+    import dqueue
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked"])
+    queue.clear_task_history()
+
+    # one user floods the queue before the other submits anything
+    for i in range(5):
+        queue.put(dict(test=1, data=i), submission_data=dict(user_email="flood@odahub.io"))
+
+    queue.put(dict(test=2, data=0), submission_data=dict(user_email="other@odahub.io"))
+    queue.put(dict(test=3, data=0), submission_data=dict(user_email="other@odahub.io"), priority=10)
+
+    served = []
+    for i in range(7):
+        task = queue.get()
+        served.append((task.user_email, task.task_data['test']))
+        queue.task_done()
+
+    # urgent task jumps the queue, then the users alternate while both have waiting tasks
+    assert served[0] == ("other@odahub.io", 3)
+    assert served[1][0] == "flood@odahub.io"
+    assert served[2] == ("other@odahub.io", 2)
+    assert [u for u, _ in served[3:]] == ["flood@odahub.io"] * 4
+
+    with pytest.raises(dqueue.Empty):
+        queue.get()
+
+def test_concurrency_limits():
+    import dqueue
+    import dqueue.core as core
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+    queue.clear_task_history()
+    queue.recount_running_slots()
+
+    for i in range(3):
+        queue.put(dict(test=1, data=i), submission_data=dict(user_email="flood@odahub.io"))
+    queue.put(dict(test=2, data=0), submission_data=dict(user_email="other@odahub.io"))
+
+    workers = [dqueue.Queue("test-queue", worker_id=f"worker-{i}") for i in range(4)]
+
+    try:
+        core.max_running_per_user = 1
+
+        # each user gets one running task, the rest waits
+        tasks = [workers[0].get(), workers[1].get()]
+        assert sorted(t.user_email for t in tasks) == ["flood@odahub.io", "other@odahub.io"]
+
+        with pytest.raises(dqueue.Empty):
+            workers[2].get()
+
+        flood_worker = workers[[t.user_email for t in tasks].index("flood@odahub.io")]
+        flood_worker.task_done()
+
+        assert workers[2].get().user_email == "flood@odahub.io"
+
+        core.max_running_per_user = 0
+        core.max_running_per_queue = 2
+        # counters are only kept while limits are on
+        queue.recount_running_slots()
+
+        with pytest.raises(dqueue.Empty):
+            workers[3].get()
+
+        workers[2].task_failed()
+
+        assert workers[3].get().user_email == "flood@odahub.io"
+    finally:
+        core.max_running_per_user = 0
+        core.max_running_per_queue = 0
+
+def test_retry_backoff():
+    import datetime
+    import dqueue
+    import dqueue.core as core
+    from dqueue.database import TaskEntry
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+    queue.clear_task_history()
+
+    queue.put(dict(test=1, data="backoff"))
+
+    retry_backoff_s, sleep_multiplier = core.retry_backoff_s, core.sleep_multiplier
+    try:
+        core.retry_backoff_s = 3600
+        core.sleep_multiplier = 1
+
+        queue.get()
+        queue.task_failed()
+
+        queue.forgive_task_failures()
+        assert queue.info['waiting'] == 1
+
+        # forgiven, but not offered before the backoff delay
+        with pytest.raises(dqueue.Empty):
+            queue.get()
+
+        TaskEntry.update({TaskEntry.not_before: datetime.datetime.now()}).execute(database=None)
+
+        assert queue.get().task_data == dict(test=1, data="backoff")
+        queue.task_done()
+
+        assert core.retry_not_before(1) < core.retry_not_before(2)
+
+        # tasks which keep expiring back off as well
+        core.retry_backoff_s = 100
+        queue.put(dict(test=1, data="expiring"))
+        guardian = dqueue.Queue("test-queue")
+
+        delays = []
+        for i in range(3):
+            queue.forgive_task_failures()
+            TaskEntry.update({TaskEntry.not_before: datetime.datetime.now()}).execute(database=None)
+            key = queue.get().key
+            TaskEntry.update({TaskEntry.update_expected_in_s: -1}).execute(database=None)
+            assert guardian.expire_tasks() == 1
+            queue.current_task = None
+
+            entry = TaskEntry.get(TaskEntry.key == key)
+            delays.append((entry.not_before - datetime.datetime.now()).total_seconds())
+
+        assert [round(d, -2) for d in delays] == [100, 200, 400]
+    finally:
+        core.retry_backoff_s, core.sleep_multiplier = retry_backoff_s, sleep_multiplier
+
+def test_failure_limit():
+    import dqueue
+    import dqueue.core as core
+    import dqueue.database as database
+    from dqueue.database import TaskEntry, EventLog
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+    queue.clear_task_history()
+
+    sleep_multiplier = core.sleep_multiplier
+    try:
+        core.sleep_multiplier = 0
+
+        queue.put(dict(test=1, data="limit"))
+        queue.get()
+        queue.task_failed()
+        assert TaskEntry.get().n_failed == 1
+
+        # at the limit: not forgiven
+        TaskEntry.update({TaskEntry.n_failed: core.n_failed_retries}).execute(database=None)
+        assert queue.forgive_task_failures() == 0
+        assert queue.info['failed'] == 1
+
+        # expired claims count as failures
+        TaskEntry.update({TaskEntry.n_failed: 1}).execute(database=None)
+        queue.forgive_task_failures()
+        queue.get()
+        TaskEntry.update({TaskEntry.update_expected_in_s: -1}).execute(database=None)
+        assert queue.expire_tasks() == 1
+        assert TaskEntry.get().n_failed == 2
+
+        # the worker reporting the failure late does not count it again
+        not_before = TaskEntry.get().not_before
+        queue.task_failed()
+        assert TaskEntry.get().n_failed == 2
+        assert TaskEntry.get().not_before == not_before
+
+        # rows from before the column: counted from the event log and the task, every failure event, late ones too
+        TaskEntry.update({TaskEntry.n_failed: 0}).execute(database=None)
+        assert database.backfill_n_failed() == 1
+        assert TaskEntry.get().n_failed == 3
+
+        # no trace of failures: taken as exhausted, and stays failed
+        TaskEntry.update({TaskEntry.n_failed: 0, TaskEntry.execution_info: None}).execute(database=None)
+        EventLog.delete().execute(database=None)
+        assert database.backfill_n_failed(core.n_failed_retries) == 1
+        assert TaskEntry.get().n_failed == core.n_failed_retries
+
+        assert queue.forgive_task_failures() == 0
+        assert queue.info['failed'] == 1
+    finally:
+        core.sleep_multiplier = sleep_multiplier
+
+def test_transitions_versioning():
+    import dqueue
+    from dqueue.database import TaskEntry
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+    queue.clear_task_history()
+
+    queue.put(dict(test=1, data="versioned"))
+    key = queue.get().key
+
+    version = TaskEntry.get(TaskEntry.key == key).version
+    assert queue.current_task_version == version
+
+    # stale version loses
+    assert not queue.transition(key, ["running"], "waiting", expected_version=version - 1)
+    assert queue.transition(key, ["running"], "running", expected_version=version)
+    assert not queue.transition(key, ["running"], "waiting", expected_version=version)
+
+    # claim is lost, but the result is still taken
+    queue.task_done()
+    assert queue.info['done'] == 1
+
+    # duplicate completion is a no-op
+    assert not queue.transition(key, ["reserved", "running"], "done")
+    assert TaskEntry.get(TaskEntry.key == key).state == "done"
+
+    # late completion after expiry
+    queue.put(dict(test=1, data="late"))
+    queue.get()
+    TaskEntry.update({TaskEntry.state: "failed"}).where(TaskEntry.key == queue.current_task.key).execute(database=None)
+    queue.task_done()
+    assert queue.info['done'] == 2
+    assert queue.info['failed'] == 0
+
+def test_move_task_reconnects(monkeypatch):
+    import peewee
+    import dqueue
+    import dqueue.core as core
+    import dqueue.database as database
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+
+    key = queue.put(dict(test=1, data="reconnect"))['key']
+
+    transition = queue.transition
+    failures = [peewee.OperationalError("connection dropped")]
+    def flaky_transition(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return transition(*args, **kwargs)
+
+    reconnects = []
+    sleeps = []
+    monkeypatch.setattr(queue, "transition", flaky_transition)
+    monkeypatch.setattr(database, "reconnect", lambda: reconnects.append(1))
+    monkeypatch.setattr(core.time, "sleep", sleeps.append)
+
+    # one dropped connection does not lose the transition, even with a single try asked for
+    assert queue.move_task("waiting", "locked", key)
+    assert reconnects == [1]
+    assert queue.info['locked'] == 1
+
+    # delays are bounded
+    failures[:] = [peewee.OperationalError("down")] * 30
+    assert not queue.move_task("locked", "waiting", key, n_tries_left=30)
+    assert max(sleeps) == core.move_retry_max_delay_s
+
+def test_state_updates_keep_task_blob():
+    import dqueue
+    from dqueue.database import TaskEntry
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+    queue.clear_task_history()
+
+    queue.put(dict(test=1, data="blob"))
+    key = queue.get().key
+
+    blob = TaskEntry.get(TaskEntry.key == key).task_dict_string
+
+    queue.current_task.execution_info = dict(n_times_failed=1, exception="boom")
+    queue.task_failed()
+
+    entry = TaskEntry.get(TaskEntry.key == key)
+    assert entry.task_dict_string == blob
+    assert dqueue.core.Task.from_entry(entry).execution_info == dict(n_times_failed=2, exception="boom")
+
+def test_blob_store(tmpdir):
+    import dqueue
+    import dqueue.entry
+    import dqueue.blobstore as blobstore
+    from dqueue.database import TaskEntry
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+    queue.clear_task_history()
+
+    store, blob_min_size = blobstore._store, blobstore.blob_min_size
+    try:
+        blobstore._store = blobstore.LocalBlobStore(str(tmpdir))
+        blobstore.blob_min_size = 0
+
+        task_data = dict(test=1, data="large" * 1000)
+        queue.put(task_data)
+
+        entry = TaskEntry.get()
+        assert entry.task_dict_string == ""
+        assert entry.task_dict_size > 5000
+        assert blobstore._store.exists(entry.task_dict_blob)
+
+        assert queue.get().task_data == task_data
+        queue.current_task.execution_info = dict(output="large" * 1000)
+        queue.task_done()
+
+        entry = TaskEntry.get()
+        assert entry.execution_info is None
+        assert dqueue.core.Task.from_entry(entry).execution_info == dict(output="large" * 1000)
+
+        task_dict = dqueue.entry.decode_entry_data(queue.task_by_key(entry.key))
+        assert task_dict['task_data'] == task_data
+
+        # same payload, same blob
+        assert blobstore.put(blobstore.get(entry.task_dict_blob)) == (entry.task_dict_blob, entry.task_dict_size)
+
+        # blobs are fetched only where the payload is used: not to find instances of a task by state
+        fetched = []
+        get = blobstore.get
+        blobstore.get = lambda sha: fetched.append(sha) or get(sha)
+        try:
+            task = dqueue.core.Task(task_data)
+            assert [i['state'] for i in queue.find_task_instances(task)] == ["done"]
+            assert fetched == []
+
+            assert queue.find_task_instances(task, inline=True)[0]['task_dict_string'] != ""
+            assert len(fetched) == 2
+
+            assert queue.put(task_data)['task_dict_string'] != ""
+        finally:
+            blobstore.get = get
+    finally:
+        blobstore._store, blobstore.blob_min_size = store, blob_min_size
+
+def test_archive(client, monkeypatch):
+    import datetime
+    import dqueue
+    import dqueue.api
+    from dqueue.database import TaskEntry
+
+    queue=dqueue.Queue("test-queue")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+    queue.clear_task_history()
+
+    for i in range(5):
+        queue.put(dict(test=1, data=i))
+        queue.get()
+        queue.task_done()
+
+    queue.put(dict(test=1, data="recent"))
+    queue.get()
+    queue.task_done()
+
+    other_queue=dqueue.Queue("test-queue-other")
+    other_queue.put(dict(test=1, data="other queue"))
+    other_queue.get()
+    other_queue.task_done()
+
+    key = dqueue.core.Task(dict(test=1, data=0)).key
+
+    TaskEntry.update({TaskEntry.modified: datetime.datetime.now() - datetime.timedelta(days=10)})\
+             .where(TaskEntry.key != dqueue.core.Task(dict(test=1, data="recent")).key)\
+             .execute(database=None)
+
+    # the API archives one queue if asked to, and in a limited number of batches
+    monkeypatch.setattr(dqueue.api, "archive_max_batches", 2)
+    r = client.get('/tasks/archive', query_string=dict(queue="test-queue", older_than_days=1, batch_size=1, max_batches=100))
+    assert r.json['tasks'] == 2
+
+    assert queue.archive_tasks(older_than_days=1, batch_size=2, pause_s=0, only_this_queue=True) == 3
+    assert other_queue.info['done'] == 1
+
+    assert queue.archive_tasks(older_than_days=1) == 1
+    assert queue.archive_tasks(older_than_days=1) == 0
+
+    assert queue.info['done'] == 1
+
+    # archived tasks are still known
+    assert queue.task_by_key(key)['state'] == "done"
+    assert queue.put(dict(test=1, data=0))['state'] == "done"
+    assert queue.info['waiting'] == 0
+
+def test_event_log_retention():
+    import datetime
+    import dqueue
+    from dqueue.database import EventLog
+    from dqueue import retention
+    from dqueue.retention import RetentionPolicy
+
+    queue=dqueue.Queue("test-queue")
+    queue.clear_event_log()
+
+    for i in range(10):
+        queue.log_task(f"event {i}", task_key="task-a")
+    for i in range(3):
+        queue.log_task(f"event {i}", task_key="task-b")
+        queue.note_worker_state(f"state {i}")
+
+    EventLog.update({EventLog.timestamp: datetime.datetime.now() - datetime.timedelta(days=1)})\
+            .where(EventLog.worker_state == "state 0")\
+            .execute(database=None)
+
+    policies = [
+            RetentionPolicy("task", keep_last=4),
+            RetentionPolicy("worker", max_age_days=0.5),
+        ]
+
+    # events are kept until they are rolled up
+    assert queue.apply_event_log_retention(policies)['deleted'] == 0
+
+    queue.rollup_event_log(lag_s=0)
+    r = queue.apply_event_log_retention(policies)
+
+    assert r['deleted'] == 6 + 1
+    assert [p['deleted'] for p in r['policies']] == [6, 1]
+
+    assert len(queue.view_log(task_key="task-a")) == 4
+    assert len(queue.view_log(task_key="task-b")) == 3
+
+    # the most recent are counted among all events, but only those rolled up are deleted
+    for i in range(6):
+        queue.log_task(f"event {i}", task_key="task-b")
+
+    assert queue.apply_event_log_retention(policies)['deleted'] == 3
+    assert len(queue.view_log(task_key="task-b")) == 6
+
+    queue.rollup_event_log(lag_s=0)
+    assert queue.apply_event_log_retention(policies)['deleted'] == 2
+    assert len(queue.view_log(task_key="task-b")) == 4
+
+    # deletion stops after max_chunks, each of at most chunk_size rows
+    r = retention.delete_chunked(chunk_size=2, pause_s=0, max_chunks=2)
+    assert r['chunks'] == 2
+    assert r['deleted'] <= 4
+
+    # chunks are of matching ids, however sparse: deleting a few events of a task among many takes one chunk
+    queue.clear_event_log()
+    for i in range(6):
+        queue.log_task(f"event {i}", task_key="task-sparse")
+        for j in range(20):
+            queue.note_worker_state(f"state {i} {j}")
+
+    queue.rollup_event_log(lag_s=0)
+    r = queue.apply_event_log_retention([RetentionPolicy("task", keep_last=2)])
+    assert r['deleted'] == 4
+    assert r['chunks'] == 1
+
+    # the chunk budget is for the whole pass, not each task
+    for t in "abc":
+        for i in range(3):
+            queue.log_task(f"event {i}", task_key=f"task-{t}")
+
+    queue.rollup_event_log(lag_s=0)
+    r = queue.apply_event_log_retention([RetentionPolicy("task", keep_last=1)], max_chunks=2)
+    assert r['chunks'] == 2
+    assert r['deleted'] == 4
+
+    # each chunk starts after the last one: rows kept are not scanned again
+    from dqueue.database import query_hooks
+    for i in range(6):
+        queue.log_task(f"event {i}", task_key="task-keyset")
+
+    statements = []
+    query_hooks.append(lambda sql, params, duration_s, cursor: statements.append((sql, params)))
+    try:
+        r = retention.delete_chunked(EventLog.task_key == "task-keyset", chunk_size=2, pause_s=0)
+    finally:
+        query_hooks.pop()
+
+    assert r['deleted'] == 6
+    first_ids = [params[0] for sql, params in statements if sql.startswith("SELECT")]
+    assert first_ids[0] == 0 and first_ids == sorted(set(first_ids))
+
+    # tasks without events since the last complete pass are not scanned
+    from dqueue.database import RollupWatermark
+    for i in range(5):
+        queue.log_task(f"event {i}", task_key="task-scanned")
+    queue.rollup_event_log(lag_s=0)
+
+    watermark = RollupWatermark.insert(name="retention-keep-last-2", last_id=retention.rollup.rolled_up_id())
+    watermark.on_conflict_replace().execute(database=None)
+    assert queue.apply_event_log_retention([RetentionPolicy("task", keep_last=2)])['deleted'] == 0
+    assert len(queue.view_log(task_key="task-scanned")) == 5
+
+    RollupWatermark.update({RollupWatermark.last_id: 0}).where(RollupWatermark.name == "retention-keep-last-2").execute(database=None)
+    queue.apply_event_log_retention([RetentionPolicy("task", keep_last=2)])
+    assert len(queue.view_log(task_key="task-scanned")) == 2
+
+def test_rollup():
+    import dqueue
+
+    queue=dqueue.Queue("test-queue", worker_id="worker-rollup")
+    queue.wipe(["waiting","done","running","failed","locked","reserved"])
+    queue.rollup_event_log(lag_s=0)
+
+    for i in range(3):
+        queue.put(dict(test=1, data=i, object_identity=dict(factory_name="Factory", full_name=f"Factory(i={i})")))
+        queue.get()
+        if i < 2:
+            queue.task_done()
+        else:
+            queue.task_failed()
+
+    for spent_s in 1, 2, 10:
+        queue.log_queue("spent", spent_s, "worker-rollup")
+
+    assert queue.rollup_event_log(lag_s=3600)['events'] == 0
+
+    r = queue.rollup_event_log(lag_s=0)
+    assert r['events'] > 0
+    assert queue.rollup_event_log(lag_s=0)['events'] == 0
+
+    buckets = queue.get_rollup(period="hour", group_by=["worker_id", "factory_name"])
+    by_group = {(b['worker_id'], b['factory_name']): b for b in buckets}
+
+    b = by_group[("worker-rollup", "Factory")]
+    assert b['n_started'] == 3
+    assert b['n_done'] == 2
+    assert b['n_failed'] == 1
+
+    b = by_group[("worker-rollup", "unknown")]
+    assert b['spent_s_count'] == 3
+    assert b['spent_s_sum'] == 13
+    assert abs(b['spent_s_p50'] - 2) / 2 < 0.1
+
+def test_metrics(tmpdir):
+    import subprocess
+    import dqueue
+    from dqueue import metrics
+
+    registry = metrics.Registry(buckets=(0.1, 1), directory=str(tmpdir))
+    registry.inc("dqueue_test_total", state="done")
+    registry.inc("dqueue_test_total", 2, state="done")
+    registry.observe("dqueue_test_seconds", 0.05)
+    registry.observe("dqueue_test_seconds", 5)
+
+    text = registry.exposition()
+    assert 'dqueue_test_total{state="done"} 3' in text
+    assert 'dqueue_test_seconds_bucket{le="0.1"} 1' in text
+    assert 'dqueue_test_seconds_bucket{le="+Inf"} 2' in text
+    assert 'dqueue_test_seconds_count 2' in text
+    assert registry.flusher is not None
+
+    # an exited process: its counters are kept, in the file of all exited processes
+    p = subprocess.Popen(["true"])
+    p.wait()
+    exited = metrics.Registry(buckets=(0.1, 1), directory=str(tmpdir))
+    exited.inc("dqueue_test_total", 4, state="done")
+    metrics.write_snapshot(os.path.join(str(tmpdir), f"metrics-{p.pid}.json"), exited.snapshot())
+
+    for i in range(2):
+        assert 'dqueue_test_total{state="done"} 7' in registry.exposition()
+        assert not os.path.exists(os.path.join(str(tmpdir), f"metrics-{p.pid}.json"))
+        assert os.path.exists(registry.exited_filename)
+
+    queue=dqueue.Queue("test-queue")
+    queue.put(dict(test=1, data="metrics"))
+
+    text = metrics.registry.exposition()
+    assert 'dqueue_put_seconds_count{outcome="ok"}' in text
+    assert 'dqueue_db_query_seconds_bucket{statement="INSERT",le="+Inf"}' in text
+
+def test_connection_checkout():
+    import dqueue.database as database
+
+    database.release_connection()
+    assert database.db.is_closed()
+
+    database.checkout_connection()
+    assert not database.db.is_closed()
+    assert database.pool_stats()['in_use'] >= 1
+
+    database.reconnect()
+    assert not database.db.is_closed()
+
+    database.release_connection()
+    assert database.db.is_closed()
+
+def test_profiling(client, tmpdir, monkeypatch):
+    import dqueue
+    from dqueue import profiling
+
+    monkeypatch.setattr(profiling, "profile_dir", str(tmpdir))
+    monkeypatch.setattr(profiling, "max_keep", 2)
+
+    queue=dqueue.Queue("test-queue")
+
+    with profiling.profiled("guardian") as profile:
+        assert profile is None
+
+    with profiling.profiled("guardian", force=True) as profile:
+        queue.expire_tasks()
+
+    summary = profiling.load_summary(profile.id)
+    assert summary['name'] == "guardian"
+    assert summary['n_queries'] > 0
+    assert "expire_tasks" in profiling.stats_text(profile.id)
+
+    # any token is accepted; a token is still needed for the request to be authenticated at all
+    monkeypatch.setenv("DQUEUE_DISABLE_AUTH", "yes")
+    monkeypatch.setattr(profiling, "header_enabled", True)
+    headers = {"Authorization": "Bearer token"}
+    assert client.get('/profiles/list', headers=headers).json[0]['id'] == profile.id
+
+    client.get('/profiles/list', headers={**headers, profiling.header: "yes"})
+    profiles = client.get('/profiles/list', headers=headers).json
+    assert len(profiles) == 2
+    assert profiles[0]['name'] == "GET /profiles/list"
+
+    r = client.get('/profiles/get', query_string=dict(profile_id=profiles[0]['id'], format="text"), headers=headers)
+    assert r.status_code == 200
+    assert "cumulative" in r.data.decode()
+
+    assert client.get('/profiles/get', query_string=dict(profile_id="../secret"), headers=headers).status_code == 400
+
+    with profiling.profiled("guardian", force=True):
+        pass
+
+    assert len(profiling.list_profiles()) == 2
+
+def test_query_tracing(client, caplog, monkeypatch):
+    import dqueue
+    from dqueue import tracing
+
+    tracer = tracing.QueryTracer(top_n=2, slow_query_s=0.1, max_statements=2)
+    tracer.trace("SELECT 1 WHERE x = ?", ["a"], 0.01, None)
+    tracer.trace("SELECT 1 WHERE x = ?", ["a"], 0.03, None)
+    tracer.trace("SELECT 1 WHERE x = ?", [1], 0.2, None)
+    tracer.trace("SELECT 2", [], 0.02, None)
+
+    assert "slow query" in caplog.text
+
+    r = tracer.report()
+    assert r['n_traced'] == 4
+    assert [(s['params'], s['count']) for s in r['statements']] == [("int", 1), ("str", 2)]
+    assert r['statements'][1]['max_s'] == 0.03
+    assert [s['duration_s'] for s in r['slowest']] == [0.2, 0.03]
+
+    tracer.expire(time.time() + tracer.window_s)
+    assert tracer.slowest == []
+
+    queue=dqueue.Queue("test-queue")
+    queue.put(dict(test=1, data="tracing"))
+
+    monkeypatch.setenv("DQUEUE_DISABLE_AUTH", "yes")
+    r = client.get('/metrics/queries', headers={"Authorization": "Bearer token"}).json
+    assert any(s['sql'].startswith("INSERT") and s['rows'] > 0 for s in r['statements'])
+
+def test_lazy_logging(caplog):
+    from dqueue import extralogging
+
+    calls = []
+    def expensive():
+        calls.append(1)
+        return "formatted"
+
+    logger = logging.getLogger("dqueue.test.lazy")
+    logger.setLevel(logging.WARNING)
+
+    logger.info("%s", extralogging.Lazy(expensive))
+    assert calls == []
+
+    logger.warning("%s", extralogging.Lazy(expensive))
+    assert calls == [1]
+    assert "formatted" in caplog.text
+
+    rate_limited = extralogging.RateLimited(logger, interval_s=3600)
+    for i in range(5):
+        rate_limited.log(logging.WARNING, "kind", "event %s", i)
+
+    assert len([r for r in caplog.records if r.getMessage().startswith("event")]) == 1
+
+    rate_limited.last["kind"] = 0
+    rate_limited.log(logging.WARNING, "kind", "event %s", 5)
+    assert "event 5 (and 4 similar" in caplog.text
+
+def test_log_shipping():
+    import json
+    import socket
+    import threading
+    from dqueue import logshipping
+
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(10)
+
+    received = []
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                received.append(b"".join(iter(lambda: conn.recv(65536), b"")))
+
+    threading.Thread(target=accept, daemon=True).start()
+
+    url = "127.0.0.1:%d" % server.getsockname()[1]
+
+    stasher = logshipping.AsyncLogStasher(url, max_queued=3, batch_size=2, json_lines=True)
+    for i in range(5):
+        stasher.enqueue(dict(i=i, nested=dict(a=1)))
+
+    assert stasher.stats()['dropped'] == 2
+
+    assert stasher.flush() == 3
+
+    for i in range(100):
+        if len(received) == 2:
+            break
+        time.sleep(0.01)
+
+    lines = b"".join(received).splitlines()
+    assert [json.loads(l)['i'] for l in lines] == [2, 3, 4]
+    assert json.loads(lines[0])['nested/a'] == 1
+
+    # logstash down: messages are counted as failed, the caller is not delayed
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        url = "127.0.0.1:%d" % unused.getsockname()[1]
+
+    stasher = logshipping.AsyncLogStasher(url, flush_interval_s=0.01)
+
+    t0 = time.time()
+    stasher.log(dict(i=0))
+    assert time.time() - t0 < 0.1
+
+    for i in range(100):
+        if stasher.stats()['failed'] == 1:
+            break
+        time.sleep(0.01)
+
+    assert stasher.stats()['failed'] == 1
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_per_process_state(tmpdir):
+    from dqueue import tracing, logshipping, facts, metrics
+
+    tracer = tracing.QueryTracer()
+    tracer.trace("SELECT 1", [], 0.01, None)
+
+    stasher = logshipping.AsyncLogStasher(url=None, async_enabled=True)
+    stasher.enqueue(dict(message="parent"))
+
+    restored = facts.RestoredFacts()
+    restored.put("odahub-b-parent", dict(dag_json="[]", data_json="1"))
+
+    registry = metrics.Registry(directory=str(tmpdir))
+    registry.inc("dqueue_test_total")
+
+    # held by threads of the parent, which do not exist in the child
+    tracer.lock.acquire()
+    restored.lock.acquire()
+    registry.lock.acquire()
+
+    pid = os.fork()
+    if pid == 0:
+        ok = tracer.lock.acquire(timeout=1) and tracer.n_traced == 0 and len(stasher.queue) == 0 and stasher.thread is None
+        ok = ok and restored.lock.acquire(timeout=1) and restored.facts == {}
+        ok = ok and registry.lock.acquire(timeout=1) and registry.counters == {} and registry.flusher is None
+        os._exit(0 if ok else 1)
+
+    tracer.lock.release()
+    restored.lock.release()
+    registry.lock.release()
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert tracer.n_traced == 1
+    assert len(stasher.queue) == 1
+    assert restored.get("odahub-b-parent") is not None
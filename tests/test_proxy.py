@@ -169,6 +169,15 @@ class TestLiveServer:
         
         to = self.queue.get()
     
+    def test_move_queue(self):
+        self.queue.purge()
+
+        self.local_queue.put({'move': 1}, {})
+        assert self.queue.move_queue_tasks("default", "moved-to") == 1
+
+        assert Queue("moved-to").list() != []
+        assert self.queue.move_queue_tasks("moved-to", "default") == 1
+
     @pytest.mark.xfail(reason='timing is very hard')
     def test_expire(self):
         self.queue.purge()
@@ -246,3 +255,52 @@ class TestLiveServer:
 
         assert t10 == tr10
         
+
+def test_request_statistics(client):
+    import dqueue.app
+    from dqueue.app import Request, request_db
+
+    sampler = dqueue.app.request_sampler
+    sampler.flush()
+
+    with dqueue.app.app.app_context():
+        n_before = Request.query.count()
+
+    for i in range(3):
+        client.get("healthcheck")
+
+    # recorded in memory, stored in batch by the background thread or here
+    sampler.flush()
+
+    with dqueue.app.app.app_context():
+        assert Request.query.count() >= n_before + 3
+
+    r = client.get("statistics/")
+    assert r.status_code == 200
+
+def test_request_statistics_weight(client, monkeypatch):
+    import datetime
+    import dqueue.app
+    from dqueue.app import Request
+
+    sampler = dqueue.app.request_sampler
+    sampler.flush()
+
+    # every request sampled, but each recorded as standing for 4
+    monkeypatch.setattr(sampler, "sample_rate", 0.25)
+    monkeypatch.setattr("random.random", lambda: 0)
+
+    for i in range(3):
+        client.get("healthcheck")
+
+    sampler.flush()
+
+    with dqueue.app.app.app_context():
+        assert {r.weight for r in Request.query.filter(Request.path == "/healthcheck").order_by(Request.index.desc()).limit(3)} == {4.}
+
+        now = datetime.datetime.utcnow()
+        routes = {r.path: r for r in dqueue.app.statistics.api.get_routes_data(now - datetime.timedelta(days=1), now + datetime.timedelta(days=1))}
+        weights = [r.weight for r in Request.query.filter(Request.path == "/healthcheck")]
+        assert routes["/healthcheck"].hits == sum(weights) > len(weights)
+
+    assert client.get("statistics/").status_code == 200